@@ -1,11 +1,20 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import random
+import time
 from collections import defaultdict
 from enum import Enum
 
 import redis
-from config.configuration import get_logger
+from canonical import canonicalize
+from config.configuration import (FRONTIER, HEARTBEAT_EVERY, LEASE_TIMEOUT,
+                                  RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                                  SEEN_BACKEND, TRANSPORT, get_logger)
+from frontier import make_frontier
+from seen import make_seen_set
+from streams import StreamQueue, consumer_name
 
 logger = get_logger("data")
 
@@ -25,17 +34,57 @@ class CrawlTracker:
     """Track the status of a URL"""
 
     def __init__(
-        self, redis_conn: redis.Redis, seed_url: str, run_id: str, max_pages: int
+        self,
+        redis_conn: redis.Redis,
+        seed_url: str,
+        run_id: str,
+        max_pages: int,
+        retries: int = RETRIES,
+        seen_backend: str = SEEN_BACKEND,
+        frontier: str = FRONTIER,
+        transport: str = TRANSPORT,
+        lease_timeout: float = LEASE_TIMEOUT,
     ):
         self.rdb = redis_conn
         self.seed_url = seed_url
         self.run_id = run_id
         self.urls = defaultdict(dict)
         self.max_pages = max_pages
+        self.retries = retries
         self.limit_reached = False
+        # Earliest time a retry is due, so idle workers know when to wake
+        self.next_retry_due = 0.0
+        # Urls already requested, so each is only downloaded and parsed once
+        self.download_seen = make_seen_set(
+            redis_conn, "download_requests", seen_backend
+        )
+        self.parse_seen = make_seen_set(redis_conn, "parse_requests", seen_backend)
+        self.transport = transport
+        self.persist_stream = None
+        if transport == "streams":
+            # Urls and rows for the db are only dropped once acknowledged
+            frontier = "stream"
+            self.persist_stream = StreamQueue(redis_conn, "stream:persist")
+        self.frontier = make_frontier(redis_conn, frontier)
+        # Popped urls are leased to this worker until closed. Leases are
+        # kept alive by its heartbeats, and put back on the frontier by the
+        # reaper if they lapse, e.g. because the worker's node died.
+        # Named as it's used, as crawl processes are forked w/ this tracker.
+        self._worker_id = None
+        self.lease_timeout = lease_timeout
+        self.leased = set()
+        self.next_reap = 0.0
 
-    async def init_url_data(self, url: str) -> None:
-        init_vals = {
+    @property
+    def worker_id(self) -> str:
+        return self._worker_id or consumer_name()
+
+    @worker_id.setter
+    def worker_id(self, worker_id: str):
+        self._worker_id = worker_id
+
+    def url_init_data(self) -> dict:
+        return {
             "attrs": {
                 "seed_url": self.seed_url,
                 "run_id": self.run_id,
@@ -43,67 +92,368 @@ class CrawlTracker:
                 "max_pages": self.max_pages,
             }
         }
-        await self.update_url(url, init_vals)
+
+    async def init_url_data(self, url: str) -> None:
+        await self.update_url(url, self.url_init_data())
 
     async def close_url(self, url: str, pipe=None) -> None:
         if pipe is None:
             pipe = self.rdb.pipeline()
         # Create single transaction w/ multiple operations
         key = f"urls:{url}"
-        pipe.incr("completed_pages").get("completed_pages")
-        _, completed_pages = await pipe.execute()
-        await self.rdb.publish("db", json.dumps({"key": key, "table_name": "urls"}))
+        self.release_lease(pipe, url)
+        # Whether it succeeded on a retry or was dead-lettered, the url is done
+        pipe.hdel("retry_attempts", url)
+        self.frontier.forget(pipe, url)
+        # Urls may be delivered, and so closed, more than once. Only the
+        # close that takes a url out of flight counts it as done.
+        pipe.srem("in_flight", url)
+        if not (await pipe.execute())[-1]:
+            logger.debug(f"{url} was already closed")
+            return
+        pipe = self.rdb.pipeline()
+        pipe.incr("completed_pages").decr("outstanding")
+        completed_pages, outstanding = await pipe.execute()
+        await self.publish_persist(json.dumps({"key": key, "table_name": "urls"}))
 
         if int(completed_pages) >= self.max_pages:
             self.limit_reached = True
-            await self.rdb.publish("db", "exit")
+            await self.signal_exit()
+        elif int(outstanding) == 0:
+            # Nothing queued, deferred, downloading or parsing, the crawl is done
+            logger.info("No outstanding urls left, closing queue")
+            await self.signal_exit()
+
+    async def publish_persist(self, message: str) -> None:
+        """Passes a message on to the db writer"""
+        if self.persist_stream is not None:
+            await self.persist_stream.put(message)
+        else:
+            await self.rdb.publish("writer", message)
+
+    async def signal_exit(self) -> None:
+        """Wakes workers blocked on the frontier so they can shut down"""
+        await self.frontier.signal_exit()
+
+    async def clear_exit(self) -> None:
+        """Removes the exit signal left on the frontier by a previous run"""
+        await self.frontier.clear_exit()
 
     async def update_url(self, url, url_data: dict, close=False) -> None:
         """
         Progresses the status of the URL through the crawl pipeline.
         If and error state is passed, the url is closed and removed from the cache.
         """
-        key = f"urls:{url}"
         pipe = self.rdb.pipeline()
         # updated all fields to redis in a single transaction
+        self.add_url_updates(pipe, url, url_data)
+        if not close:
+            return await pipe.hincrby(url, "crawl_status").execute()
+        else:
+            await self.close_url(url, pipe)
+
+    def add_url_updates(self, pipe, url: str, url_data: dict) -> None:
+        """Queues the writes for a url's fields onto a pipeline"""
+        key = f"urls:{url}"
         for field, value in url_data.items():
             if field == "attrs":
                 pipe.hset(f"{key}:attrs", mapping=value)
             elif field == "linked_urls":
-                pipe.lpush(f"{key}:linked_urls", *value)
+                if value:
+                    pipe.lpush(f"{key}:linked_urls", *value)
             else:
                 pipe.set(f"{key}:{field}", value)
-        if not close:
-            return await pipe.hincrby(url, "crawl_status").execute()
-        else:
-            await self.close_url(url, pipe)
 
-    async def get_page_to_visit(self) -> list[str]:
-        """Get all frontier seeds for a URL"""
+    async def get_page_to_visit(self, timeout: float = None) -> str | None:
+        """
+        Pops the next url from the frontier. With a timeout, blocks
+        for up to that many seconds waiting for one to arrive.
+        """
         if self.limit_reached:
             logger.warning("Max pages reached, closing queue")
             return "exit"
-        url = await self.rdb.lpop("to_visit")
+        if time.time() >= self.next_retry_due:
+            await self.requeue_due_retries()
+        if time.time() >= self.next_reap:
+            await self.reap_expired_leases()
+        url = await self.frontier.pop(timeout)
         if url is not None:
             url = url.decode("utf-8")
+        if url == "exit":
+            # Put the signal back for the other workers
+            await self.signal_exit()
+        elif url is not None and not self.frontier.redelivers:
+            await self.take_lease(url)
         return url
 
-    async def request_download(self, url: str) -> None:
+    async def take_lease(self, url: str) -> None:
+        """Leases a popped url to this worker, until it's closed or it lapses"""
+        pipe = self.rdb.pipeline()
+        pipe.zadd("leases", {url: time.time() + self.lease_timeout})
+        pipe.hset("lease_owners", url, self.worker_id)
+        await pipe.execute()
+        self.leased.add(url)
+
+    def release_lease(self, pipe, url: str) -> None:
+        pipe.zrem("leases", url)
+        pipe.hdel("lease_owners", url)
+        self.leased.discard(url)
+
+    async def heartbeat(self) -> None:
+        """Extends the leases held by this worker and records that it's alive"""
+        now = time.time()
+        pipe = self.rdb.pipeline()
+        pipe.zadd("heartbeats", {self.worker_id: now})
+        if self.leased:
+            # Only extends leases still held, ones already reaped stay reaped
+            expiry = now + self.lease_timeout
+            pipe.zadd("leases", {url: expiry for url in self.leased}, xx=True)
+        await pipe.execute()
+
+    async def keep_alive(self, done, every: float = HEARTBEAT_EVERY) -> None:
+        """Sends heartbeats every so often until done is set"""
+        while not done.is_set():
+            try:
+                await self.heartbeat()
+                await self.record_memory()
+            except Exception as e:
+                logger.error(f"Unable to send heartbeat: {e}")
+            try:
+                await asyncio.wait_for(done.wait(), every)
+            except asyncio.TimeoutError:
+                pass
+
+    async def reap_expired_leases(self) -> list[str]:
+        """
+        Puts urls whose lease has lapsed back on the frontier. Expiry times
+        come from each worker's clock, so nodes' clocks should be in sync
+        to well within the lease timeout.
+        """
+        self.next_reap = time.time() + self.lease_timeout / 4
+        expired = await self.rdb.zrangebyscore("leases", "-inf", time.time())
+        if not expired:
+            return []
+        pipe = self.rdb.pipeline()
+        for url in expired:
+            pipe.zrem("leases", url)
+        pipe.hmget("lease_owners", expired)
+        pipe.hdel("lease_owners", *expired)
+        *removed, owners, _ = await pipe.execute()
+        # Only the worker that removed a lease requeues its url
+        reaped = [url for url, was_removed in zip(expired, removed) if was_removed]
+        if reaped:
+            await self.frontier.requeue(reaped)
+            lost_by = {owner.decode("utf-8") for owner in owners if owner}
+            logger.warning(
+                f"Requeued {len(reaped)} urls whose lease lapsed, held by {lost_by}"
+            )
+        return [url.decode("utf-8") for url in reaped]
+
+    async def live_workers(self, max_age: float = None) -> list[str]:
+        """Workers that have sent a heartbeat within max_age seconds"""
+        max_age = self.lease_timeout if max_age is None else max_age
+        workers = await self.rdb.zrangebyscore(
+            "heartbeats", time.time() - max_age, "+inf"
+        )
+        return [worker.decode("utf-8") for worker in workers]
+
+    async def record_memory(self) -> int | None:
+        """Samples the memory redis is using, keeping the run's high-water mark"""
+        try:
+            info = await self.rdb.info("memory")
+        except redis.ResponseError:
+            # Not every server implements INFO, e.g. fakeredis
+            return None
+        used = int(info["used_memory"])
+        await self.rdb.zadd("memory_peak", {self.run_id: used}, gt=True)
+        return used
+
+    async def memory_peak(self) -> int | None:
+        """Most memory redis was seen using during the run, in bytes"""
+        peak = await self.rdb.zscore("memory_peak", self.run_id)
+        return int(peak) if peak is not None else None
+
+    async def ack_download(self, url: str) -> None:
+        """Marks a url taken from the frontier as handled, whatever the outcome"""
+        await self.frontier.ack(url)
+
+    async def defer(self, url: str) -> None:
+        """
+        Puts a popped url back on the frontier, e.g. while its host is backing
+        off, for this or another worker to take once it's popped again
+        """
+        pipe = self.rdb.pipeline()
+        self.release_lease(pipe, url)
+        await pipe.execute()
+        await self.frontier.requeue([url.encode("utf-8")])
+        await self.frontier.ack(url)
+
+    async def request_download(self, url: str) -> bool:
         """Used to request that a page be downloaded"""
-        is_new = await self.rdb.sadd("download_requests", url)
-        if is_new:
-            await self.init_url_data(url)
-            is_new = await self.rdb.lpush("to_visit", url)
-        return bool(is_new)
+        return bool(await self.request_downloads([url]))
+
+    async def request_downloads(
+        self, urls: list[str], source_url: str = None, priorities: dict = None
+    ) -> list[str]:
+        """
+        Requests that a batch of pages (e.g. every link found on a page) be
+        downloaded. Urls are canonicalized, de-duplicated, initialized and
+        queued in a fixed number of round trips however many there are.
+        source_url is the page the urls were linked from, and priorities
+        holds any sitemap priorities, both used to order the frontier.
+        Returns the urls that were new.
+        """
+        urls = list(dict.fromkeys(canonicalize(url) for url in urls))
+        if not urls:
+            return []
+        priorities = {
+            canonicalize(url): priority for url, priority in (priorities or {}).items()
+        }
+        depth = 0
+        if source_url:
+            depth = await self.frontier.get_depth(canonicalize(source_url)) + 1
+        added = await self.download_seen.add_many(urls)
+        new_urls = [url for url, is_new in zip(urls, added) if is_new]
+        pipe = self.rdb.pipeline()
+        init_data = self.url_init_data()
+        for url in new_urls:
+            self.add_url_updates(pipe, url, init_data)
+            pipe.hincrby(url, "crawl_status")
+        if new_urls:
+            self.frontier.push(pipe, new_urls, depth, priorities)
+            pipe.sadd("in_flight", *new_urls)
+            pipe.incrby("outstanding", len(new_urls))
+        if source_url:
+            seen_urls = set(urls).difference(new_urls)
+            self.frontier.link(pipe, list(seen_urls))
+        await pipe.execute()
+        return new_urls
 
     async def request_parse(self, url: str) -> None:
         """Used to request that a page be parsed, and
         to ensure it has not already been parsed"""
-        is_new = await self.rdb.sadd("parse_requests", url)
+        is_new = await self.parse_seen.add(url)
         if is_new:
             await self.init_url_data(url)
         return bool(is_new)
 
+    def retry_delay(self, attempt: int) -> float:
+        """Capped exponential backoff, jittered so retries don't arrive in waves"""
+        capped = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        return capped / 2 + random.uniform(0, capped / 2)
+
+    async def schedule_retry(self, url: str) -> bool:
+        """
+        Queues a failed download for another attempt once its backoff has passed.
+        Returns False, leaving the url for the caller to close,
+        once its retries are exhausted.
+        """
+        attempt = await self.rdb.hincrby("retry_attempts", url, 1)
+        if attempt > self.retries:
+            return False
+        delay = self.retry_delay(attempt)
+        retry_at = time.time() + delay
+        pipe = self.rdb.pipeline()
+        pipe.zadd("retry_queue", {url: retry_at})
+        # Waiting on the retry queue, the url needn't be leased meanwhile
+        self.release_lease(pipe, url)
+        await pipe.execute()
+        self.next_retry_due = min(self.next_retry_due, retry_at)
+        logger.info(f"Retry {attempt}/{self.retries} of {url} in {delay:.1f}s")
+        return True
+
+    async def requeue_due_retries(self) -> list[str]:
+        """Moves retries whose backoff has passed back onto the frontier"""
+        due = await self.rdb.zrangebyscore("retry_queue", "-inf", time.time())
+        pipe = self.rdb.pipeline()
+        for url in due:
+            pipe.zrem("retry_queue", url)
+        pipe.zrange("retry_queue", 0, 0, withscores=True)
+        *removed, head = await pipe.execute()
+        self.next_retry_due = head[0][1] if head else float("inf")
+        # Only the worker that removed a url from the queue requeues it
+        claimed = [url for url, was_removed in zip(due, removed) if was_removed]
+        if claimed:
+            await self.frontier.requeue(claimed)
+        return [url.decode("utf-8") for url in claimed]
+
+    async def pending_retries(self) -> int:
+        return await self.rdb.zcard("retry_queue")
+
+    def retry_wait(self, default: float) -> float:
+        """Seconds until the next retry is due, capped at default"""
+        return max(0, min(default, self.next_retry_due - time.time()))
+
+    async def dead_letter(self, url: str, crawl_status: str, status_code: int = None):
+        """Records a url that could not be crawled"""
+        entry = {"url": url, "crawl_status": crawl_status, "status_code": status_code}
+        pipe = self.rdb.pipeline()
+        pipe.hget("retry_attempts", url)
+        pipe.hdel("retry_attempts", url)
+        attempts, _ = await pipe.execute()
+        entry["attempts"] = int(attempts or 0)
+        await self.rdb.rpush("dead_letter", json.dumps(entry))
+
+    async def snapshot(self) -> dict:
+        """
+        The crawl's unfinished urls, i.e. those queued, being crawled or
+        waiting to be retried, along w/ how many pages have been completed.
+        """
+        pipe = self.rdb.pipeline()
+        pipe.get("completed_pages")
+        pipe.zrange("leases", 0, -1)
+        pipe.zrange("retry_queue", 0, -1)
+        completed_pages, in_flight, retries = await pipe.execute()
+        queued = await self.frontier.queued()
+        unfinished = queued + [url.decode("utf-8") for url in [*in_flight, *retries]]
+        return {
+            "run_id": self.run_id,
+            "seed_url": self.seed_url,
+            "completed_pages": int(completed_pages or 0),
+            "queued": list(dict.fromkeys(unfinished)),
+        }
+
+    async def restore(
+        self, done_urls: list[str], queued_urls: list[str], completed_pages: int = 0
+    ) -> list[str]:
+        """
+        Rebuilds the state of an interrupted crawl. Urls already done are
+        marked as seen, so they aren't downloaded again, and the rest are
+        queued. Returns the urls queued.
+        """
+        done = list(dict.fromkeys(canonicalize(url) for url in done_urls))
+        done_set = set(done)
+        queued = [
+            url
+            for url in dict.fromkeys(canonicalize(url) for url in queued_urls)
+            if url not in done_set
+        ]
+        if done or queued:
+            await self.download_seen.add_many(done + queued)
+        if done:
+            await self.parse_seen.add_many(done)
+        pipe = self.rdb.pipeline()
+        init_data = self.url_init_data()
+        for url in queued:
+            self.add_url_updates(pipe, url, init_data)
+            pipe.hincrby(url, "crawl_status")
+        pipe.delete("in_flight")
+        if queued:
+            self.frontier.push(pipe, queued)
+            pipe.sadd("in_flight", *queued)
+        pipe.set("outstanding", len(queued))
+        pipe.set("completed_pages", max(completed_pages, len(done)))
+        await pipe.execute()
+        logger.info(f"Restored crawl w/ {len(done)} urls done, {len(queued)} queued")
+        return queued
+
+    async def seen_stats(self) -> dict:
+        """Memory used by the record of requested urls"""
+        return {
+            "download_requests": await self.download_seen.stats(),
+            "parse_requests": await self.parse_seen.stats(),
+        }
+
     async def get_cached_response(self, url: str):
         """Retrieve URL data from cache"""
         key = f"urls:{url}"
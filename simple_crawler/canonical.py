@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import re
+import string
+from functools import lru_cache
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from config.configuration import (CANONICAL_CACHE_SIZE, DROP_TRACKING_PARAMS,
+                                  SORT_QUERY_PARAMS)
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+# Query parameters that only identify where a visitor came from
+TRACKING_PARAMS = {"gclid", "fbclid", "msclkid", "yclid", "mc_cid", "mc_eid", "_ga"}
+TRACKING_PREFIXES = ("utm_",)
+
+UNRESERVED = set(string.ascii_letters + string.digits + "-._~")
+ESCAPE = re.compile(r"%([0-9A-Fa-f]{2})")
+# Characters left as is in each part, beyond the unreserved ones
+PATH_SAFE = "/:@!$&'()*+,;=%"
+QUERY_SAFE = "/?:@!$'()*+,;=%"
+
+
+def normalize_escapes(part: str, safe: str) -> str:
+    """
+    Decodes percent-escapes of unreserved characters, upper-cases
+    the remaining escapes and escapes anything that should have been.
+    """
+
+    def fix(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in UNRESERVED else f"%{match.group(1).upper()}"
+
+    return quote(ESCAPE.sub(fix, part), safe=safe)
+
+
+def is_tracking_param(pair: str) -> bool:
+    name = pair.split("=", 1)[0].lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonicalize(
+    url: str,
+    sort_query: bool = SORT_QUERY_PARAMS,
+    drop_tracking: bool = DROP_TRACKING_PARAMS,
+) -> str:
+    """
+    Returns the canonical form of a url, so that equivalent urls are only
+    crawled once. Lower-cases the scheme and host, strips default ports and
+    fragments, and normalizes percent-encoding. Optionally sorts query
+    parameters and drops tracking parameters (utm_*, gclid, ...).
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+
+    netloc = parts.netloc
+    if netloc:
+        userinfo, at, hostport = netloc.rpartition("@")
+        host, port = hostport, ""
+        # Bracketed IPv6 hosts contain colons of their own
+        if ":" in hostport and not hostport.endswith("]"):
+            host, _, port = hostport.rpartition(":")
+        netloc = f"{userinfo}{at}{host.lower()}"
+        if port and port != DEFAULT_PORTS.get(scheme):
+            netloc = f"{netloc}:{port}"
+
+    path = normalize_escapes(parts.path, PATH_SAFE)
+    if netloc and not path:
+        path = "/"
+
+    pairs = [
+        normalize_escapes(pair, QUERY_SAFE + "&")
+        for pair in parts.query.split("&")
+        if pair
+    ]
+    if drop_tracking:
+        pairs = [pair for pair in pairs if not is_tracking_param(pair)]
+    if sort_query:
+        pairs.sort()
+    return urlunsplit((scheme, netloc, path, "&".join(pairs), ""))
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def get_host(url: str) -> str:
+    """Memoized lookup of a url's (lower-cased) host and port"""
+    return urlsplit(url).netloc.lower()
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+
+from cache import CrawlTracker
+from config.configuration import CHECKPOINT_EVERY, get_logger
+
+logger = get_logger("data")
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+class Checkpointer:
+    """
+    Periodically writes a snapshot of a crawl's unfinished urls to its data
+    directory. Together w/ the urls already in the run's database, it lets
+    an interrupted crawl be resumed where it left off.
+    """
+
+    def __init__(
+        self, tracker: CrawlTracker, data_dir: str, every: float = CHECKPOINT_EVERY
+    ):
+        self.tracker = tracker
+        self.path = os.path.join(data_dir, CHECKPOINT_FILE)
+        self.every = every
+
+    async def save(self) -> dict:
+        snapshot = await self.tracker.snapshot()
+        # Written aside and then swapped in, so a crash mid-write
+        # leaves the previous checkpoint intact
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.debug(f"Checkpoint w/ {len(snapshot['queued'])} urls queued")
+        return snapshot
+
+    def load(self) -> dict | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    async def run(self, done: asyncio.Event):
+        """Saves a checkpoint every so often until done is set"""
+        if self.every <= 0:
+            return
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), self.every)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Unable to save checkpoint: {e}")
@@ -2,27 +2,97 @@ from __future__ import annotations
 
 import argparse
 
-from config.configuration import CHECK_EVERY, MAX_PAGES, RETRIES, get_logger
+from config.configuration import (DEFAULT_CRAWL_DELAY, DOWNLOAD_WORKERS,
+                                  MAX_CONNECTIONS, MAX_PAGES, PARSE_ENGINE,
+                                  PARSE_PROCESSES, PARSE_WORKERS, PROCESSES,
+                                  RETRIES, get_logger)
+from extractors import EXTRACTORS
 from main import crawl
 
 logger = get_logger("main")
 logger.info("Starting crawler")
 parser = argparse.ArgumentParser(description="Basic Web Crawler")
-parser.add_argument("url", help="Starting URL to crawl")
+parser.add_argument(
+    "url", nargs="?", help="Starting URL to crawl, optional w/ --resume"
+)
 parser.add_argument(
     "--max-pages", type=int, default=MAX_PAGES, help="Maximum number of pages to crawl"
 )
 parser.add_argument(
-    "--retries", type=int, default=RETRIES, help="Delay between requests in seconds"
+    "--retries",
+    type=int,
+    default=RETRIES,
+    help="Number of times a failed download is retried",
 )
 parser.add_argument(
-    "--check_every",
+    "--max-connections",
+    type=int,
+    default=MAX_CONNECTIONS,
+    help="Maximum number of requests in flight at once",
+)
+parser.add_argument(
+    "--delay",
     type=float,
-    default=CHECK_EVERY,
-    help="Delay between checks in seconds",
+    default=DEFAULT_CRAWL_DELAY,
+    help="Delay between requests to the same host, unless robots.txt sets one",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=PROCESSES,
+    help="Number of crawler processes, sharing the frontier through redis",
+)
+parser.add_argument(
+    "--download-workers",
+    type=int,
+    default=DOWNLOAD_WORKERS,
+    help="Number of concurrent download workers",
+)
+parser.add_argument(
+    "--parse-workers",
+    type=int,
+    default=PARSE_WORKERS,
+    help="Number of concurrent parse workers",
+)
+parser.add_argument(
+    "--parse-processes",
+    type=int,
+    default=PARSE_PROCESSES,
+    help="Size of the process pool used for link extraction (0 to parse in-loop)",
+)
+parser.add_argument(
+    "--parse-engine",
+    choices=list(EXTRACTORS),
+    default=PARSE_ENGINE,
+    help="Link extractor used by the parser",
+)
+parser.add_argument(
+    "--resume",
+    metavar="RUN_ID",
+    help="Resume an interrupted crawl from its database and last checkpoint",
+)
+parser.add_argument(
+    "--join",
+    action="store_true",
+    help="Add workers to the crawl already running against the same redis",
 )
 args = parser.parse_args()
-links = crawl(args.url, args.max_pages, args.retries, args.check_every)
+if args.url is None and args.resume is None and not args.join:
+    parser.error("a url is required unless resuming or joining a crawl")
+links = crawl(
+    args.url,
+    args.max_pages,
+    args.retries,
+    max_connections=args.max_connections,
+    delay=args.delay,
+    download_workers=args.download_workers,
+    parse_workers=args.parse_workers,
+    parse_processes=args.parse_processes,
+    parse_engine=args.parse_engine,
+    resume=args.resume,
+    processes=args.processes,
+    join=args.join,
+)
 for link in links:
     logger.info(link)
 logger.info(f"Crawled {len(links)} pages")
@@ -21,14 +21,112 @@ sqlite_config = os.environ.get(
 
 REDIS_PORT = os.environ.get("REDIS_PORT", 7777)
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+# Where crawl state is kept, redis or local (in-process, for single node runs)
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "redis")
+# Most page content the local backend holds, the oldest is dropped past this
+LOCAL_CONTENT_BYTES = int(os.environ.get("LOCAL_CONTENT_BYTES", 256 * 1024 * 1024))
 SQLITE_DB_FILE = os.environ.get("SQLITE_DB_FILE", "sqlite.db")
+# Milliseconds a write waits on a locked database, and queries kept compiled
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+SQLITE_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", 256))
+# Rows are written in batches of up to this many rows or bytes, or once the
+# oldest has waited this many seconds. Batches grow while commits are quicker
+# than the target latency (in seconds) and shrink when slower
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 100))
+WRITE_MAX_BATCH_SIZE = int(os.environ.get("WRITE_MAX_BATCH_SIZE", 5000))
+WRITE_BATCH_BYTES = int(os.environ.get("WRITE_BATCH_BYTES", 8 * 1024 * 1024))
+WRITE_BATCH_AGE = float(os.environ.get("WRITE_BATCH_AGE", 2.0))
+WRITE_TARGET_LATENCY = float(os.environ.get("WRITE_TARGET_LATENCY", 0.25))
+# zlib level page content is stored at, 1 (fastest) to 9 (smallest)
+CONTENT_COMPRESSION_LEVEL = int(os.environ.get("CONTENT_COMPRESSION_LEVEL", 6))
 RDB_FILE = os.environ.get("RDB_FILE", "data.rdb")
 DATA_DIR = os.environ.get("DATA_DIR", "data")
 
 MAX_PAGES = os.environ.get("MAX_PAGES", 10)
 RETRIES = os.environ.get("RETRIES", 3)
 WRITE_TO_DB = os.environ.get("WRITE_TO_DB", True)
-CHECK_EVERY = os.environ.get("CHECK_EVERY", 0.5)
+# Longest a worker blocks on an empty frontier before re-checking its state
+FRONTIER_BLOCK_TIMEOUT = float(os.environ.get("FRONTIER_BLOCK_TIMEOUT", 5.0))
+# Crawler processes sharing the redis frontier, each w/ its own workers
+PROCESSES = int(os.environ.get("PROCESSES", 1))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 16))
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 2))
+# Processes used for link extraction, 0 parses on the event loop
+PARSE_PROCESSES = int(os.environ.get("PARSE_PROCESSES", 0))
+# Link extractor used by the parser, one of bs4, lxml or stream
+PARSE_ENGINE = os.environ.get("PARSE_ENGINE", "bs4")
+
+# Url canonicalization
+SORT_QUERY_PARAMS = os.environ.get("SORT_QUERY_PARAMS", "True") == "True"
+DROP_TRACKING_PARAMS = os.environ.get("DROP_TRACKING_PARAMS", "True") == "True"
+CANONICAL_CACHE_SIZE = int(os.environ.get("CANONICAL_CACHE_SIZE", 100_000))
+
+# Record of urls already requested, one of set, hash (64-bit) or bloom
+SEEN_BACKEND = os.environ.get("SEEN_BACKEND", "set")
+BLOOM_ERROR_RATE = float(os.environ.get("BLOOM_ERROR_RATE", 0.001))
+BLOOM_INITIAL_CAPACITY = int(os.environ.get("BLOOM_INITIAL_CAPACITY", 1_000_000))
+BLOOM_GROWTH = int(os.environ.get("BLOOM_GROWTH", 2))
+
+# Order urls are visited in, list (last in, first out), priority or host
+# (a queue per host, taken from whichever host may be requested next)
+FRONTIER = os.environ.get("FRONTIER", "list")
+# Priority frontier scores, weighing sitemap priority, depth and in-degree
+PRIORITY_WEIGHT = float(os.environ.get("PRIORITY_WEIGHT", 10.0))
+DEPTH_WEIGHT = float(os.environ.get("DEPTH_WEIGHT", 1.0))
+LINK_WEIGHT = float(os.environ.get("LINK_WEIGHT", 0.1))
+# Sitemap priorities move by up to half this for pages that change often or
+# recently (or rarely), w/ lastmod's weight halving every half-life in days
+FRESHNESS_WEIGHT = float(os.environ.get("FRESHNESS_WEIGHT", 0.5))
+LASTMOD_HALF_LIFE = float(os.environ.get("LASTMOD_HALF_LIFE", 30.0))
+
+# How work moves between the download, parse and persist stages, either
+# pubsub (in-process queues and redis pubsub) or streams (redis streams w/
+# consumer groups, so several processes can share each stage)
+TRANSPORT = os.environ.get("TRANSPORT", "pubsub")
+STREAM_GROUP = os.environ.get("STREAM_GROUP", "crawlers")
+# Seconds a message may stay unacknowledged before another consumer takes it
+STREAM_CLAIM_IDLE = float(os.environ.get("STREAM_CLAIM_IDLE", 60.0))
+
+# Seconds between snapshots of the frontier, used to resume a crawl (0 disables)
+CHECKPOINT_EVERY = float(os.environ.get("CHECKPOINT_EVERY", 30.0))
+
+# Seconds a popped url stays leased to a worker w/o a heartbeat renewing it,
+# after which it's put back on the frontier for another worker
+LEASE_TIMEOUT = float(os.environ.get("LEASE_TIMEOUT", 120.0))
+HEARTBEAT_EVERY = float(os.environ.get("HEARTBEAT_EVERY", 15.0))
+
+# Once a url's row is committed to sqlite its keys in redis are removed, or
+# left to expire after this many seconds, bounding redis' memory (-1 keeps them)
+PERSISTED_KEY_TTL = int(os.environ.get("PERSISTED_KEY_TTL", 0))
+
+# Failed downloads are retried after a capped exponential backoff (w/ jitter)
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 300.0))
+
+# HTTP engine
+USER_AGENT = os.environ.get("USER_AGENT", "simple-crawler")
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 200))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("MAX_CONNECTIONS_PER_HOST", 8))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 10))
+
+# robots.txt rules are cached for a day, as suggested by RFC 9309.
+# The stored copies live in their own redis db so flushing crawl state keeps them
+ROBOTS_TTL = int(os.environ.get("ROBOTS_TTL", 86400))
+# Hosts whose robots.txt can't be reached are disallowed for this long, then retried
+ROBOTS_ERROR_TTL = int(os.environ.get("ROBOTS_ERROR_TTL", 600))
+ROBOTS_REDIS_DB = int(os.environ.get("ROBOTS_REDIS_DB", 1))
+
+# Per-host politeness, used when robots.txt doesn't specify a delay
+DEFAULT_CRAWL_DELAY = float(os.environ.get("DEFAULT_CRAWL_DELAY", 1.0))
+MAX_CRAWL_DELAY = float(os.environ.get("MAX_CRAWL_DELAY", 30.0))
+
+# Adaptive per-host concurrency (additive increase, multiplicative decrease)
+AIMD_INITIAL_LIMIT = float(os.environ.get("AIMD_INITIAL_LIMIT", 2))
+AIMD_INCREASE = float(os.environ.get("AIMD_INCREASE", 1.0))
+AIMD_DECREASE = float(os.environ.get("AIMD_DECREASE", 0.5))
+LATENCY_TOLERANCE = float(os.environ.get("LATENCY_TOLERANCE", 4.0))
+DEFAULT_BACKOFF = float(os.environ.get("DEFAULT_BACKOFF", 10.0))
+MAX_BACKOFF = float(os.environ.get("MAX_BACKOFF", 300.0))
 
 
 def _load_console_log():
@@ -94,8 +192,9 @@ def _get_table_details():
                 "table_name": table_name,
                 "columns": columns,
                 "types": types,
-                "primary_key": primary_key,
+                "primary_key": primary_key[0] if primary_key else "id",
                 "unique_keys": unique_keys,
+                "indexes": table_data.get("indexes", {}),
             }
         )
     return table_details
@@ -1,119 +1,377 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import json
+import os
 import sqlite3
+import time
+import zlib
 from collections import defaultdict
 
 import aiosqlite
-from config.configuration import _get_table_details, get_logger
+from config.configuration import (CONTENT_COMPRESSION_LEVEL,
+                                  FRONTIER_BLOCK_TIMEOUT, PERSISTED_KEY_TTL,
+                                  SQLITE_BUSY_TIMEOUT,
+                                  SQLITE_CACHED_STATEMENTS, TRANSPORT,
+                                  WRITE_BATCH_AGE, WRITE_BATCH_BYTES,
+                                  WRITE_BATCH_SIZE, WRITE_MAX_BATCH_SIZE,
+                                  WRITE_TARGET_LATENCY, _get_table_details,
+                                  get_logger)
 from redis import asyncio as redis
+from streams import StreamQueue
 from utils import deserialize
 
 logger = get_logger("data")
 
 STOPWORD = b"exit"
 RUNS_TABLE = "runs"
+LINKS_TABLE = "links"
+URL_IDS_TABLE = "url_ids"
+CONTENTS_TABLE = "contents"
+# Rows written along w/ the url they came from, not counted towards batches
+DERIVED_TABLES = {LINKS_TABLE, CONTENTS_TABLE}
+
+
+def decode_links(linked_urls) -> list[str]:
+    """Reads a linked_urls column, stored as a json list"""
+    try:
+        links = json.loads(linked_urls or "[]")
+    except (TypeError, ValueError):
+        return []
+    return links if isinstance(links, list) else []
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=32).hexdigest()
+
+
+def row_size(row: dict) -> int:
+    """Rough count of the bytes a row holds, mostly its page content"""
+    return sum(
+        len(value) if isinstance(value, (str, bytes)) else 8 for value in row.values()
+    )
 
 
 class BulkDBWriter:
-    def __init__(self, tables: dict[str, BaseTable], redis_conn, batch_size=4):
+    """
+    Buffers rows for the db and writes them in batches. A batch is written
+    once it holds batch_size rows or max_bytes of data, or its oldest row
+    has waited max_age seconds, whichever comes first. The batch size
+    follows how long commits take, doubled while they're well within
+    target_latency and halved once they take longer.
+    """
+
+    def __init__(
+        self,
+        tables: dict[str, BaseTable],
+        redis_conn,
+        batch_size=WRITE_BATCH_SIZE,
+        key_ttl: int = PERSISTED_KEY_TTL,
+        max_batch_size: int = WRITE_MAX_BATCH_SIZE,
+        max_bytes: int = WRITE_BATCH_BYTES,
+        max_age: float = WRITE_BATCH_AGE,
+        target_latency: float = WRITE_TARGET_LATENCY,
+    ):
         self.tables = tables
         self.redis_conn = redis_conn
         self.batch_size = batch_size
+        self.max_batch_size = max(batch_size, max_batch_size)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.target_latency = target_latency
+        self.key_ttl = key_ttl
         self.to_write = defaultdict(list)
+        # Redis keys the rows waiting to be written were read from
+        self.to_clean = defaultdict(list)
+        self.buffered_bytes = 0
+        # When the oldest row waiting to be written was buffered
+        self.oldest = None
+        # The batch being written while more messages are read
+        self.flushing = None
         self.running = True
+        # Set on shutdown, the writer stops once nothing is left to read
+        self.stopping = False
 
     async def store_data(self, table_name: str, data: dict = None, key: str = None) -> None:
         """Store URL data in database"""
         if key is not None:
             data = await self.process_key(key)
+            if data is None:
+                logger.debug(f"No data left in redis for {key}, already written")
+                return
+            self.to_clean[table_name].append(key)
         self.to_write[table_name].append(data)
-        print(f"Currently {len(self.to_write[table_name])} rows to write")
-        if len(self.to_write[table_name]) > self.batch_size:
-            await self.flush_data(table_name)
-            self.to_write[table_name] = []
+        self.buffered_bytes += row_size(data)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
 
-    async def flush_data(self, table_name):
-        """Builds and insert query and executes it"""
+    def buffered_rows(self) -> int:
+        return sum(
+            len(data)
+            for table_name, data in self.to_write.items()
+            if table_name not in DERIVED_TABLES
+        )
+
+    def flush_due(self) -> bool:
+        rows = self.buffered_rows()
+        if rows == 0:
+            return False
+        return (
+            rows >= self.batch_size
+            or self.buffered_bytes >= self.max_bytes
+            or time.monotonic() - self.oldest >= self.max_age
+        )
+
+    def adapt_batch_size(self, rows: int, latency: float) -> None:
+        if latency > self.target_latency:
+            self.batch_size = max(1, self.batch_size // 2)
+            logger.debug(f"Commit took {latency:.3f}s, batches of {self.batch_size}")
+        elif rows >= self.batch_size and latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+
+    async def flush_data(self, table_name) -> bool:
+        """
+        Builds and insert query and executes it.
+        Returns whether every row taken off the buffers was written.
+        """
         if table_name == "all":
-            tables = self.to_write.items()
+            table_names = list(self.to_write)
+            self.buffered_bytes = 0
+            self.oldest = None
         else:
-            tables = [(table_name, self.to_write[table_name])]
-        print("Flushing data...")
+            table_names = [table_name]
+        # Taken off the buffers up front, so rows can be buffered meanwhile
+        batches = []
+        for table_name in table_names:
+            keys = self.to_clean.pop(table_name, [])
+            batches.append((table_name, self.to_write[table_name], keys))
+            self.to_write[table_name] = []
 
-        for table_name, data in tables:
+        written = True
+        rows = 0
+        started = time.monotonic()
+        for table_name, data, _ in batches:
+            if not data:
+                continue
             table = self.tables[table_name]
-            result = await table.db_operation(data=data, operation="insert")
-            self.to_write[table_name] = []
-            return result
-    
-    async def process_key(self, key: str):
+            result = await table.db_operation(data=data, operation="upsert")
+            written = written and bool(result)
+            if table_name not in DERIVED_TABLES:
+                rows += len(data)
+        if rows:
+            self.adapt_batch_size(rows, time.monotonic() - started)
+        # Only once a url's row and its links are all written
+        keys = [key for _, _, table_keys in batches for key in table_keys]
+        if written:
+            await self.clean_keys(keys)
+        elif keys:
+            logger.warning(f"Kept {len(keys)} urls in redis, rows not written")
+        return written
+
+    async def flush_in_background(self) -> None:
+        """
+        Writes the buffered rows while the next batch is read. Only one
+        batch is written at a time, so while sqlite is behind reading waits
+        and messages are held back in redis, rather than buffered here.
+        """
+        await self.wait_flushed()
+        self.flushing = asyncio.create_task(self.flush_data("all"))
+
+    async def wait_flushed(self) -> None:
+        if self.flushing is not None:
+            await self.flushing
+            self.flushing = None
+
+    async def process_key(self, key: str) -> dict | None:
+        """Reads a url's row from its keys in redis"""
         pipe = self.redis_conn.pipeline()
         pipe.lrange(f"{key}:linked_urls", 0, -1)
         pipe.hgetall(f"{key}:attrs")
         pipe.get(f"{key}:content")
-        pipe.delete(key)
-        linked_urls, attrs, content, _ = await pipe.execute()
-        url_data = await deserialize(attrs) # is this needed?
-        url_data['linked_urls'] = [url.decode("utf-8") for url in linked_urls]
-        url_data['content'] = content.decode("utf-8")
+        linked_urls, attrs, content = await pipe.execute()
+        if not attrs:
+            return None
+        url_data = await deserialize(attrs)
+        url = url_data["url"] = key.removeprefix("urls:")
+        links = [url.decode("utf-8") for url in linked_urls]
+        url_data["linked_urls"] = json.dumps(links)
+        if LINKS_TABLE in self.tables:
+            # Also written as edges of the link graph, w/ the url's row
+            run_id = url_data.get("run_id")
+            self.to_write[LINKS_TABLE].extend(
+                {"run_id": run_id, "src": url, "dst": link} for link in links
+            )
+        if CONTENTS_TABLE in self.tables and content:
+            # Stored once per distinct page body, the row keeps its hash
+            content_hash = hash_content(content)
+            self.to_write[CONTENTS_TABLE].append(
+                {"hash": content_hash, "body": content}
+            )
+            self.buffered_bytes += len(content)
+            url_data["content_hash"] = content_hash
+        else:
+            url_data["content"] = content.decode("utf-8") if content else None
         return url_data
 
+    async def clean_keys(self, keys: list[str]) -> None:
+        """
+        Removes, or sets to expire, the redis keys of urls whose rows have
+        been committed, so redis only holds pages still being crawled
+        """
+        if not keys or self.key_ttl < 0:
+            return
+        # A url's fields, and the status counter kept under the url itself
+        url_keys = [
+            url_key
+            for key in keys
+            for url_key in (
+                f"{key}:attrs",
+                f"{key}:linked_urls",
+                f"{key}:content",
+                key.removeprefix("urls:"),
+            )
+        ]
+        pipe = self.redis_conn.pipeline()
+        if self.key_ttl == 0:
+            pipe.delete(*url_keys)
+        else:
+            for url_key in url_keys:
+                pipe.expire(url_key, self.key_ttl)
+        await pipe.execute()
+
+    def stop(self) -> None:
+        self.stopping = True
+
     async def handle_message(self, channel: redis.client.PubSub):
         while self.running:
-            message = await channel.get_message(ignore_subscribe_messages=True)
+            message = await channel.get_message(
+                ignore_subscribe_messages=True, timeout=self.max_age
+            )
             logger.debug(f"Received message: {message}")
             if message is not None:
                 if message["data"] == STOPWORD:
+                    await self.wait_flushed()
                     await self.flush_data("all")
                     self.running = False
                     break
                 kwargs = json.loads(message.get("data", b'{}'))
                 await self.store_data(**kwargs)
+            if self.flush_due():
+                await self.flush_in_background()
+
+    async def handle_stream(self, queue: StreamQueue):
+        """
+        Reads messages from a stream in batches. Messages are only
+        acknowledged once their rows have been written, so rows from a
+        writer that dies mid-batch, or whose write fails (e.g. the db is
+        locked by another writer), are written by the next one to claim
+        them. Unread messages wait in the stream while sqlite is behind.
+        """
+        unacked = []
+        while self.running:
+            timeout = min(FRONTIER_BLOCK_TIMEOUT, self.max_age)
+            entries = await queue.get(self.batch_size, timeout)
+            if not entries and self.stopping:
+                self.running = False
+            for entry_id, message in entries:
+                unacked.append(entry_id)
+                if message == STOPWORD.decode("utf-8"):
+                    # The rest of the batch has been read too, so is written
+                    # and acknowledged along w/ it, not left pending
+                    self.running = False
+                    continue
+                await self.store_data(**json.loads(message))
+            if self.flush_due() or not self.running:
+                if await self.flush_data("all"):
+                    await queue.ack(*unacked)
+                else:
+                    logger.warning(f"Left {len(unacked)} messages pending to retry")
+                unacked = []
 
 
 class DatabaseManager:
-    def __init__(self, redis_conn, db_file="data/db.sqlite"):
+    def __init__(self, redis_conn, db_file="data/db.sqlite", transport=TRANSPORT):
         self.db_file = db_file
         self.redis_conn = redis_conn
+        self.transport = transport
         self.tables = {}
-        self._init_db()
+        self.listeners = []
+        self.futures = []
 
     async def _init_db(self):
         # Initialize databases
         self.table_details = _get_table_details()
         await self.create_tables()
-        missing_tables = set(self.tables.keys()) - {"runs", "urls", "sitemaps"}
+        expected_tables = {"runs", "urls", "sitemaps", URL_IDS_TABLE, *DERIVED_TABLES}
+        missing_tables = expected_tables - set(self.tables.keys())
         if missing_tables:
             raise Exception(f"Missing tables: {missing_tables}")
-        self.listeners = []
-        self.futures = []
+
+    async def start(self):
+        """
+        Creates the tables and starts the db writer. Messages published
+        before the writer has subscribed are lost, so this comes first.
+        """
+        await self._init_db()
         await self.add_listener(BulkDBWriter, (self.tables, self.redis_conn))
 
+    async def wait_for_writer(self, interval: float = 0.1):
+        """Waits for a writer in another process to subscribe"""
+        logger.info("Waiting for the db writer to subscribe")
+        while True:
+            [(_, subscribers)] = await self.redis_conn.pubsub_numsub("writer")
+            if subscribers:
+                return
+            await asyncio.sleep(interval)
+
     async def shutdown(self):
         """Shutdown the database manager"""
         logger.info("Shutting down database manager")
-        try:
-            await self.redis_conn.publish("writer", STOPWORD)
-        except Exception as e:
-            logger.info(f"Unable to publish stop message to DB writer: {e}")
+        if self.transport == "streams":
+            # Each stream message goes to a single writer, so the stop can't be
+            # sent that way. Writers stop once they've read all there is.
+            for writer in self.listeners:
+                writer.stop()
+        elif self.listeners:
+            try:
+                await self.publish(STOPWORD.decode("utf-8"))
+            except Exception as e:
+                logger.info(f"Unable to publish stop message to DB writer: {e}")
         await asyncio.gather(*self.futures)
+        await SQLiteConnection.close_all()
 
     async def add_listener(self, listener_cls, args=()):
-        pubsub = self.redis_conn.pubsub()
-        await pubsub.subscribe("writer")
         writer = listener_cls(*args)
-        future = asyncio.create_task(writer.handle_message(pubsub))
+        if self.transport == "streams":
+            # Writers in every process share the stream's consumer group
+            queue = StreamQueue(self.redis_conn, "stream:persist")
+            future = asyncio.create_task(writer.handle_stream(queue))
+        else:
+            pubsub = self.redis_conn.pubsub()
+            await pubsub.subscribe("writer")
+            future = asyncio.create_task(writer.handle_message(pubsub))
         self.listeners.append(writer)
         self.futures.append(future)
 
     async def create_tables(self):
         for details in self.table_details:
-            table = BaseTable(**details)
+            table_cls = TABLE_CLASSES.get(details["table_name"], BaseTable)
+            # Every table lives in the run's db, which resumes read from
+            table = table_cls(**{**details, "db_file": self.db_file})
             await table.db_operation(operation="create")
+            await table.migrate()
+            for query in table.build_index_strings():
+                await table.execute_query(query)
             self.tables[table.table_name] = table
 
+    async def publish(self, message: str):
+        """Passes a message on to the db writer"""
+        if self.transport == "streams":
+            await StreamQueue(self.redis_conn, "stream:persist").put(message)
+        else:
+            await self.redis_conn.publish("writer", message)
+
     async def start_run(self, run_id: str, seed_url: str, max_pages: int) -> int:
         """Start a new crawl run"""
         data = {
@@ -122,11 +380,44 @@ class DatabaseManager:
             "max_pages": max_pages,
             "event": "start_run",
         }
-        await self.redis_conn.publish(
-            "writer", json.dumps({"table_name": RUNS_TABLE, "data": data})
-        )
+        await self.publish(json.dumps({"table_name": RUNS_TABLE, "data": data}))
+
+    async def crawled_urls(self, run_id: str) -> dict[str, list[str]]:
+        """
+        Urls already written for a run, each w/ the links found on it,
+        used to resume an interrupted crawl
+        """
+        query = "SELECT url, linked_urls FROM urls WHERE run_id = ?"
+        try:
+            async with aiosqlite.connect(self.db_file) as db:
+                rows = await (await db.execute(query, (run_id,))).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Unable to read crawled urls for run {run_id}: {e}")
+            return {}
+        return {url: decode_links(linked_urls) for url, linked_urls in rows}
+
+    async def page_content(self, url: str, run_id: str) -> str | None:
+        """A page's content as written during a run"""
+        query = f"""SELECT {CONTENTS_TABLE}.body FROM urls
+              JOIN {CONTENTS_TABLE} ON {CONTENTS_TABLE}.hash = urls.content_hash
+              WHERE urls.url = ? AND urls.run_id = ?"""
+        async with aiosqlite.connect(self.db_file) as db:
+            row = await (await db.execute(query, (url, run_id))).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row else None
 
-    async def complete_run(self, run_id: str, seed_url: str, max_pages: int):
+    async def links_to(self, url: str, run_id: str) -> list[str]:
+        """Urls found linking to a url during a run"""
+        query = f"""SELECT src.url FROM {URL_IDS_TABLE} AS dst
+              JOIN {LINKS_TABLE} ON {LINKS_TABLE}.dst_id = dst.id
+              JOIN {URL_IDS_TABLE} AS src ON src.id = {LINKS_TABLE}.src_id
+              WHERE dst.url = ? AND {LINKS_TABLE}.run_id = ?"""
+        async with aiosqlite.connect(self.db_file) as db:
+            rows = await (await db.execute(query, (url, run_id))).fetchall()
+        return [src_url for src_url, in rows]
+
+    async def complete_run(
+        self, run_id: str, seed_url: str, max_pages: int, memory_peak: int = None
+    ):
         """Mark a run as completed and set end time"""
         data = {
             "run_id": run_id,
@@ -134,10 +425,10 @@ class DatabaseManager:
             "max_pages": max_pages,
             "event": "complete_run",
         }
+        if memory_peak is not None:
+            data["redis_memory_peak"] = memory_peak
         logger.info(f"Completing run {run_id}")
-        await self.redis_conn.publish(
-            "writer", json.dumps({"table_name": RUNS_TABLE, "data": data})
-        )
+        await self.publish(json.dumps({"table_name": RUNS_TABLE, "data": data}))
 
 
 class BaseTable:
@@ -149,6 +440,7 @@ class BaseTable:
         types: list[str] = ["INTEGER", "INTEGER", "TEXT", "TEXT"],
         primary_key: str = "id",
         unique_keys: list[str] = ["id"],
+        indexes: dict[str, list[str]] = None,
     ):
         self.db_file = db_file
         self.table_name = table_name
@@ -156,19 +448,24 @@ class BaseTable:
         self.types = types
         self.primary_key = primary_key
         self.unique_keys = unique_keys
+        self.indexes = indexes or {}
         self.string_functions = {
             "insert": self.build_insert_string,
+            "upsert": self.build_upsert_string,
             "update": self.build_update_string,
             "create": self.build_create_string,
         }
 
+    @property
+    def conflict_keys(self) -> list[str]:
+        """Columns that identify a row, e.g. a url within a run"""
+        return self.unique_keys or [self.primary_key]
+
     async def build_create_string(self, *args):
         """Build a create string for a table"""
         cols_to_types = dict(zip(self.columns, self.types))
 
-        if len(self.unique_keys) == 0:
-            self.unique_keys = [self.primary_key]
-        unique_cols = ", ".join(self.unique_keys)
+        unique_cols = ", ".join(self.conflict_keys)
         cols_w_types = [f"{col} {ctype}" for col, ctype in cols_to_types.items()]
         create_cols_string = ", ".join(cols_w_types)
         create_string = f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
@@ -178,9 +475,31 @@ class BaseTable:
                                 )"""
         return create_string, ()
 
+    def build_index_strings(self) -> list[str]:
+        return [
+            f"CREATE INDEX IF NOT EXISTS {name} ON {self.table_name} "
+            f"({', '.join(columns)})"
+            for name, columns in self.indexes.items()
+        ]
+
+    def row_columns(self, row: dict) -> list[str]:
+        # Rows read from redis also carry fields only used while crawling
+        return [k for k in row if k in self.columns and k not in ["id"]]
+
+    def group_rows(self, data: list[dict]) -> list[list[dict]]:
+        """
+        Splits a batch by the columns its rows provide, e.g. a run's start
+        and its completion, so each row only sets the columns it has
+        """
+        groups = defaultdict(list)
+        for row in data:
+            groups[frozenset(self.row_columns(row))].append(row)
+        return list(groups.values())
+
     async def build_insert_string(self, data: list[dict]):
-        columns = [k for k, v in data[0].items() if k not in ["id"]]
-        params = [tuple(row.get(col, "") for col in columns) for row in data]
+        """Builds an insert for rows that all provide the same columns"""
+        columns = self.row_columns(data[0])
+        params = [tuple(row[col] for col in columns) for row in data]
         placeholders = ",".join(["?" for _ in columns])
         select_list = ",".join(columns)
         insert_query = (
@@ -188,36 +507,242 @@ class BaseTable:
         )
         return insert_query, params
 
+    async def build_upsert_string(self, data: list[dict]):
+        """
+        An insert that updates rows already in the table instead, e.g. urls
+        crawled again or written again by a resumed run. Columns the rows
+        don't provide keep their stored values.
+        """
+        insert_query, params = await self.build_insert_string(data)
+        keys = self.conflict_keys
+        columns = [col for col in self.row_columns(data[0]) if col not in keys]
+        if columns:
+            updates = ", ".join(f"{col} = excluded.{col}" for col in columns)
+            action = f"DO UPDATE SET {updates}"
+        else:
+            action = "DO NOTHING"
+        query = f"{insert_query} ON CONFLICT({', '.join(keys)}) {action}"
+        return query, params
+
     async def build_update_string(self, data: list[dict]):
-        columns = [k for k, v in data[0].items() if k not in ["id", "created_at"]]
-        params = [tuple(row.get(col, "") for col in columns) for row in data]
+        keys = self.conflict_keys
+        columns = [col for col in self.row_columns(data[0]) if col not in keys]
+        params = [tuple(row[col] for col in columns + keys) for row in data]
         placeholders = ", ".join([f"{col} = ?" for col in columns])
-        placeholders.append(data[0]["id"])
+        conditions = " AND ".join([f"{key} = ?" for key in keys])
         query = f"""UPDATE {self.table_name}
               SET {placeholders}
-              WHERE {self.primary_key} = ?"""
+              WHERE {conditions}"""
         return query, params
 
     async def db_operation(self, data: list[dict] = None, operation: str = "insert"):
-        """Create a table if it doesn't exist"""
-        query, params = await self.string_functions[operation](data)
-        result = await self.execute_query(query, params=params)
-        if operation == "insert" and result is False:
-            self.db_operation(data, "update")
-            logger.warning(f"Row already exists, updated {self.table_name}")
-        return result
+        """
+        Runs a create, insert, upsert or update against the table. Rows are
+        written w/ a statement per set of columns, all in one transaction.
+        """
+        build_string = self.string_functions[operation]
+        if operation == "create":
+            query, params = await build_string(data)
+            return await self.execute_query(query, params=params)
+        queries = [await build_string(rows) for rows in self.group_rows(data)]
+        return await self.execute_queries(queries)
+
+    async def migrate(self) -> None:
+        """
+        Brings a table created by an earlier version up to date, adding the
+        columns it lacks and the unique index its upserts conflict on. Of
+        rows that would break the index, only the latest written is kept.
+        """
+        connection = SQLiteConnection.get(self.db_file)
+        table_info = await connection.read(f"PRAGMA table_info({self.table_name})")
+        existing = {row[1] for row in table_info}
+        if not existing:
+            return
+        queries = [
+            (f"ALTER TABLE {self.table_name} ADD COLUMN {col} {ctype}", ())
+            for col, ctype in zip(self.columns, self.types)
+            if col not in existing
+        ]
+        if not await self.has_conflict_index(connection):
+            keys = ", ".join(self.conflict_keys)
+            queries += [
+                (
+                    f"DELETE FROM {self.table_name} WHERE rowid NOT IN "
+                    f"(SELECT MAX(rowid) FROM {self.table_name} GROUP BY {keys})",
+                    (),
+                ),
+                (
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table_name}_conflict "
+                    f"ON {self.table_name} ({keys})",
+                    (),
+                ),
+            ]
+        if queries:
+            logger.info(f"Migrating {self.table_name} to its current schema")
+            await self.execute_queries(queries)
+
+    async def has_conflict_index(self, connection: SQLiteConnection) -> bool:
+        """Whether a unique constraint or index covers the conflict keys"""
+        indexes = await connection.read(f"PRAGMA index_list({self.table_name})")
+        for _, name, unique, *_ in indexes:
+            if not unique:
+                continue
+            index_info = await connection.read(f"PRAGMA index_info({name})")
+            if {row[2] for row in index_info} == set(self.conflict_keys):
+                return True
+        return False
 
     async def execute_query(self, query: str, params: tuple | list[tuple] = ()):
         """Execute a query"""
         logger.debug(f"Executing query: {query} w/ params: {params}")
-        for _ in range(3):
+        return await self.execute_queries([(query, params)])
+
+    async def execute_queries(self, queries: list[tuple[str, tuple | list[tuple]]]):
+        """Execute several queries in a single transaction"""
+        try:
+            await SQLiteConnection.get(self.db_file).write_many(queries)
+        except sqlite3.OperationalError as e:
+            logger.error(f"Unable to write to {self.table_name}: {e}")
+            return False
+        return True
+
+
+class LinksTable(BaseTable):
+    """
+    Edges of the link graph, from the url a link was found on to the url
+    it points to. Urls are stored once, in the url_ids table, and edges
+    refer to them by id. Each batch is written in one transaction: new
+    urls are given ids, then the edges are inserted by looking them up.
+    """
+
+    def build_edge_queries(self, data: list[dict]) -> list[tuple[str, list[tuple]]]:
+        urls = dict.fromkeys(url for row in data for url in (row["src"], row["dst"]))
+        edges = [(row["run_id"], row["src"], row["dst"]) for row in data]
+        add_urls = (
+            f"INSERT INTO {URL_IDS_TABLE} (url) VALUES (?) ON CONFLICT(url) DO NOTHING"
+        )
+        add_edges = f"""INSERT INTO {self.table_name} (run_id, src_id, dst_id)
+              SELECT ?, src.id, dst.id
+              FROM {URL_IDS_TABLE} AS src, {URL_IDS_TABLE} AS dst
+              WHERE src.url = ? AND dst.url = ?
+              ON CONFLICT DO NOTHING"""
+        return [(add_urls, [(url,) for url in urls]), (add_edges, edges)]
+
+    async def db_operation(self, data: list[dict] = None, operation: str = "insert"):
+        if operation == "create":
+            return await super().db_operation(data, operation)
+        # Edges already written are left as they are, whatever the operation
+        return await self.execute_queries(self.build_edge_queries(data))
+
+
+class ContentsTable(BaseTable):
+    """
+    Page bodies, keyed by the hash of their content and compressed w/
+    zlib. Pages w/ the same body, e.g. template pages or soft 404s, are
+    only stored once. Batches are compressed in a thread, off the loop.
+    """
+
+    def __init__(self, *args, level: int = CONTENT_COMPRESSION_LEVEL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.level = level
+
+    def compress(self, data: list[dict]) -> list[tuple]:
+        bodies = {row["hash"]: row["body"] for row in data}
+        return [
+            (content_hash, len(body), zlib.compress(body, self.level))
+            for content_hash, body in bodies.items()
+        ]
+
+    async def db_operation(self, data: list[dict] = None, operation: str = "insert"):
+        if operation == "create":
+            return await super().db_operation(data, operation)
+        params = await asyncio.to_thread(self.compress, data)
+        # A body already stored is the same body, there is nothing to update
+        query = f"""INSERT INTO {self.table_name} (hash, size, body)
+              VALUES (?, ?, ?) ON CONFLICT(hash) DO NOTHING"""
+        return await self.execute_query(query, params=params)
+
+
+TABLE_CLASSES = {LINKS_TABLE: LinksTable, CONTENTS_TABLE: ContentsTable}
+
+
+class SQLiteConnection:
+    """
+    A long-lived connection to a database file, shared by the tables in it.
+    Runs in WAL mode, so reads (e.g. when resuming) don't block the writer,
+    and commits each batch in its own transaction. Statements are kept
+    compiled by sqlite3, as batches reuse the same few queries.
+    """
+
+    open_connections: dict[str, SQLiteConnection] = {}
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.db = None
+        # Batches from different tables take turns at the one connection
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def get(cls, db_file: str) -> SQLiteConnection:
+        if db_file not in cls.open_connections:
+            cls.open_connections[db_file] = cls(db_file)
+        return cls.open_connections[db_file]
+
+    @classmethod
+    async def close_all(cls):
+        connections = list(cls.open_connections.values())
+        cls.open_connections.clear()
+        for connection in connections:
+            await connection.close()
+
+    async def connect(self) -> aiosqlite.Connection:
+        if self.db is None:
+            # Transactions are begun and committed explicitly
+            db = aiosqlite.connect(
+                self.db_file,
+                isolation_level=None,
+                cached_statements=SQLITE_CACHED_STATEMENTS,
+            )
+            # Every batch is committed as it's written, so a connection left
+            # open mustn't keep the process from exiting
+            db.daemon = True
+            await db
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            await db.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+            self.db = db
+        return self.db
+
+    async def read(self, query: str, params: tuple = ()) -> list[tuple]:
+        async with self.lock:
+            db = await self.connect()
+            cursor = await db.execute(query, params)
+            return await cursor.fetchall()
+
+    async def write(self, query: str, params: tuple | list[tuple] = ()):
+        """Runs a query, or a batch of them, in a single transaction"""
+        await self.write_many([(query, params)])
+
+    async def write_many(self, queries: list[tuple[str, tuple | list[tuple]]]):
+        async with self.lock:
+            db = await self.connect()
+            await db.execute("BEGIN IMMEDIATE")
             try:
-                async with aiosqlite.connect(self.db_file) as db:
-                    func = db.executemany if isinstance(params, list) else db.execute
-                    await func(query, params)
-                    await db.commit()
-                    return True
-            except sqlite3.OperationalError as e:
-                logger.error(f"Integrity error: {e}")
-                await asyncio.sleep(1)
-        return False
+                for query, params in queries:
+                    if isinstance(params, list):
+                        await db.executemany(query, params)
+                    else:
+                        await db.execute(query, params)
+            except BaseException:
+                await db.execute("ROLLBACK")
+                raise
+            await db.execute("COMMIT")
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+
+# Forked processes can't use the parent's connections, they open their own
+os.register_at_fork(after_in_child=SQLiteConnection.open_connections.clear)
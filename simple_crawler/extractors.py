@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+# Each extractor reads a page's html and returns the href of its <base> tag
+# (None if there isn't one) along with the href of every <a> tag, in order.
+# Resolving, filtering and de-duplicating links is left to the parser,
+# so every engine yields exactly the same links. bs4 is the reference, the
+# others read the html as its html.parser backend does.
+
+# Character references as html.unescape (and so html.parser) finds them
+CHARREF = re.compile(r"&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[A-Za-z0-9]{1,32};?)")
+
+
+def bs4_hrefs(content: str) -> tuple[str | None, list[str]]:
+    """Builds a full BeautifulSoup tree (html.parser backend)"""
+    soup = BeautifulSoup(content, "html.parser")
+    base = soup.find("base", href=True)
+    hrefs = [tag["href"] for tag in soup.find_all("a", href=True)]
+    return (base["href"] if base else None), hrefs
+
+
+def decode_charref(match: re.Match) -> str:
+    """
+    Decodes a reference as html.parser does. libxml2 reads some differently,
+    e.g. &#128; as U+0080 rather than €, and cuts values short at surrogates,
+    code points past U+10FFFF or references missing their ;. Non-ascii
+    characters are written out, ascii ones as references so markup stays
+    markup.
+    """
+    return "".join(
+        char if ord(char) > 127 else f"&#{ord(char)};"
+        for char in unescape(match.group())
+    )
+
+
+def unused_char(content: str) -> str:
+    """A noncharacter the page doesn't use, to stand in for another"""
+    return next(
+        chr(code) for code in range(0xFDD0, 0x110000) if chr(code) not in content
+    )
+
+
+def lxml_hrefs(content: str) -> tuple[str | None, list[str]]:
+    """Reads hrefs w/ xpath over lxml's C parser"""
+    if not content.strip():
+        return None, []
+    html = CHARREF.sub(decode_charref, content)
+    # libxml2 ends strings at NUL, so it's swapped out and back in
+    nul = unused_char(html) if "\x00" in html else None
+    if nul is not None:
+        html = html.replace("\x00", nul)
+    # Encoded, so pages w/ an xml encoding declaration are accepted
+    parser = etree.HTMLParser(encoding="utf-8")
+    root = etree.fromstring(html.encode("utf-8"), parser)
+    if root is None:
+        return None, []
+    if any(error.message == "Attribute href redefined" for error in parser.error_log):
+        # libxml2 keeps the first of repeated attributes, html.parser the last
+        return stream_hrefs(content)
+    base = root.xpath("(//base[@href])[1]/@href")
+    hrefs = [str(href) for href in root.xpath("//a/@href")]
+    base = str(base[0]) if base else None
+    if nul is not None:
+        base = base.replace(nul, "\x00") if base else None
+        hrefs = [href.replace(nul, "\x00") for href in hrefs]
+    return base, hrefs
+
+
+class HrefParser(HTMLParser):
+    """Streams through the html collecting hrefs, without building a tree"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ("a", "base"):
+            return
+        # Repeated attributes keep their last value, as in bs4
+        hrefs = [value for name, value in attrs if name == "href"]
+        if not hrefs:
+            return
+        href = hrefs[-1] or ""
+        if tag == "a":
+            self.hrefs.append(href)
+        elif self.base is None:
+            self.base = href
+
+    handle_startendtag = handle_starttag
+
+
+def stream_hrefs(content: str) -> tuple[str | None, list[str]]:
+    """Streams through the html w/ the standard library's HTMLParser"""
+    parser = HrefParser()
+    parser.feed(content)
+    parser.close()
+    return parser.base, parser.hrefs
+
+
+EXTRACTORS = {
+    "bs4": bs4_hrefs,
+    "lxml": lxml_hrefs,
+    "stream": stream_hrefs,
+}
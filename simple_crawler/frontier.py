@@ -0,0 +1,348 @@
+from __future__ import annotations
+
+import time
+from collections import defaultdict
+from typing import Callable
+
+import redis
+from canonical import get_host
+from config.configuration import (DEFAULT_CRAWL_DELAY, DEPTH_WEIGHT, FRONTIER,
+                                  LINK_WEIGHT, PRIORITY_WEIGHT, get_logger)
+from streams import StreamQueue
+
+logger = get_logger("data")
+
+EXIT = "exit"
+DEFAULT_PRIORITY = 0.5
+# Most wake-up signals kept for workers blocked on a host frontier
+WAKE_TOKENS = 64
+
+
+def decode_urls(urls) -> list[str]:
+    """Decodes urls read from redis, leaving out any exit signal"""
+    return [url.decode("utf-8") for url in urls if url != EXIT.encode("utf-8")]
+
+
+class ListFrontier:
+    """
+    Urls waiting to be downloaded, kept in a redis list and visited
+    last-in first-out. Writes are queued onto the caller's pipeline so they
+    go out in the same round trip as the rest of a url's initialization.
+    """
+
+    # Whether urls popped but never acknowledged are handed out again
+    redelivers = False
+
+    def __init__(self, redis_conn: redis.Redis, key: str = "to_visit"):
+        self.rdb = redis_conn
+        self.key = key
+
+    def push(self, pipe, urls: list[str], depth: int = 0, priorities: dict = None):
+        pipe.lpush(self.key, *urls)
+
+    def link(self, pipe, urls: list[str]):
+        """Records new links to urls that were already requested"""
+
+    def set_delays(self, delay_for: Callable[[str], float]):
+        """Sets the lookup of how long to wait between requests to a host"""
+
+    async def ack(self, url: str):
+        """Marks a popped url as handled"""
+
+    def forget(self, pipe, url: str):
+        """Drops what the frontier kept on a url once it is closed"""
+
+    async def get_depth(self, url: str) -> int:
+        return 0
+
+    async def pop(self, timeout: float = None) -> bytes | None:
+        if timeout is None or timeout <= 0:
+            return await self.rdb.lpop(self.key)
+        popped = await self.rdb.blpop(self.key, timeout=timeout)
+        return popped[1] if popped else None
+
+    async def requeue(self, urls: list[str]):
+        """Returns urls to the frontier, e.g. once their retry is due"""
+        await self.rdb.rpush(self.key, *urls)
+
+    async def queued(self) -> list[str]:
+        """Every url waiting on the frontier, in the order they'd be popped"""
+        urls = await self.rdb.lrange(self.key, 0, -1)
+        return decode_urls(urls)
+
+    async def signal_exit(self):
+        await self.rdb.lpush(self.key, EXIT)
+
+    async def clear_exit(self):
+        await self.rdb.lrem(self.key, 0, EXIT)
+
+
+class PriorityFrontier(ListFrontier):
+    """
+    Urls waiting to be downloaded, in a redis sorted set popped highest
+    score first. Urls score higher the higher their sitemap priority, the
+    closer they are to the seed and the more pages link to them, so a
+    max_pages budget is spent on the most important pages.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        key: str = "frontier",
+        priority_weight: float = PRIORITY_WEIGHT,
+        depth_weight: float = DEPTH_WEIGHT,
+        link_weight: float = LINK_WEIGHT,
+    ):
+        super().__init__(redis_conn, key)
+        self.depth_key = f"{key}:depth"
+        # Scores urls were pushed w/, so a requeued url keeps its place
+        self.score_key = f"{key}:score"
+        self.priority_weight = priority_weight
+        self.depth_weight = depth_weight
+        self.link_weight = link_weight
+
+    def score(self, priority: float, depth: int, in_degree: int) -> float:
+        return (
+            self.priority_weight * priority
+            - self.depth_weight * depth
+            + self.link_weight * in_degree
+        )
+
+    def push(self, pipe, urls: list[str], depth: int = 0, priorities: dict = None):
+        priorities = priorities or {}
+        # Links found on a page start w/ that page's link to them
+        in_degree = 1 if depth else 0
+        scores = {
+            url: self.score(priorities.get(url, DEFAULT_PRIORITY), depth, in_degree)
+            for url in urls
+        }
+        pipe.zadd(self.key, scores, nx=True)
+        pipe.hset(self.depth_key, mapping={url: depth for url in urls})
+        pipe.hset(self.score_key, mapping=scores)
+
+    def link(self, pipe, urls: list[str]):
+        # Only bumps urls still waiting, ones already popped aren't re-added
+        for url in urls:
+            pipe.zadd(self.key, {url: self.link_weight}, xx=True, incr=True)
+
+    async def get_depth(self, url: str) -> int:
+        depth = await self.rdb.hget(self.depth_key, url)
+        return int(depth or 0)
+
+    def forget(self, pipe, url: str):
+        # Kept until close, as the depth of links found on a page is its own + 1
+        pipe.hdel(self.depth_key, url)
+        pipe.hdel(self.score_key, url)
+
+    async def pop(self, timeout: float = None) -> bytes | None:
+        if timeout is None or timeout <= 0:
+            popped = await self.rdb.zpopmax(self.key)
+            return popped[0][0] if popped else None
+        popped = await self.rdb.bzpopmax(self.key, timeout=timeout)
+        return popped[1] if popped else None
+
+    async def requeue(self, urls: list[str]):
+        # Urls go back w/ the score they were pushed w/, not a default one
+        stored, depths = await (
+            self.rdb.pipeline()
+            .hmget(self.score_key, urls)
+            .hmget(self.depth_key, urls)
+            .execute()
+        )
+        scores = {}
+        for url, score, depth in zip(urls, stored, depths):
+            if score is None:
+                score = self.score(DEFAULT_PRIORITY, int(depth or 0), 0)
+            scores[url] = float(score)
+        await self.rdb.zadd(self.key, scores)
+
+    async def queued(self) -> list[str]:
+        urls = await self.rdb.zrange(self.key, 0, -1)
+        return decode_urls(reversed(urls))
+
+    async def signal_exit(self):
+        # Scored above every url, so it is the next thing popped
+        await self.rdb.zadd(self.key, {EXIT: float("inf")})
+
+    async def clear_exit(self):
+        await self.rdb.zrem(self.key, EXIT)
+
+
+class HostFrontier(ListFrontier):
+    """
+    Mercator-style frontier, w/ a FIFO queue of urls for each host and a
+    sorted set of hosts scored by when each may next be requested.
+    Workers take their next url from a host that is ready now, so one host
+    w/ a long queue or a long crawl-delay doesn't hold up the others.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        key: str = "frontier",
+        default_delay: float = DEFAULT_CRAWL_DELAY,
+    ):
+        super().__init__(redis_conn, key)
+        self.hosts_key = f"{key}:hosts"
+        self.wake_key = f"{key}:wake"
+        self.exit_key = f"{key}:exit"
+        self.default_delay = default_delay
+        self.delay_for = lambda host: self.default_delay
+
+    def host_key(self, host: str) -> str:
+        return f"{self.key}:host:{host}"
+
+    def set_delays(self, delay_for: Callable[[str], float]):
+        self.delay_for = delay_for
+
+    def push(self, pipe, urls: list[str], depth: int = 0, priorities: dict = None):
+        by_host = defaultdict(list)
+        for url in urls:
+            by_host[get_host(url)].append(url)
+        now = time.time()
+        for host, host_urls in by_host.items():
+            pipe.rpush(self.host_key(host), *host_urls)
+            # Hosts still waiting out their delay keep their place
+            pipe.zadd(self.hosts_key, {host: now}, nx=True)
+        self.wake(pipe, len(urls))
+
+    def wake(self, pipe, count: int):
+        """Signals workers waiting on the frontier to check it again"""
+        pipe.lpush(self.wake_key, *["1"] * min(count, WAKE_TOKENS))
+        pipe.ltrim(self.wake_key, 0, WAKE_TOKENS - 1)
+
+    async def pop_ready(self) -> bytes | None:
+        """Takes the next url from a host that may be requested now, if any"""
+        while True:
+            exiting, ready = await (
+                self.rdb.pipeline()
+                .get(self.exit_key)
+                .zrangebyscore(self.hosts_key, "-inf", time.time(), start=0, num=1)
+                .execute()
+            )
+            if exiting:
+                return EXIT.encode("utf-8")
+            if not ready:
+                return None
+            # Only the worker that removes the host takes its next url
+            if not await self.rdb.zrem(self.hosts_key, ready[0]):
+                continue
+            host = ready[0].decode("utf-8")
+            url, _ = await (
+                self.rdb.pipeline()
+                .lpop(self.host_key(host))
+                .zadd(self.hosts_key, {host: time.time() + self.delay_for(host)})
+                .execute()
+            )
+            if url is not None:
+                return url
+            # Drop the emptied host, unless urls were pushed for it meanwhile
+            _, queued = await (
+                self.rdb.pipeline()
+                .zrem(self.hosts_key, host)
+                .llen(self.host_key(host))
+                .execute()
+            )
+            if queued:
+                await self.rdb.zadd(self.hosts_key, {host: time.time()}, nx=True)
+
+    async def pop(self, timeout: float = None) -> bytes | None:
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            url = await self.pop_ready()
+            remaining = deadline - time.monotonic()
+            if url is not None or timeout is None or remaining <= 0:
+                return url
+            # Wait for the next host to come due, or for new urls to arrive
+            head = await self.rdb.zrange(self.hosts_key, 0, 0, withscores=True)
+            if head:
+                remaining = min(remaining, max(0.01, head[0][1] - time.time()))
+            await self.rdb.blpop(self.wake_key, timeout=remaining)
+
+    async def requeue(self, urls: list[str]):
+        pipe = self.rdb.pipeline()
+        self.push(pipe, [url.decode("utf-8") for url in urls])
+        await pipe.execute()
+
+    async def queued(self) -> list[str]:
+        hosts = await self.rdb.zrange(self.hosts_key, 0, -1)
+        pipe = self.rdb.pipeline()
+        for host in hosts:
+            pipe.lrange(self.host_key(host.decode("utf-8")), 0, -1)
+        return decode_urls(url for urls in await pipe.execute() for url in urls)
+
+    async def signal_exit(self):
+        pipe = self.rdb.pipeline()
+        pipe.set(self.exit_key, 1)
+        self.wake(pipe, WAKE_TOKENS)
+        await pipe.execute()
+
+    async def clear_exit(self):
+        await self.rdb.delete(self.exit_key, self.wake_key)
+
+
+class StreamFrontier(ListFrontier):
+    """
+    Urls waiting to be downloaded, on a redis stream shared by every
+    download worker through a consumer group. A popped url stays pending
+    until it is acknowledged, so urls held by a crashed worker are claimed
+    by another rather than lost.
+    """
+
+    redelivers = True
+
+    def __init__(self, redis_conn: redis.Redis, key: str = "stream:download"):
+        super().__init__(redis_conn, key)
+        self.queue = StreamQueue(redis_conn, key)
+        self.exit_key = f"{key}:exit"
+        # Message ids of the urls this process has popped but not yet handled
+        self.in_progress = {}
+
+    def push(self, pipe, urls: list[str], depth: int = 0, priorities: dict = None):
+        for url in urls:
+            self.queue.add(pipe, url)
+
+    async def pop(self, timeout: float = None) -> bytes | None:
+        if await self.rdb.get(self.exit_key):
+            return EXIT.encode("utf-8")
+        entries = await self.queue.get(timeout=timeout)
+        if not entries:
+            return None
+        entry_id, url = entries[0]
+        self.in_progress[url] = entry_id
+        return url.encode("utf-8")
+
+    async def ack(self, url: str):
+        entry_id = self.in_progress.pop(url, None)
+        if entry_id is not None:
+            await self.queue.ack(entry_id)
+
+    async def requeue(self, urls: list[str]):
+        pipe = self.rdb.pipeline()
+        self.push(pipe, [url.decode("utf-8") for url in urls])
+        await pipe.execute()
+
+    async def queued(self) -> list[str]:
+        # Includes urls popped but not yet acknowledged
+        entries = await self.rdb.xrange(self.key)
+        return decode_urls(fields[b"data"] for _, fields in entries)
+
+    async def signal_exit(self):
+        await self.rdb.set(self.exit_key, 1)
+
+    async def clear_exit(self):
+        await self.rdb.delete(self.exit_key)
+
+
+FRONTIERS = {
+    "list": ListFrontier,
+    "priority": PriorityFrontier,
+    "host": HostFrontier,
+    "stream": StreamFrontier,
+}
+
+
+def make_frontier(redis_conn: redis.Redis, kind: str = FRONTIER):
+    if kind not in FRONTIERS:
+        raise ValueError(f"Unknown frontier {kind}, use one of {list(FRONTIERS)}")
+    return FRONTIERS[kind](redis_conn)
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import aiohttp
+from config.configuration import (MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST,
+                                  REQUEST_TIMEOUT, USER_AGENT, get_logger)
+
+logger = get_logger("downloader")
+
+
+class HttpEngine:
+    """
+    Owns the aiohttp session shared by every downloader in the process.
+    Connections are pooled (and kept alive) per host by the connector,
+    which also caps the number of requests in flight at any one time.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        timeout: float = REQUEST_TIMEOUT,
+        user_agent: str = USER_AGENT,
+    ):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self._session = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Lazily create the session, as it must be bound to a running loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": self.user_agent},
+            )
+        return self._session
+
+    async def fetch(self, url: str, raise_for_status: bool = True):
+        """Returns the decoded body, status code and headers for a url"""
+        session = await self.get_session()
+        async with session.get(url) as response:
+            if raise_for_status:
+                response.raise_for_status()
+            text = await response.text(errors="replace")
+            return text, response.status, response.headers
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,560 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+from collections import OrderedDict, defaultdict, deque
+
+import redis
+from config.configuration import LOCAL_CONTENT_BYTES, get_logger
+
+logger = get_logger("data")
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+def encode(value) -> bytes:
+    """Encodes a value the way redis-py does before sending it"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if value is None or isinstance(value, bool):
+        raise redis.DataError(f"Invalid input of type: '{type(value).__name__}'")
+    if isinstance(value, (int, float)):
+        return repr(value).encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+def score_bound(value) -> float:
+    return float(value.decode("utf-8") if isinstance(value, bytes) else value)
+
+
+class Descending:
+    """Member wrapper that sorts in reverse, for the max-heap of a sorted set"""
+
+    __slots__ = ("member",)
+
+    def __init__(self, member: bytes):
+        self.member = member
+
+    def __lt__(self, other: Descending) -> bool:
+        return self.member > other.member
+
+
+class SortedSet:
+    """
+    Scores by member, w/ a min-heap and a max-heap so the lowest and
+    highest members are found without sorting. Heap entries go stale when
+    a member is removed or rescored, and are skipped (and dropped) lazily.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.low = []
+        self.high = []
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def add(self, member: bytes, score: float):
+        self.scores[member] = score
+        heapq.heappush(self.low, (score, member))
+        heapq.heappush(self.high, (-score, Descending(member)))
+        if len(self.low) > 2 * len(self.scores) + 64:
+            self.compact()
+
+    def remove(self, member: bytes) -> bool:
+        return self.scores.pop(member, None) is not None
+
+    def compact(self):
+        self.low = [(score, member) for member, score in self.scores.items()]
+        self.high = [
+            (-score, Descending(member)) for member, score in self.scores.items()
+        ]
+        heapq.heapify(self.low)
+        heapq.heapify(self.high)
+
+    def first(self) -> tuple[bytes, float] | None:
+        while self.low:
+            score, member = self.low[0]
+            if self.scores.get(member) == score:
+                return member, score
+            heapq.heappop(self.low)
+        return None
+
+    def pop_last(self) -> tuple[bytes, float] | None:
+        while self.high:
+            score, member = heapq.heappop(self.high)
+            member = member.member
+            if self.scores.get(member) == -score:
+                del self.scores[member]
+                return member, -score
+        return None
+
+    def ordered(self) -> list[tuple[bytes, float]]:
+        return sorted(self.scores.items(), key=lambda item: (item[1], item[0]))
+
+
+class LocalPipeline:
+    """Queues commands and runs them back to back, w/ nothing in between"""
+
+    def __init__(self, store: LocalRedis):
+        self.store = store
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        method = getattr(self.store, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        commands, self.commands = self.commands, []
+        # No command awaits anything, so the batch runs as one transaction
+        return [await method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class LocalPubSub:
+    def __init__(self, store: LocalRedis):
+        self.store = store
+        self.messages = deque()
+        self.channels = set()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(encode(channel))
+            self.store.subscribers[encode(channel)].add(self)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        if not self.messages:
+            await asyncio.sleep(timeout or 0)
+            return None
+        channel, data = self.messages.popleft()
+        return {"type": "message", "pattern": None, "channel": channel, "data": data}
+
+    async def close(self):
+        for channel in self.channels:
+            self.store.subscribers[channel].discard(self)
+        self.channels.clear()
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the redis client, for crawls run in a single
+    process. Keeps crawl state in dicts, deques and heaps, and implements
+    the commands the crawler uses w/ the same arguments and return values,
+    so the crawl tracker, frontiers and seen sets run on it unchanged.
+    Page content is kept up to max_content_bytes, dropping the oldest first.
+    """
+
+    def __init__(self, max_content_bytes: int = LOCAL_CONTENT_BYTES):
+        self.data = {}
+        self.expires = {}
+        # Page content, oldest first, kept apart so it can be bounded
+        self.content = OrderedDict()
+        self.content_bytes = 0
+        self.max_content_bytes = max_content_bytes
+        self.subscribers = defaultdict(set)
+        self.waiters = []
+
+    # Keys
+
+    def lookup(self, name, kind: type, create: bool = False):
+        key = encode(name)
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.drop(key)
+        value = self.data.get(key)
+        if value is None and create:
+            value = self.data[key] = kind()
+        if value is not None and not isinstance(value, kind):
+            raise redis.ResponseError(WRONGTYPE)
+        return value
+
+    def drop(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        if key in self.content:
+            self.content_bytes -= len(self.content.pop(key))
+        return self.data.pop(key, None) is not None
+
+    def drop_if_empty(self, name):
+        key = encode(name)
+        if key in self.data and not self.data[key]:
+            self.drop(key)
+
+    async def delete(self, *names) -> int:
+        return sum(self.drop(encode(name)) for name in names)
+
+    async def exists(self, *names) -> int:
+        return sum(self.lookup(name, object) is not None for name in names)
+
+    async def expire(self, name, seconds: int) -> bool:
+        if self.lookup(name, object) is None:
+            return False
+        self.expires[encode(name)] = time.monotonic() + seconds
+        return True
+
+    async def ttl(self, name) -> int:
+        if self.lookup(name, object) is None:
+            return -2
+        deadline = self.expires.get(encode(name))
+        return -1 if deadline is None else round(deadline - time.monotonic())
+
+    async def pttl(self, name) -> int:
+        if self.lookup(name, object) is None:
+            return -2
+        deadline = self.expires.get(encode(name))
+        return -1 if deadline is None else round(1000 * (deadline - time.monotonic()))
+
+    async def flushdb(self, asynchronous: bool = False) -> bool:
+        self.data.clear()
+        self.expires.clear()
+        self.content.clear()
+        self.content_bytes = 0
+        return True
+
+    async def save(self) -> bool:
+        """Nothing outlives the process, there is nothing to save"""
+        return True
+
+    async def memory_usage(self, name) -> int | None:
+        """Rough count of the bytes held for a key"""
+        value = self.lookup(name, object)
+        if value is None:
+            return None
+        return self.size_of(value)
+
+    async def info(self, section: str = None) -> dict:
+        """Only the memory in use is reported, as a rough count of bytes held"""
+        used = sum(len(key) + self.size_of(value) for key, value in self.data.items())
+        return {"used_memory": used}
+
+    @staticmethod
+    def size_of(value) -> int:
+        if isinstance(value, dict):
+            return sum(len(field) + len(item) for field, item in value.items())
+        if isinstance(value, SortedSet):
+            return sum(len(member) + 8 for member in value.scores)
+        if isinstance(value, (set, deque)):
+            return sum(len(item) for item in value)
+        return len(value)
+
+    def pipeline(self, transaction: bool = True) -> LocalPipeline:
+        return LocalPipeline(self)
+
+    # Strings
+
+    async def get(self, name) -> bytes | None:
+        value = self.lookup(name, (bytes, bytearray))
+        return bytes(value) if value is not None else None
+
+    async def set(
+        self, name, value, ex: int = None, px: int = None, nx: bool = False
+    ) -> bool:
+        key = encode(name)
+        if nx and self.lookup(key, object) is not None:
+            return None
+        self.drop(key)
+        value = encode(value)
+        self.data[key] = value
+        if ex is not None:
+            self.expires[key] = time.monotonic() + ex
+        if px is not None:
+            self.expires[key] = time.monotonic() + px / 1000
+        if key.endswith(b":content"):
+            self.store_content(key, value)
+        return True
+
+    def store_content(self, key: bytes, value: bytes):
+        self.content[key] = value
+        self.content_bytes += len(value)
+        while self.content_bytes > self.max_content_bytes and len(self.content) > 1:
+            oldest, _ = self.content.popitem(last=False)
+            self.content_bytes -= len(self.data.pop(oldest))
+            logger.warning(f"Content store full, dropped {oldest.decode('utf-8')}")
+
+    async def incrby(self, name, amount: int = 1) -> int:
+        value = int(self.lookup(name, (bytes, bytearray)) or 0) + amount
+        self.data[encode(name)] = encode(value)
+        return value
+
+    async def incr(self, name, amount: int = 1) -> int:
+        return await self.incrby(name, amount)
+
+    async def decr(self, name, amount: int = 1) -> int:
+        return await self.incrby(name, -amount)
+
+    async def getbit(self, name, offset: int) -> int:
+        value = self.lookup(name, (bytes, bytearray)) or b""
+        byte, bit = divmod(offset, 8)
+        if byte >= len(value):
+            return 0
+        return (value[byte] >> (7 - bit)) & 1
+
+    async def setbit(self, name, offset: int, value: int) -> int:
+        bits = self.lookup(name, (bytes, bytearray))
+        if not isinstance(bits, bytearray):
+            bits = self.data[encode(name)] = bytearray(bits or b"")
+        byte, bit = divmod(offset, 8)
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        previous = (bits[byte] >> (7 - bit)) & 1
+        if value:
+            bits[byte] |= 1 << (7 - bit)
+        else:
+            bits[byte] &= ~(1 << (7 - bit))
+        return previous
+
+    # Hashes
+
+    async def hset(self, name, key=None, value=None, mapping: dict = None) -> int:
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        fields = self.lookup(name, dict, create=True)
+        added = 0
+        for field, item in items.items():
+            field = encode(field)
+            added += field not in fields
+            fields[field] = encode(item)
+        return added
+
+    async def hget(self, name, key) -> bytes | None:
+        return (self.lookup(name, dict) or {}).get(encode(key))
+
+    async def hmget(self, name, keys, *args) -> list:
+        keys = [keys, *args] if isinstance(keys, (str, bytes)) else [*keys, *args]
+        fields = self.lookup(name, dict) or {}
+        return [fields.get(encode(key)) for key in keys]
+
+    async def hgetall(self, name) -> dict:
+        return dict(self.lookup(name, dict) or {})
+
+    async def hvals(self, name) -> list:
+        return list((self.lookup(name, dict) or {}).values())
+
+    async def hincrby(self, name, key, amount: int = 1) -> int:
+        fields = self.lookup(name, dict, create=True)
+        value = int(fields.get(encode(key), 0)) + amount
+        fields[encode(key)] = encode(value)
+        return value
+
+    async def hdel(self, name, *keys) -> int:
+        fields = self.lookup(name, dict) or {}
+        removed = sum(fields.pop(encode(key), None) is not None for key in keys)
+        self.drop_if_empty(name)
+        return removed
+
+    # Sets
+
+    async def sadd(self, name, *values) -> int:
+        members = self.lookup(name, set, create=True)
+        before = len(members)
+        members.update(encode(value) for value in values)
+        return len(members) - before
+
+    async def srem(self, name, *values) -> int:
+        members = self.lookup(name, set) or set()
+        before = len(members)
+        members.difference_update(encode(value) for value in values)
+        self.drop_if_empty(name)
+        return before - len(members)
+
+    async def smembers(self, name) -> set:
+        return set(self.lookup(name, set) or ())
+
+    async def scard(self, name) -> int:
+        return len(self.lookup(name, set) or ())
+
+    # Lists
+
+    async def lpush(self, name, *values) -> int:
+        items = self.lookup(name, deque, create=True)
+        items.extendleft(encode(value) for value in values)
+        self.wake()
+        return len(items)
+
+    async def rpush(self, name, *values) -> int:
+        items = self.lookup(name, deque, create=True)
+        items.extend(encode(value) for value in values)
+        self.wake()
+        return len(items)
+
+    async def lpop(self, name) -> bytes | None:
+        items = self.lookup(name, deque)
+        if not items:
+            return None
+        value = items.popleft()
+        self.drop_if_empty(name)
+        return value
+
+    async def llen(self, name) -> int:
+        return len(self.lookup(name, deque) or ())
+
+    async def lrange(self, name, start: int, end: int) -> list:
+        items = list(self.lookup(name, deque) or ())
+        end = len(items) if end == -1 else (end + 1 or None)
+        return items[start:end]
+
+    async def ltrim(self, name, start: int, end: int) -> bool:
+        items = self.lookup(name, deque)
+        if items is not None:
+            self.data[encode(name)] = deque(await self.lrange(name, start, end))
+            self.drop_if_empty(name)
+        return True
+
+    async def lrem(self, name, count: int, value) -> int:
+        items = list(self.lookup(name, deque) or ())
+        value = encode(value)
+        order = range(len(items) - 1, -1, -1) if count < 0 else range(len(items))
+        limit = abs(count) or len(items)
+        removed = [index for index in order if items[index] == value][:limit]
+        if removed:
+            removed = set(removed)
+            kept = [item for index, item in enumerate(items) if index not in removed]
+            self.data[encode(name)] = deque(kept)
+            self.drop_if_empty(name)
+        return len(removed)
+
+    # Sorted sets
+
+    async def zadd(
+        self,
+        name,
+        mapping: dict,
+        nx=False,
+        xx=False,
+        incr=False,
+        gt=False,
+        lt=False,
+        **kwargs,
+    ) -> int | float | None:
+        members = self.lookup(name, SortedSet, create=True)
+        added = 0
+        score = None
+        for member, score in mapping.items():
+            member = encode(member)
+            exists = member in members.scores
+            if (nx and exists) or (xx and not exists):
+                score = None
+                continue
+            if exists and not incr:
+                current = members.scores[member]
+                if (gt and score <= current) or (lt and score >= current):
+                    continue
+            if incr:
+                score += members.scores.get(member, 0.0)
+            added += not exists
+            members.add(member, float(score))
+        self.drop_if_empty(name)
+        self.wake()
+        return score if incr else added
+
+    async def zrem(self, name, *values) -> int:
+        members = self.lookup(name, SortedSet) or SortedSet()
+        removed = sum(members.remove(encode(value)) for value in values)
+        self.drop_if_empty(name)
+        return removed
+
+    async def zcard(self, name) -> int:
+        return len(self.lookup(name, SortedSet) or ())
+
+    async def zscore(self, name, value) -> float | None:
+        return (self.lookup(name, SortedSet) or SortedSet()).scores.get(encode(value))
+
+    async def zrange(self, name, start: int, end: int, withscores=False) -> list:
+        members = self.lookup(name, SortedSet) or SortedSet()
+        if start == 0 and end == 0:
+            # The lowest member, w/o sorting the whole set
+            first = members.first()
+            items = [first] if first else []
+        else:
+            items = members.ordered()
+            items = items[start : len(items) if end == -1 else (end + 1 or None)]
+        return items if withscores else [member for member, _ in items]
+
+    async def zrangebyscore(
+        self, name, min, max, start=None, num=None, withscores=False
+    ) -> list:
+        members = self.lookup(name, SortedSet) or SortedSet()
+        low, high = score_bound(min), score_bound(max)
+        first = members.first()
+        if first is None or first[1] > high:
+            items = []
+        elif start == 0 and num == 1 and first[1] >= low:
+            items = [first]
+        else:
+            items = [item for item in members.ordered() if low <= item[1] <= high]
+            if start is not None:
+                items = items[start : start + num if num is not None else None]
+        return items if withscores else [member for member, _ in items]
+
+    async def zremrangebyscore(self, name, min, max) -> int:
+        expired = await self.zrangebyscore(name, min, max)
+        return await self.zrem(name, *expired)
+
+    async def zpopmax(self, name, count: int = None) -> list:
+        members = self.lookup(name, SortedSet)
+        popped = []
+        while members and len(popped) < (count or 1):
+            popped.append(members.pop_last())
+        self.drop_if_empty(name)
+        return popped
+
+    # Blocking pops
+
+    def wake(self):
+        """Wakes every pop blocked waiting for a list or sorted set to fill"""
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_for(self, pop, keys, timeout: float):
+        keys = [keys] if isinstance(keys, (str, bytes)) else keys
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            for key in keys:
+                popped = await pop(key)
+                if popped:
+                    return popped
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    async def blpop(self, keys, timeout: float = 0) -> tuple | None:
+        async def pop(key):
+            value = await self.lpop(key)
+            return (encode(key), value) if value is not None else None
+
+        return await self.wait_for(pop, keys, timeout)
+
+    async def bzpopmax(self, keys, timeout: float = 0) -> tuple | None:
+        async def pop(key):
+            popped = await self.zpopmax(key)
+            return (encode(key), *popped[0]) if popped else None
+
+        return await self.wait_for(pop, keys, timeout)
+
+    # Pubsub
+
+    def pubsub(self) -> LocalPubSub:
+        return LocalPubSub(self)
+
+    async def publish(self, channel, message) -> int:
+        channel = encode(channel)
+        listeners = self.subscribers.get(channel, set())
+        for listener in listeners:
+            listener.messages.append((channel, encode(message)))
+        return len(listeners)
@@ -1,18 +1,28 @@
 from __future__ import annotations
 
 import asyncio
-import atexit
+import multiprocessing
 import time
 from asyncio import Queue
+from concurrent.futures import Executor, ProcessPoolExecutor
 from parser import Parser
 
 import redis
-from config.configuration import (RDB_FILE, REDIS_HOST, REDIS_PORT,
-                                  SQLITE_DB_FILE, get_logger)
+from canonical import canonicalize
+from checkpoint import Checkpointer
+from config.configuration import (DEFAULT_CRAWL_DELAY, DOWNLOAD_WORKERS,
+                                  FRONTIER_BLOCK_TIMEOUT, MAX_CONNECTIONS,
+                                  PARSE_ENGINE, PARSE_PROCESSES, PARSE_WORKERS,
+                                  PROCESSES, RDB_FILE, REDIS_HOST, REDIS_PORT,
+                                  SQLITE_DB_FILE, TRANSPORT, get_logger)
 # from manager import Manager
 from downloader import SiteDownloader
+from local_store import LocalRedis
 from manager import Manager
 from mapper import SiteMapper
+from politeness import THROTTLE_STATUSES, parse_retry_after
+from streams import StreamQueue
+from utils import deserialize
 
 logger = get_logger("crawler")
 
@@ -27,108 +37,376 @@ async def prime_queue(seed_url: str):
     # Check to see if we can get a sitemap
     mapper = SiteMapper(manager=manager, seed_url=seed_url)
     try:
-        sitemap_url, sitemap_indexes, sitemap_details = mapper.get_sitemap()
+        sitemap_url, sitemap_indexes, sitemap_details = await mapper.get_sitemap()
     except Exception as e:
         logger.error(f"Error getting sitemap for {seed_url}: {e}")
-        manager.crawl_tracker.request_download(seed_url)
+        await manager.crawl_tracker.request_download(seed_url)
+
+
+async def resume_queue(seed_url: str, checkpointer: Checkpointer):
+    """
+    Rebuilds the frontier of an interrupted run from the pages in its
+    database (and the links found on them) and its last checkpoint
+    """
+    tracker = manager.crawl_tracker
+    done = await manager.db_manager.crawled_urls(manager.run_id)
+    snapshot = checkpointer.load() or {}
+    linked = [link for links in done.values() for link in links]
+    queued = await tracker.restore(
+        list(done),
+        snapshot.get("queued", []) + linked,
+        snapshot.get("completed_pages", 0),
+    )
+    if not done and not queued:
+        logger.warning(f"Nothing to resume for run {manager.run_id}, using the seed")
+        await prime_queue(seed_url)
+    elif not queued:
+        logger.info(f"Run {manager.run_id} has no urls left to crawl")
+        await tracker.signal_exit()
+
+
+async def prepare_crawl(url: str, flush_cache: bool, resume: bool):
+    """Clears out any previous crawl's state and primes the frontier"""
+    # A resumed crawl is rebuilt from its checkpoint, not what redis holds
+    if flush_cache or resume:
+        await manager.rdb.flushdb()
+    await manager.crawl_tracker.clear_exit()
+    # Read by workers joining the crawl from other nodes
+    await manager.rdb.hset(
+        "run",
+        mapping={
+            "run_id": manager.run_id,
+            "seed_url": url,
+            "max_pages": manager.max_pages,
+        },
+    )
+    if resume:
+        checkpointer = Checkpointer(manager.crawl_tracker, manager.data_dir)
+        await resume_queue(url, checkpointer)
+    else:
+        await prime_queue(url)
+    logger.info(f"Primed queue for seed url {url}")
+
+
+async def start_writer(url: str, transport: str, coordinated: bool, resume: bool):
+    """
+    Starts this process's db writer, once redis has been flushed. Each
+    stream message is read by one writer, so every process runs one, but
+    published messages reach every subscriber, so processes coordinated
+    over pubsub leave the writing to their coordinator.
+    """
+    db_manager = manager.db_manager
+    if coordinated and transport != "streams":
+        await db_manager.wait_for_writer()
+        return
+    await db_manager.start()
+    if not coordinated and not resume:
+        await db_manager.start_run(manager.run_id, url, manager.max_pages)
 
 
 async def process_url_while_true(
-    url: str, retries: int, write_to_db: bool = True, check_every: float = 0.5
+    url: str,
+    retries: int,
+    write_to_db: bool = True,
+    flush_cache: bool = True,
+    download_workers: int = DOWNLOAD_WORKERS,
+    parse_workers: int = PARSE_WORKERS,
+    parse_processes: int = PARSE_PROCESSES,
+    parse_engine: str = PARSE_ENGINE,
+    transport: str = TRANSPORT,
+    resume: bool = False,
+    coordinated: bool = False,
 ):
-    parse_queue = Queue(20)
-    await prime_queue(url)
-    logger.info(f"Primed queue for seed url {url}")
-    download_producer = asyncio.create_task(
-        download_url_while_true(parse_queue, retries, write_to_db, check_every)
-    )
-    parsed_results = parse_while_true(parse_queue, write_to_db, check_every)
-    all_links = await asyncio.gather(download_producer, parsed_results)
+    """
+    Runs a crawl's download and parse workers until the crawl tracker
+    signals that it's done. A coordinated process is one of several
+    crawling the same run, which leave preparing the crawl, checkpoints
+    and the run's bookkeeping to the process that started them.
+    """
+    if transport == "streams":
+        # Shared w/ the parsers of every crawler process
+        parse_queue = StreamQueue(manager.rdb, "stream:parse")
+    else:
+        parse_queue = Queue(20 * parse_workers)
+    downloads_done = asyncio.Event()
+    # Parse workers share one pool, so extraction runs on up to N cores
+    executor = ProcessPoolExecutor(parse_processes) if parse_processes > 0 else None
+    checkpointer = Checkpointer(manager.crawl_tracker, manager.data_dir)
+    crawl_done = asyncio.Event()
+    checkpoints, heartbeats = None, None
+    try:
+        if not coordinated:
+            await prepare_crawl(url, flush_cache, resume)
+        await start_writer(url, transport, coordinated, resume)
+        if not coordinated:
+            checkpoints = asyncio.create_task(checkpointer.run(crawl_done))
+        # Keeps this process's leases on the urls it has popped alive
+        heartbeats = asyncio.create_task(manager.crawl_tracker.keep_alive(crawl_done))
+        # All workers share the frontier (via the crawl tracker) and the parse queue
+        downloaders = [
+            asyncio.create_task(
+                download_url_while_true(parse_queue, retries, write_to_db, worker_id=i)
+            )
+            for i in range(download_workers)
+        ]
+        parsers = [
+            asyncio.create_task(
+                parse_while_true(
+                    parse_queue,
+                    write_to_db,
+                    executor,
+                    parse_engine,
+                    worker_id=i,
+                    downloads_done=downloads_done,
+                )
+            )
+            for i in range(parse_workers)
+        ]
+        await asyncio.gather(*downloaders)
+        # Once downloading stops, parsers finish what is queued and then exit
+        downloads_done.set()
+        if isinstance(parse_queue, Queue):
+            for _ in parsers:
+                await parse_queue.put(None)
+        parsed_links = await asyncio.gather(*parsers)
+        for name, stats in (await manager.crawl_tracker.seen_stats()).items():
+            logger.info(
+                f"{name} ({stats['backend']}): {stats['count']} urls seen, "
+                f"{stats['bytes_per_url']} bytes per url"
+            )
+    finally:
+        # Stopping the checkpoints saves one last snapshot
+        crawl_done.set()
+        for task in (checkpoints, heartbeats):
+            if task is not None:
+                await task
+        await manager.http_engine.close()
+        if executor is not None:
+            executor.shutdown()
+    if not coordinated:
+        await complete_run(url)
+    # Writes what is left of this process's batches
+    await manager.db_manager.shutdown()
+    if not coordinated:
+        # Snapshots redis once the crawl's state is final
+        await manager.shutdown()
     logger.info(f"Completed processing {url}")
-    return all_links
+    return [link for links in parsed_links for link in links]
+
+
+async def complete_run(url: str):
+    """Records the run as complete, w/ the most memory redis used during it"""
+    tracker = manager.crawl_tracker
+    await tracker.record_memory()
+    memory_peak = await tracker.memory_peak()
+    if memory_peak is not None:
+        logger.info(
+            f"Redis memory high-water mark for run {manager.run_id}: "
+            f"{memory_peak / 2**20:.1f}MiB"
+        )
+    await manager.db_manager.complete_run(
+        manager.run_id, url, manager.max_pages, memory_peak
+    )
+
+
+def crawl_worker(url: str, kwargs: dict) -> list[str]:
+    """Entry point of each process started by crawl_processes"""
+    return asyncio.run(process_url_while_true(url, coordinated=True, **kwargs))
+
+
+async def release_connections():
+    """Closes connections, so forked workers open their own in their own loop"""
+    await manager.http_engine.close()
+    await manager.rdb.connection_pool.disconnect()
+    await manager.robots_rdb.connection_pool.disconnect()
+
+
+async def start_coordinator(url: str, flush_cache: bool, resume: bool):
+    await prepare_crawl(url, flush_cache, resume)
+    await release_connections()
+
+
+async def joined_run() -> dict:
+    """The crawl currently running against redis, as recorded by its coordinator"""
+    run = await deserialize(await manager.rdb.hgetall("run"))
+    await release_connections()
+    return run
+
+
+async def wait_for_workers(url: str, futures: list, resume: bool) -> list[list[str]]:
+    """Writes the run's records and takes checkpoints until every worker has exited"""
+    await manager.db_manager.start()
+    if not resume:
+        await manager.db_manager.start_run(manager.run_id, url, manager.max_pages)
+    checkpointer = Checkpointer(manager.crawl_tracker, manager.data_dir)
+    crawl_done = asyncio.Event()
+    checkpoints = asyncio.create_task(checkpointer.run(crawl_done))
+    try:
+        return await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+    finally:
+        crawl_done.set()
+        await checkpoints
+        await complete_run(url)
+        await manager.db_manager.shutdown()
+        await manager.shutdown()
+
+
+def crawl_processes(
+    url: str,
+    processes: int,
+    flush_cache: bool,
+    resume: bool,
+    join: bool = False,
+    **kwargs,
+) -> list[str]:
+    """
+    Spreads a crawl over several processes, so parsing isn't limited to one
+    core. This process prepares the crawl and then forks the workers, which
+    share the frontier, seen sets and page count through redis. Whichever
+    worker completes the last page (or max_pages) signals the others to stop.
+    When joining a crawl coordinated elsewhere, only the workers are started.
+    """
+    if isinstance(manager.rdb, LocalRedis):
+        raise ValueError("Crawling w/ several processes needs the redis backend")
+    if not join:
+        asyncio.run(start_coordinator(url, flush_cache, resume))
+    # Forked, so workers inherit the manager as set up for this run
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(processes, mp_context=context) as pool:
+        futures = [pool.submit(crawl_worker, url, kwargs) for _ in range(processes)]
+        if join:
+            parsed_links = [future.result() for future in futures]
+        else:
+            parsed_links = asyncio.run(wait_for_workers(url, futures, resume))
+    logger.info(f"Completed processing {url} across {processes} processes")
+    return [link for links in parsed_links for link in links]
+
+
+async def next_to_parse(
+    parse_queue: Queue | StreamQueue, downloads_done: asyncio.Event
+) -> tuple[str | None, str | None]:
+    """
+    Waits for the next url to parse, returning it along w/ the stream message
+    to acknowledge once it's parsed. Returns None once parsing is done.
+    """
+    if isinstance(parse_queue, Queue):
+        return await parse_queue.get(), None
+    while True:
+        entries = await parse_queue.get(timeout=FRONTIER_BLOCK_TIMEOUT)
+        if entries:
+            entry_id, url = entries[0]
+            return url, entry_id
+        # Nothing left for this process's parsers once its downloaders stop
+        if downloads_done.is_set():
+            return None, None
+
+
+def is_retryable(status: int | None) -> bool:
+    """Connection errors, server errors and throttling are worth retrying"""
+    return status is None or status >= 500 or status in THROTTLE_STATUSES
 
 
 async def download_url_while_true(
-    parse_queue: Queue, retries: int, write_to_db: bool = True, check_every: float = 0.5
+    parse_queue: Queue | StreamQueue,
+    retries: int,
+    write_to_db: bool = True,
+    worker_id: int = 0,
 ):
     """
-    Periodically check the queue for new items requested for download.
-    If there are new items, download them and add them to the queue.
+    Wait on the frontier for urls requested for download,
+    download them and pass them on to the parsers.
+    Runs until the crawl tracker signals that no work is left.
     """
     downloader = SiteDownloader(manager, write_to_db)
-    empty_count = 0
-    max_empty_count = 25
-    running = True
-    # Continue querying cache for new items
-    # Stop when 25 cycle have passed without finding any new items
-    while running and empty_count <= max_empty_count:
+    politeness = manager.politeness
+    url = None
+    tracker = manager.crawl_tracker
+    while True:
         try:
-            # Check redis list for new pages needing to be visited
-            url = manager.crawl_tracker.get_page_to_visit()
+            # Block on the frontier, waking early only when a retry comes due
+            timeout = tracker.retry_wait(FRONTIER_BLOCK_TIMEOUT)
+            url = await tracker.get_page_to_visit(timeout=timeout)
             if url == "exit":
                 logger.info("No more pages to visit, closing queue")
-                running = False
-            for _ in range(retries):
-                if url is not None:
-                    logger.debug(f"Download request received for {url} ...")
-                    content = None
-                    try:
-                        content, status = downloader.get_page_elements(url)
-                    except Exception as e:
-                        logger.error(f"Error downloading page {url}: {e}")
-                        if "429" in str(e):
-                            logger.info(
-                                f"429 error, sleeping then increasing check_every to {check_every*1.5}"
-                            )
-                            check_every = check_every * 1.5
-                            await asyncio.sleep(10)
-                    manager.crawl_tracker.request_parse(url)
-                    if content is not None:
-                        await asyncio.wait_for(parse_queue.put((url,)), timeout=1)
-                    logger.debug("try loop exit")
-                else:
-                    empty_count += 1
-            await asyncio.sleep(check_every)
+                break
+            if url is None:
+                continue
+            if not await downloader.can_fetch(url):
+                logger.info(f"Skipping {url} (not allowed by robots.txt)")
+                await downloader.on_failure(url, "disallowed", 403)
+                await tracker.ack_download(url)
+                continue
+            # Waits out the host's delay holding just this url, the rest of the
+            # frontier stays in redis. Urls whose host is backing off for
+            # longer go back on the frontier.
+            if not await politeness.wait_for_slot(url, FRONTIER_BLOCK_TIMEOUT):
+                await tracker.defer(url)
+                continue
+            logger.debug(f"Download request received for {url} ...")
+            content, status, retry_after = None, None, None
+            started = time.monotonic()
+            try:
+                content, status = await downloader.get_page_elements(url)
+            except Exception as e:
+                logger.error(f"Error downloading page {url}: {e}")
+                status = getattr(e, "status", None)
+                headers = getattr(e, "headers", None) or {}
+                retry_after = parse_retry_after(headers.get("Retry-After"))
+            latency = time.monotonic() - started
+            await politeness.release(url, status, latency, retry_after)
+            await politeness.publish_limits()
+            if content is None:
+                if is_retryable(status) and await tracker.schedule_retry(url):
+                    await tracker.ack_download(url)
+                    continue
+                await downloader.on_failure(url, "error", status)
+                await tracker.ack_download(url)
+                continue
+            await tracker.request_parse(url)
+            # Waits for room when the parsers fall behind
+            await parse_queue.put(url)
+            await tracker.ack_download(url)
+            logger.debug("try loop exit")
         except asyncio.TimeoutError:
             logger.info("Timeout error")
             break
-    logger.info(f"Completed processing {url}, exiting...")
-    await asyncio.sleep(5)
-    return
+    logger.info(f"Download worker {worker_id} exiting...")
 
 
 async def parse_while_true(
-    parse_queue: Queue, write_to_db: bool = True, check_every: float = 0.5
+    parse_queue: Queue | StreamQueue,
+    write_to_db: bool = True,
+    executor: Executor = None,
+    engine: str = PARSE_ENGINE,
+    worker_id: int = 0,
+    downloads_done: asyncio.Event = None,
 ):
     """
     Parse the content of a page, extract urls.
     Pass extracted links back into queue for download
     """
     links = []
-    parser = Parser(manager, write_to_db)
-    empty_count = 0
-    max_empty_count = 25
-    # Continue parsing until 25 cycle have passed without finding any new items
-    # More likely, the max page limit will be reached first, causing the downloader
-    # to exit
-    while True and empty_count <= max_empty_count:
-        if not parse_queue.empty():
-            empty_count = 0
-            url = await asyncio.wait_for(parse_queue.get(), timeout=1)
-            logger.info(f"Request received for {url}, parsing...")
-            link_list = parser.parse(url)
-            for link in link_list:
-                links.append(link)
-            if len(links) == 0:
-                logger.warning(f"No links found for {url}")
+    parser = Parser(manager, write_to_db, executor=executor, engine=engine)
+    # Parse until the downloaders are done and a stop sentinel (None) arrives,
+    # or, reading from a stream, until it has nothing more to give
+    while True:
+        url, entry_id = await next_to_parse(parse_queue, downloads_done)
+        if url is None:
+            if isinstance(parse_queue, Queue):
+                parse_queue.task_done()
+            break
+        logger.info(f"Request received for {url}, parsing...")
+        link_list = await parser.parse(url)
+        for link in link_list:
+            links.append(link)
+        if len(link_list) == 0:
+            logger.warning(f"No links found for {url}")
+        if isinstance(parse_queue, Queue):
             parse_queue.task_done()
         else:
-            empty_count += 1
-        await asyncio.sleep(check_every)
+            await parse_queue.ack(entry_id)
 
-    if empty_count >= max_empty_count:
-        logger.info(f"Queue empty for {max_empty_count} consecutive checks")
-    logger.info("Completed parsing")
+    logger.info(f"Parse worker {worker_id} completed parsing")
     return links
 
 
@@ -137,25 +415,65 @@ def crawl(
     max_pages: int = 100,
     retries: int = 3,
     write_to_db: bool = True,
-    check_every: float = 0.5,
     flush_cache: bool = True,
+    max_connections: int = MAX_CONNECTIONS,
+    delay: float = DEFAULT_CRAWL_DELAY,
+    download_workers: int = DOWNLOAD_WORKERS,
+    parse_workers: int = PARSE_WORKERS,
+    parse_processes: int = PARSE_PROCESSES,
+    parse_engine: str = PARSE_ENGINE,
+    resume: str = None,
+    processes: int = PROCESSES,
+    join: bool = False,
 ):
-    if flush_cache:
-        manager.rdb.flushall()
-    atexit.register(manager.shutdown)
+    if join:
+        if isinstance(manager.rdb, LocalRedis):
+            raise ValueError("Joining a crawl needs the redis backend")
+        run = asyncio.run(joined_run())
+        if not run:
+            raise ValueError("No crawl is running to join")
+        manager.set_run_id(run["run_id"])
+        seed_url, max_pages = run["seed_url"], int(run["max_pages"])
+    if resume is not None:
+        # Carries on w/ the run's data dir, database and checkpoint
+        manager.set_run_id(resume)
+        snapshot = Checkpointer(manager.crawl_tracker, manager.data_dir).load()
+        seed_url = seed_url or (snapshot or {}).get("seed_url")
+    if seed_url is None:
+        raise ValueError("A seed url is needed, unless resuming a checkpointed run")
+    seed_url = canonicalize(seed_url)
     manager.set_seed_url(seed_url)
     manager.set_max_pages(max_pages)
-    manager.retries = retries
-    manager.db_manager.start_run(manager.run_id, seed_url, max_pages)
+    manager.set_max_connections(max_connections)
+    manager.set_crawl_delay(delay)
+    manager.set_retries(retries)
     logger.info(f"Starting crawl for {seed_url}")
-    links = asyncio.run(
-        process_url_while_true(
-            url=seed_url,
-            retries=retries,
-            write_to_db=write_to_db,
-            check_every=check_every,
+    worker_kwargs = {
+        "retries": retries,
+        "write_to_db": write_to_db,
+        "download_workers": download_workers,
+        "parse_workers": parse_workers,
+        "parse_processes": parse_processes,
+        "parse_engine": parse_engine,
+    }
+    if processes > 1 or join:
+        links = crawl_processes(
+            seed_url,
+            processes,
+            flush_cache,
+            resume is not None,
+            join=join,
+            **worker_kwargs,
+        )
+    else:
+        links = asyncio.run(
+            process_url_while_true(
+                url=seed_url,
+                flush_cache=flush_cache,
+                resume=resume is not None,
+                **worker_kwargs,
+            )
         )
-    )
     time.sleep(3)
     return links
 
@@ -166,5 +484,4 @@ if __name__ == "__main__":
         max_pages=10,
         retries=1,
         write_to_db=True,
-        check_every=0.2,
     )
@@ -5,7 +5,7 @@ import shutil
 import sys
 from datetime import datetime
 
-import redis
+from redis import asyncio as redis
 from utils import create_dir
 
 from data import DatabaseManager
@@ -15,8 +15,13 @@ sys.path.append(loc)
 
 from cache import CrawlTracker  # noqa
 from config.configuration import REDIS_HOST  # noqa
-from config.configuration import (DATA_DIR, RDB_FILE, REDIS_PORT,
-                                  SQLITE_DB_FILE, get_logger)
+from config.configuration import (CACHE_BACKEND, DATA_DIR, MAX_CONNECTIONS,
+                                  RDB_FILE, REDIS_PORT, ROBOTS_REDIS_DB,
+                                  SQLITE_DB_FILE, TRANSPORT, get_logger)
+from http_engine import HttpEngine  # noqa
+from local_store import LocalRedis  # noqa
+from politeness import PolitenessScheduler  # noqa
+from robots import RobotsCache  # noqa
 
 logger = get_logger("main")
 logger.info(loc)
@@ -35,6 +40,7 @@ class Manager:
         rdb_file=RDB_FILE,
         run_id=None,
         redis_conn=None,
+        cache_backend: str = CACHE_BACKEND,
     ):
         if run_id is None:
             formatted_datetime = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
@@ -49,11 +55,14 @@ class Manager:
         self.is_async = not debug
         self.db_file = db_file
         self.rdb_file = rdb_file
+        self.cache_backend = cache_backend
         self._init_redis(host, port, redis_conn)
         self._init_dirs()
-        self._init_pubsub()
         self._init_db()
         self._init_cache()
+        self._init_http()
+        self._init_robots()
+        self._init_politeness()
 
         self.visited_urls = set()
         self.to_visit = set()
@@ -69,10 +78,18 @@ class Manager:
         return data
 
     def _init_redis(self, host=None, port=None, redis_conn=None):
-        if redis_conn is None:
+        if redis_conn is None and self.cache_backend == "local":
+            if TRANSPORT == "streams":
+                raise ValueError("The streams transport needs the redis backend")
+            # Crawl state lives in this process, no redis server needed
+            self.rdb = LocalRedis()
+            self.robots_rdb = LocalRedis()
+        elif redis_conn is None:
             self.rdb = redis.Redis(host=host, port=port, decode_responses=False)
+            self.robots_rdb = redis.Redis(host=host, port=port, db=ROBOTS_REDIS_DB)
         else:
             self.rdb = redis_conn
+            self.robots_rdb = redis_conn
 
     def _init_dirs(self):
         self.data_dir = os.path.join(os.path.dirname(__file__), DATA_DIR)
@@ -82,30 +99,38 @@ class Manager:
         self.rdb_path = os.path.join(self.data_dir, self.rdb_file)
         self.sqlite_path = os.path.join(self.data_dir, self.db_file)
 
-    def _init_pubsub(self):
-        url_channel = "db"
-        # Initialize databases
-        url_pubsub = self.rdb.pubsub()
-        url_pubsub.subscribe(url_channel)
-        self.url_pubsub = url_pubsub
-        return url_pubsub
-
     def _init_db(self):
         # Initialize databases
         logger.info(self.data_dir)
-        self.db_manager = DatabaseManager(self.url_pubsub, self.sqlite_path)
+        self.db_manager = DatabaseManager(self.rdb, self.sqlite_path)
 
     def _init_cache(self):
         self.crawl_tracker = CrawlTracker(
-            self.host, self.port, self.seed_url, self.run_id, self.max_pages
+            self.rdb, self.seed_url, self.run_id, self.max_pages, self.retries
         )
 
-    def shutdown(self):
-        """Shutdown the manager"""
+    def _init_http(self, max_connections: int = MAX_CONNECTIONS):
+        self.http_engine = HttpEngine(max_connections=max_connections)
+
+    def _init_robots(self):
+        self.robots_cache = RobotsCache(self.robots_rdb, self.http_engine)
+
+    def _init_politeness(self):
+        self.politeness = PolitenessScheduler(self.robots_cache, self.rdb)
+        # The frontier spaces out hosts by the delays politeness has learnt
+        self.crawl_tracker.frontier.set_delays(self.politeness.known_delay)
+
+    async def shutdown(self):
+        """Shutdown the manager, from within the crawl's event loop"""
         logger.info("Shutting down manager")
-        self.db_manager.shutdown()
-        self.url_pubsub.close()
-        self.save_cache()
+        await self.save_cache()
+
+    def set_run_id(self, run_id: str):
+        """Points the manager at the data of another run, e.g. one to resume"""
+        self.run_id = run_id
+        self.crawl_tracker.run_id = run_id
+        self._init_dirs()
+        self._init_db()
 
     def set_seed_url(self, seed_url: str):
         self.seed_url = seed_url
@@ -115,7 +140,24 @@ class Manager:
         self.max_pages = max_pages
         self.crawl_tracker.max_pages = max_pages
 
-    def save_cache(self):
+    def set_retries(self, retries: int):
+        self.retries = retries
+        self.crawl_tracker.retries = retries
+
+    def set_max_connections(self, max_connections: int):
+        self.http_engine.max_connections = max_connections
+
+    def set_crawl_delay(self, delay: float):
+        self.politeness.default_delay = delay
+
+    async def save_cache(self):
+        """Snapshots redis and copies its dump to the run's data dir"""
+        if isinstance(self.rdb, LocalRedis):
+            return
         logger.info("Saving cache")
-        self.rdb.save()
-        shutil.copy(os.path.dirname(loc) + "/dump.rdb", self.rdb_path)
+        await self.rdb.save()
+        dump = os.path.dirname(loc) + "/dump.rdb"
+        if not os.path.exists(dump):
+            logger.warning(f"No redis dump at {dump}, is redis run from elsewhere?")
+            return
+        shutil.copy(dump, self.rdb_path)
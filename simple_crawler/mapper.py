@@ -2,24 +2,46 @@ from __future__ import annotations
 
 import json
 from collections import defaultdict
+from datetime import datetime, timezone
 
 import bs4  # noqa
 from bs4 import BeautifulSoup  # noqa
-from config.configuration import get_logger
+from config.configuration import (FRESHNESS_WEIGHT, LASTMOD_HALF_LIFE,
+                                  get_logger)
 from downloader import SiteDownloader
+from frontier import DEFAULT_PRIORITY
 from manager import Manager  # noqa
 from utils import parse_url  # noqa
 
 logger = get_logger("mapper")
 
-SITEMAP_FEILDS = ["loc", "priority", "changefreq", "modified"]
+SITEMAP_FEILDS = ["loc", "priority", "changefreq", "modified", "lastmod"]
+# How likely a page is to have changed since it was last crawled, by the
+# changefreq its sitemap gives
+CHANGEFREQ_FRESHNESS = {
+    "always": 1.0,
+    "hourly": 0.9,
+    "daily": 0.75,
+    "weekly": 0.6,
+    "monthly": 0.4,
+    "yearly": 0.2,
+    "never": 0.0,
+}
+
+
+def parse_lastmod(lastmod: str | None) -> datetime | None:
+    """Reads a W3C datetime, e.g. 2024-05-01 or 2024-05-01T12:00:00+00:00"""
+    try:
+        parsed = datetime.fromisoformat(lastmod.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
 
 class SiteMapper:
     def __init__(self, manager: Manager, seed_url: str, write_to_db: bool = True):
         self.manager = manager
         self.seed_url = seed_url
-        self.cache = manager.cache
         self.db_manager = manager.db_manager
         self.crawl_tracker = manager.crawl_tracker
         self.downloader = SiteDownloader(manager, write_to_db)
@@ -33,15 +55,15 @@ class SiteMapper:
         with open(filename, "w", encoding="UTF-8") as f:
             f.write(html)
 
-    def request_page(self, url: str):
+    async def request_page(self, url: str):
         """We allow a direct connection here given the limited
         number of pages we are requesting as part of this process
         """
-        content, status = self.cache.get_cached_response(url)
+        content = await self.crawl_tracker.get_cached_response(url)
         if content is None:
             logger.debug(f"No content cached for {url}")
             try:
-                content, req_status = self.downloader.get_page_elements(
+                content, req_status = await self.downloader.get_page_elements(
                     url, cache_results=False
                 )
                 logger.debug(f"Content received from downloader for {url}")
@@ -61,13 +83,17 @@ class SiteMapper:
 
     # Link Aggregation
     def process_sitemap(
-        self, cur_url: str, soup: BeautifulSoup, index: str = None
+        self, cur_url: str, soup: BeautifulSoup, index: str = None, url=None
     ) -> set[str]:
-        """Extract links from sitemap.xml if available"""
+        """
+        Extract the details of a <url> entry in a sitemap,
+        by default the first one found
+        """
         details = defaultdict(list)
         details["source_url"] = cur_url
         details["index"] = index
-        url = soup.find("url")
+        if url is None:
+            url = soup.find("url")
         if url is not None:
             details["status"] = "Success"
             for field in self.sitemap_feilds:
@@ -78,7 +104,7 @@ class SiteMapper:
                 details[key] = value.text
         return details
 
-    def recurse_sitemap(self, url: str, contents: str, index: str = None):
+    async def recurse_sitemap(self, url: str, contents: str, index: str = None):
         """Recurse through the sitemap"""
         sm_soup = BeautifulSoup(contents, features="lxml")
         try:
@@ -86,31 +112,66 @@ class SiteMapper:
                 links = self.parse_sitemap_index(url, sm_soup)
                 index = url
                 for link in links:
-                    content = self.request_page(link)
+                    content = await self.request_page(link)
                     if content is None:
                         logger.debug(f"No content available for {link}")
                         continue
-                    self.recurse_sitemap(link, content, index)
+                    await self.recurse_sitemap(link, content, index)
             else:
-                details = self.process_sitemap(url, sm_soup)
                 self.sitemap_indexes[index].append(url)
-                self.sitemap_details.append(dict(details))
-                if details.get("status") == "Success":
-                    self.manager.crawl_tracker.add_page_to_visit(details.get("loc"))
-                links = [details.get("loc")]
+                priorities = {}
+                for url_tag in sm_soup.find_all("url"):
+                    details = self.process_sitemap(url, sm_soup, index, url_tag)
+                    self.sitemap_details.append(dict(details))
+                    if details.get("status") == "Success" and details.get("loc"):
+                        priorities[details["loc"]] = self.get_priority(details)
+                # Queue every page in the sitemap at once
+                if priorities:
+                    await self.crawl_tracker.request_downloads(
+                        list(priorities), priorities=priorities
+                    )
 
         except Exception as e:
             logger.error(f"Error parsing {url}: {e}")
             return
 
-    def get_sitemap_urls(self, sitemap_url: str) -> str:
+    def get_priority(self, details: dict) -> float:
+        """
+        The priority the sitemap gives a page, 0.5 if not given. Pages that
+        change often or changed recently are raised, stale pages lowered.
+        """
+        try:
+            priority = float(details.get("priority"))
+        except (TypeError, ValueError):
+            priority = DEFAULT_PRIORITY
+        freshness = self.get_freshness(details)
+        if freshness is None:
+            return priority
+        return priority + FRESHNESS_WEIGHT * (freshness - 0.5)
+
+    def get_freshness(self, details: dict) -> float | None:
+        """
+        How likely a page is to have changed, from 0 to 1, going by its
+        changefreq and lastmod. None if the sitemap gives neither.
+        """
+        scores = []
+        changefreq = (details.get("changefreq") or "").strip().lower()
+        if changefreq in CHANGEFREQ_FRESHNESS:
+            scores.append(CHANGEFREQ_FRESHNESS[changefreq])
+        lastmod = parse_lastmod(details.get("lastmod"))
+        if lastmod is not None:
+            age = (datetime.now(timezone.utc) - lastmod).total_seconds() / 86400
+            scores.append(0.5 ** (max(age, 0) / LASTMOD_HALF_LIFE))
+        return sum(scores) / len(scores) if scores else None
+
+    async def get_sitemap_urls(self, sitemap_url: str) -> str:
         """Process a sitemap index and return all URLs found"""
         logger.info(f"Getting sitemap urls for {sitemap_url}")
-        contents = self.request_page(sitemap_url)
+        contents = await self.request_page(sitemap_url)
         if contents is None:
             logger.warning(f"No sitemap found for {sitemap_url}")
             raise Exception(f"No sitemap found for {sitemap_url}")
-        self.recurse_sitemap(sitemap_url, contents, index="root")
+        await self.recurse_sitemap(sitemap_url, contents, index="root")
         return sitemap_url, self.sitemap_indexes, self.sitemap_details
 
     # Map site specific on end functions
@@ -127,7 +188,7 @@ class SiteMapper:
                 detail, self.manager.run_id, self.manager.seed_url
             )
 
-    def get_sitemap(self):
+    async def get_sitemap(self):
         """
         Queues the download, map_site, and parse_page jobs for the given url.
         Returns the download, map_site, and parse_page jobs.
@@ -135,7 +196,9 @@ class SiteMapper:
         seed_url = self.manager.seed_url
         scheme, netloc, _ = parse_url(seed_url)
         sitemap_source_url = f"{scheme}://{netloc}/sitemap-index.xml"
-        sitemap_urls, _, _ = self.downloader.read_politeness_info(sitemap_source_url)
+        sitemap_urls, _, _ = await self.downloader.read_politeness_info(
+            sitemap_source_url
+        )
         sitemaps = [x for x in sitemap_urls]
 
         if len(sitemaps) == 0:
@@ -143,14 +206,14 @@ class SiteMapper:
         else:
             sitemap_source_url = sitemaps[0]
         try:
-            result = self.get_sitemap_urls(sitemap_source_url)
+            result = await self.get_sitemap_urls(sitemap_source_url)
         except Exception as e:
             logger.error(
                 f"Failed to get sitemap index for {seed_url}: {e}. Trying sitemap.xml"
             )
             sitemap_source_url = f"{scheme}://{netloc}/sitemap.xml"
             try:
-                result = self.get_sitemap_urls(sitemap_source_url)
+                result = await self.get_sitemap_urls(sitemap_source_url)
             except Exception as e:
                 logger.error(f"Sitemap at {sitemap_source_url} not found: {e}")
                 result = (None, [seed_url], {})
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
-from urllib.parse import urljoin, urlparse
+import asyncio
+from concurrent.futures import Executor
+from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
-from config.configuration import get_logger
+from canonical import canonicalize, get_host
+from config.configuration import PARSE_ENGINE, get_logger
+from extractors import EXTRACTORS
 from manager import Manager
 
 # from utils import BaseWorkClass
@@ -13,54 +16,88 @@ from manager import Manager
 logger = get_logger("parser")
 
 
+def extract_links(url: str, content: str, engine: str = PARSE_ENGINE) -> list[str]:
+    """
+    Extract the same-domain links from a page.
+    Kept free of any crawler state so it can run in a worker process.
+    """
+    if not isinstance(content, str):
+        raise TypeError(f"Expected html content for {url}, got {type(content)}")
+    # Looking for <a></a> tags with an href
+    # Future state: look for other linkable tags like <img> or <script>
+    base, hrefs = EXTRACTORS[engine](content)
+    logger.debug(f"Found {len(hrefs)} anchor tags")
+    links = set()
+    page_host = get_host(canonicalize(url))
+    for href in hrefs:
+        try:
+            # Relative links resolve against the page's <base>, if it has one
+            absolute_url = urljoin(urljoin(url, base) if base else url, href)
+            absolute_url = canonicalize(absolute_url)
+        except Exception as e:
+            logger.error(f"Error parsing {url}: {e}")
+            return []
+        # Only include URLs from the same domain
+        if get_host(absolute_url) == page_host:
+            links.add(absolute_url)
+    return list(links)
+
+
 class Parser:
-    def __init__(self, manager: Manager, write_to_db: bool = True, url: str = None):
+    def __init__(
+        self,
+        manager: Manager,
+        write_to_db: bool = True,
+        url: str = None,
+        executor: Executor = None,
+        engine: str = PARSE_ENGINE,
+    ):
+        if engine not in EXTRACTORS:
+            raise ValueError(
+                f"Unknown parse engine {engine}, use one of {list(EXTRACTORS)}"
+            )
         self.url = url
+        self.engine = engine
         self.crawl_tracker = manager.crawl_tracker
         self.write_to_db = write_to_db
+        # When set (e.g. a ProcessPoolExecutor), link extraction runs there
+        # rather than blocking the event loop
+        self.executor = executor
 
-    def get_links_from_content(self, url: str, content: str) -> set[str]:
+    async def get_links_from_content(self, url: str, content: str) -> set[str]:
         """Extract all links from a webpage"""
-        soup = BeautifulSoup(content, "html.parser")
-        links = set()
-        # Looking for <a></a> tags with an href
-        # Future state: look for other linkable tags like <img> or <script>
-        tag_instances = soup.find_all("a", href=True)
-        logger.debug(f"Found {len(tag_instances)} anchor tags")
-        for tag in soup.find_all("a", href=True):
-            try:
-                href = tag["href"]
-                absolute_url = urljoin(url, href)
-            except Exception as e:
-                logger.error(f"Error parsing {url}: {e}")
-                return set()
-            # Only include URLs from the same domain
-            if urlparse(absolute_url).netloc == urlparse(url).netloc:
-                links.add(absolute_url)
-                self.crawl_tracker.request_download(absolute_url)
-        return links
+        if self.executor is None:
+            links = extract_links(url, content, self.engine)
+        else:
+            loop = asyncio.get_running_loop()
+            links = await loop.run_in_executor(
+                self.executor, extract_links, url, content, self.engine
+            )
+        # Queue every link found on the page at once
+        await self.crawl_tracker.request_downloads(links, source_url=url)
+        return set(links)
 
-    def on_success(self, url, links):
-        """Callback for when a job succeeds"""
+    async def on_success(self, url, links):
+        """Callback for when a job succeeds, parsing is the last step for a url"""
         update_map = {"attrs": {"crawl_status": "parsed"}, "linked_urls": links}
-        _ = self.crawl_tracker.update_url(url, update_map)
+        await self.crawl_tracker.update_url(url, update_map, close=True)
 
-    def on_failure(self, url):
+    async def on_failure(self, url):
         """Callback for when a job fails"""
         update_map = {"attrs": {"crawl_status": "error"}}
-        _ = self.crawl_tracker.update_url(url, update_map, close=True)
+        await self.crawl_tracker.update_url(url, update_map, close=True)
 
     # Crawling Logic
-    def parse(self, url, content=None):
+    async def parse(self, url, content=None):
         """Main crawling method"""
         if content is None:
-            content = self.crawl_tracker.get_cached_response(url)
+            content = await self.crawl_tracker.get_cached_response(url)
         links = set()
         logger.debug(f"Parsing {url}")
         try:
-            links = self.get_links_from_content(url, content)
-            self.on_success(url, list(links))
+            links = await self.get_links_from_content(url, content)
+            await self.on_success(url, list(links))
         except Exception as e:
             logger.error(f"Error parsing {url}: {e}")
-            self.on_failure(url)
+            await self.on_failure(url)
         return links
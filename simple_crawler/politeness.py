@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import redis
+from config.configuration import (AIMD_DECREASE, AIMD_INCREASE,
+                                  AIMD_INITIAL_LIMIT, DEFAULT_BACKOFF,
+                                  DEFAULT_CRAWL_DELAY, LATENCY_TOLERANCE,
+                                  LEASE_TIMEOUT, MAX_BACKOFF,
+                                  MAX_CONNECTIONS_PER_HOST, MAX_CRAWL_DELAY,
+                                  get_logger)
+from streams import consumer_name
+
+logger = get_logger("downloader")
+
+THROTTLE_STATUSES = (429, 503)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Reads a Retry-After header, given either in seconds or as an http date"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimits:
+    """
+    Adaptive (AIMD) limit on the number of concurrent requests to each host.
+    Healthy responses raise a host's limit additively, while throttling
+    (429/503, Retry-After) or latency well above the fastest response
+    seen for the host cut it multiplicatively and pause the host.
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = AIMD_INITIAL_LIMIT,
+        max_limit: float = MAX_CONNECTIONS_PER_HOST,
+        increase: float = AIMD_INCREASE,
+        decrease: float = AIMD_DECREASE,
+        latency_tolerance: float = LATENCY_TOLERANCE,
+        default_backoff: float = DEFAULT_BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+    ):
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.default_backoff = default_backoff
+        self.max_backoff = max_backoff
+
+        self.limits = defaultdict(lambda: float(self.initial_limit))
+        self.in_flight = defaultdict(int)
+        self.min_latency = {}
+        self.latency = {}
+        self.throttled = defaultdict(int)
+        self.backoff_until = {}
+
+    def has_capacity(self, host: str) -> bool:
+        return self.in_flight[host] < int(self.limits[host])
+
+    def acquire(self, host: str):
+        self.in_flight[host] += 1
+
+    def release(
+        self,
+        host: str,
+        status: int | None,
+        latency: float,
+        retry_after: float | None = None,
+    ) -> float | None:
+        """
+        Records the outcome of a request and adjusts the host's limit.
+        Returns the seconds to pause the host for, if it is throttling.
+        """
+        self.in_flight[host] = max(0, self.in_flight[host] - 1)
+        limit = self.limits[host]
+        if status in THROTTLE_STATUSES or retry_after is not None:
+            self.throttled[host] += 1
+            backoff = retry_after
+            if backoff is None:
+                backoff = self.default_backoff * 2 ** (self.throttled[host] - 1)
+            backoff = min(backoff, self.max_backoff)
+            self.limits[host] = max(1.0, limit * self.decrease)
+            self.backoff_until[host] = time.monotonic() + backoff
+            logger.warning(
+                f"{host} is throttling ({status}), limit {self.limits[host]:.2f},"
+                f" backing off {backoff:.1f}s"
+            )
+            return backoff
+
+        self.latency[host] = (
+            latency
+            if host not in self.latency
+            else 0.8 * self.latency[host] + 0.2 * latency
+        )
+        self.min_latency[host] = min(latency, self.min_latency.get(host, latency))
+        slow = latency > self.latency_tolerance * self.min_latency[host]
+        if status is None or status >= 500 or slow:
+            self.limits[host] = max(1.0, limit * self.decrease)
+        else:
+            self.throttled[host] = 0
+            self.limits[host] = min(self.max_limit, limit + self.increase / limit)
+
+    def snapshot(self) -> dict:
+        """Current state of each host's limit, for monitoring"""
+        now = time.monotonic()
+        return {
+            host: {
+                "limit": round(limit, 2),
+                "in_flight": self.in_flight[host],
+                "latency": round(self.latency.get(host, 0.0), 3),
+                "backoff": round(max(0.0, self.backoff_until.get(host, now) - now), 1),
+            }
+            for host, limit in self.limits.items()
+        }
+
+
+class PolitenessScheduler:
+    """
+    Spaces out requests to each host using the crawl-delay and request-rate
+    found in its robots.txt (or the configured default).
+    A worker whose url's host isn't ready yet waits on it for a while, holding
+    only that url, so the rest of the frontier stays queued in redis in order.
+    Each host's next request slot, any backoff and its requests in flight are
+    kept in redis, so every process crawling the host shares one budget.
+    """
+
+    def __init__(
+        self,
+        robots_cache,
+        redis_conn: redis.Redis,
+        default_delay: float = DEFAULT_CRAWL_DELAY,
+        max_delay: float = MAX_CRAWL_DELAY,
+        host_limits: HostLimits = None,
+        request_timeout: float = LEASE_TIMEOUT,
+    ):
+        self.robots = robots_cache
+        self.rdb = redis_conn
+        self.default_delay = default_delay
+        self.max_delay = max_delay
+        self.host_limits = host_limits or HostLimits()
+        # Requests in flight stop counting against their host after this
+        # long, in case the worker making them died
+        self.request_timeout = request_timeout
+        self.last_published = 0.0
+        self.delays = {}
+
+    def get_host(self, url: str) -> str:
+        return urlparse(url).netloc
+
+    async def get_delay(self, url: str) -> float:
+        """Seconds to wait between requests to the host serving the url"""
+        host = self.get_host(url)
+        if host not in self.delays:
+            delay = self.default_delay
+            try:
+                _, rrate, crawl_delay = await self.robots.read_politeness_info(url)
+                if crawl_delay is not None:
+                    delay = crawl_delay
+                if rrate is not None and rrate.requests:
+                    delay = max(delay, rrate.seconds / rrate.requests)
+            except Exception as e:
+                logger.warning(f"Unable to read politeness info for {host}: {e}")
+            self.delays[host] = min(delay, self.max_delay)
+            logger.info(f"Requests to {host} spaced {self.delays[host]}s apart")
+        return self.delays[host]
+
+    def slot_key(self, host: str) -> str:
+        """Set while the host's delay or backoff runs out"""
+        return f"politeness:{host}"
+
+    def in_flight_key(self, host: str) -> str:
+        return f"politeness:{host}:in_flight"
+
+    def request_id(self, url: str) -> str:
+        return f"{consumer_name()}:{url}"
+
+    async def reserve(self, url: str) -> bool:
+        """Claims the host's next request slot, if it is open now"""
+        host = self.get_host(url)
+        delay = await self.get_delay(url)
+        in_flight_key, request_id = self.in_flight_key(host), self.request_id(url)
+        now = time.time()
+        # Counted in flight first, so racing workers can't both take the last place
+        pipe = self.rdb.pipeline()
+        pipe.zremrangebyscore(in_flight_key, "-inf", now)
+        pipe.zadd(in_flight_key, {request_id: now + self.request_timeout})
+        pipe.zcard(in_flight_key)
+        *_, in_flight = await pipe.execute()
+        if in_flight <= int(self.host_limits.limits[host]):
+            slot_key = self.slot_key(host)
+            if delay > 0:
+                # Only one worker sets the slot while the host's delay runs
+                claimed = await self.rdb.set(
+                    slot_key, 1, px=max(1, int(delay * 1000)), nx=True
+                )
+            else:
+                claimed = not await self.rdb.exists(slot_key)
+            if claimed:
+                self.host_limits.acquire(host)
+                return True
+        await self.rdb.zrem(in_flight_key, request_id)
+        return False
+
+    async def ready_in(self, url: str) -> float:
+        """Seconds until the host serving the url may next be requested"""
+        host = self.get_host(url)
+        delay = await self.get_delay(url)
+        in_flight_key = self.in_flight_key(host)
+        pipe = self.rdb.pipeline()
+        pipe.pttl(self.slot_key(host))
+        pipe.zremrangebyscore(in_flight_key, "-inf", time.time())
+        pipe.zcard(in_flight_key)
+        ttl, _, in_flight = await pipe.execute()
+        wait = max(0.0, ttl / 1000)
+        if in_flight >= int(self.host_limits.limits[host]):
+            # At its concurrency limit, check back after roughly one response
+            wait = max(wait, self.host_limits.latency.get(host, delay))
+        return wait
+
+    async def wait_for_slot(self, url: str, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for the host's next request slot and claims it.
+        Returns False if the host won't be ready in time.
+        """
+        deadline = time.monotonic() + timeout
+        while not await self.reserve(url):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, max(0.01, await self.ready_in(url))))
+        return True
+
+    def known_delay(self, host: str) -> float:
+        """Delay for a host, w/o fetching its robots.txt if not already known"""
+        return self.delays.get(host, self.default_delay)
+
+    async def release(
+        self,
+        url: str,
+        status: int | None,
+        latency: float,
+        retry_after: float | None = None,
+    ):
+        """Reports the outcome of a reserved request"""
+        host = self.get_host(url)
+        backoff = self.host_limits.release(host, status, latency, retry_after)
+        pipe = self.rdb.pipeline()
+        pipe.zrem(self.in_flight_key(host), self.request_id(url))
+        if backoff:
+            # Pauses the host for every process, not just this one
+            pipe.set(self.slot_key(host), 1, px=int(backoff * 1000))
+        await pipe.execute()
+
+    async def publish_limits(self, every: float = 1.0):
+        """Writes each host's current limits to redis, at most once per interval"""
+        now = time.monotonic()
+        if now - self.last_published < every:
+            return
+        self.last_published = now
+        snapshot = self.host_limits.snapshot()
+        if snapshot:
+            mapping = {host: json.dumps(state) for host, state in snapshot.items()}
+            await self.rdb.hset("host_limits", mapping=mapping)
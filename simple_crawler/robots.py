@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from urllib.parse import urlparse
+
+from config.configuration import (ROBOTS_ERROR_TTL, ROBOTS_TTL, USER_AGENT,
+                                  get_logger)
+from protego import Protego
+
+logger = get_logger("downloader")
+
+DISALLOW_ALL = "User-agent: *\nDisallow: /"
+
+
+class RobotsCache:
+    """
+    Per-host cache of parsed robots.txt rules.
+    Parsed rules are held in memory until their TTL expires, while the raw
+    robots.txt is kept in redis (w/ the same TTL) so later runs can skip the fetch.
+    Concurrent lookups for a host share a single in-flight fetch.
+    Hosts whose robots.txt can't be reached are disallowed for error_ttl,
+    w/o storing anything, and then fetched again.
+    """
+
+    def __init__(
+        self,
+        redis_conn,
+        engine,
+        ttl: int = ROBOTS_TTL,
+        user_agent: str = USER_AGENT,
+        error_ttl: int = ROBOTS_ERROR_TTL,
+    ):
+        self.rdb = redis_conn
+        self.engine = engine
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.user_agent = user_agent
+        self.rules = {}
+        self.pending = {}
+
+    def get_host(self, url: str) -> str:
+        parsed_url = urlparse(url)
+        return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+    async def get_rules(self, url: str) -> Protego:
+        """Returns the parsed robots.txt for the host serving the url"""
+        host = self.get_host(url)
+        cached = self.rules.get(host)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        task = self.pending.get(host)
+        if task is None:
+            task = asyncio.ensure_future(self.load_rules(host))
+            self.pending[host] = task
+            task.add_done_callback(lambda _: self.pending.pop(host, None))
+        # shielded so one cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def load_rules(self, host: str) -> Protego:
+        key = f"robots:{host}"
+        robots_text, ttl = await self.rdb.pipeline().get(key).ttl(key).execute()
+        if robots_text is None:
+            robots_text, reached = await self.download(host)
+            if reached:
+                ttl = self.ttl
+                await self.rdb.set(key, robots_text, ex=ttl)
+            else:
+                ttl = self.error_ttl
+        else:
+            robots_text = robots_text.decode("utf-8")
+            logger.debug(f"Using stored robots.txt for {host}")
+        if ttl < 0:
+            ttl = self.ttl
+        rules = Protego.parse(robots_text)
+        self.rules[host] = (time.monotonic() + ttl, rules)
+        return rules
+
+    async def download(self, host: str) -> tuple[str, bool]:
+        """
+        Fetches robots.txt for a host, along w/ whether it could be reached.
+        As in RFC 9309, missing files (4xx) allow everything, while server
+        errors (5xx) and unreachable hosts disallow everything.
+        """
+        robots_url = f"{host}/robots.txt"
+        try:
+            robots_text, status, _ = await self.engine.fetch(
+                robots_url, raise_for_status=False
+            )
+        except Exception as e:
+            logger.warning(f"Error fetching {robots_url}, disallowing all: {e}")
+            return DISALLOW_ALL, False
+        if status >= 500:
+            logger.warning(f"Error fetching {robots_url} ({status}), disallowing all")
+            return DISALLOW_ALL, False
+        if status >= 400:
+            logger.info(f"No robots.txt found at {robots_url} ({status})")
+            return "", True
+        return robots_text, True
+
+    async def can_fetch(self, url: str) -> bool:
+        """Check if we're allowed to crawl this URL according to robots.txt"""
+        try:
+            rules = await self.get_rules(url)
+            return rules.can_fetch(url, self.user_agent)
+        except Exception as e:
+            logger.warning(f"Error checking robots.txt for {url}: {e}")
+            return True  # If we can't check robots.txt, we probably want to set a reasonable default
+
+    async def read_politeness_info(self, url: str):
+        rules = await self.get_rules(url)
+        sitemap_url = rules.sitemaps
+        rrate = rules.request_rate(self.user_agent)
+        crawl_delay = rules.crawl_delay(self.user_agent)
+        return sitemap_url, rrate, crawl_delay
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import hashlib
+import math
+
+import redis
+from config.configuration import (BLOOM_ERROR_RATE, BLOOM_GROWTH,
+                                  BLOOM_INITIAL_CAPACITY, SEEN_BACKEND,
+                                  get_logger)
+
+logger = get_logger("data")
+
+
+class SeenSet:
+    """
+    Exact record of the urls seen, stored as a redis set of full url strings.
+    Each backend's add_many takes a batch of urls and returns, in order,
+    whether each one was new, in as few round trips as it can.
+    """
+
+    name = "set"
+
+    def __init__(self, redis_conn: redis.Redis, key: str):
+        self.rdb = redis_conn
+        self.key = key
+        # Bytes stored by this process, used when redis can't report its usage
+        self.payload_bytes = 0
+
+    def member(self, url: str):
+        return url
+
+    async def add(self, url: str) -> bool:
+        return (await self.add_many([url]))[0]
+
+    async def add_many(self, urls: list[str]) -> list[bool]:
+        pipe = self.rdb.pipeline()
+        for url in urls:
+            pipe.sadd(self.key, self.member(url))
+        added = [bool(is_new) for is_new in await pipe.execute()]
+        self.payload_bytes += sum(
+            len(self.member(url)) for url, is_new in zip(urls, added) if is_new
+        )
+        return added
+
+    async def count(self) -> int:
+        return await self.rdb.scard(self.key)
+
+    def keys(self) -> list[str]:
+        return [self.key]
+
+    async def memory_usage(self) -> int:
+        """Bytes used in redis, estimated from the payload if redis won't say"""
+        try:
+            pipe = self.rdb.pipeline()
+            for key in self.keys():
+                pipe.memory_usage(key)
+            return sum(usage or 0 for usage in await pipe.execute())
+        except redis.ResponseError:
+            return self.payload_bytes
+
+    async def stats(self) -> dict:
+        """Memory used per url seen, for monitoring"""
+        count = await self.count()
+        memory = await self.memory_usage()
+        return {
+            "backend": self.name,
+            "count": count,
+            "bytes": memory,
+            "bytes_per_url": round(memory / count, 2) if count else 0.0,
+        }
+
+
+class HashedSeenSet(SeenSet):
+    """
+    Stores a 64-bit hash of each url rather than the url itself.
+    Collisions are possible but, at 2^-64 per pair, vanishingly rare.
+    """
+
+    name = "hash"
+
+    def member(self, url: str) -> bytes:
+        return hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+
+
+class BloomSeenSet(SeenSet):
+    """
+    Scalable Bloom filter stored as a series of redis bitmaps.
+    Each bitmap ("slice") holds a fixed number of urls at a false positive
+    rate tighter than the last, and a new, larger slice is started when the
+    current one fills up, so the overall rate stays under error_rate.
+    A false positive means a new url is mistaken for one already seen.
+    """
+
+    name = "bloom"
+    tightening = 0.5
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        key: str,
+        error_rate: float = BLOOM_ERROR_RATE,
+        initial_capacity: int = BLOOM_INITIAL_CAPACITY,
+        growth: int = BLOOM_GROWTH,
+    ):
+        super().__init__(redis_conn, key)
+        self.error_rate = error_rate
+        self.initial_capacity = initial_capacity
+        self.growth = growth
+        self.slices = 1
+
+    def slice_key(self, index: int) -> str:
+        return f"{self.key}:bloom:{index}"
+
+    def slice_params(self, index: int) -> tuple[int, int, int]:
+        """Capacity, bit count and hash count of a slice"""
+        capacity = self.initial_capacity * self.growth**index
+        # Slice error rates form a geometric series summing to error_rate
+        error_rate = self.error_rate * (1 - self.tightening) * self.tightening**index
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = math.ceil(-math.log2(error_rate))
+        return capacity, bits, hashes
+
+    def offsets(self, url: str, index: int) -> list[int]:
+        _, bits, hashes = self.slice_params(index)
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+        # Double hashing, k positions from two 64-bit hashes
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % bits for i in range(hashes)]
+
+    async def add_many(self, urls: list[str]) -> list[bool]:
+        # Learn of slices started by other workers
+        grown = await self.rdb.get(f"{self.key}:grown")
+        self.slices = max(self.slices, 1 + int(grown or 0))
+        active = self.slices - 1
+
+        seen = [False] * len(urls)
+        if active:
+            # Urls found in any full slice have been seen already
+            pipe = self.rdb.pipeline()
+            for url in urls:
+                for index in range(active):
+                    for offset in self.offsets(url, index):
+                        pipe.getbit(self.slice_key(index), offset)
+            bits = iter(await pipe.execute())
+            for i, url in enumerate(urls):
+                for index in range(active):
+                    found = all([next(bits) for _ in self.offsets(url, index)])
+                    seen[i] = seen[i] or found
+
+        # The bits' previous values say whether a url was already in the
+        # active slice, including earlier in this same batch
+        pipe = self.rdb.pipeline()
+        for url, was_seen in zip(urls, seen):
+            if not was_seen:
+                for offset in self.offsets(url, active):
+                    pipe.setbit(self.slice_key(active), offset, 1)
+        bits = iter(await pipe.execute())
+        added = []
+        for url, was_seen in zip(urls, seen):
+            if was_seen:
+                added.append(False)
+                continue
+            previous = [next(bits) for _ in self.offsets(url, active)]
+            added.append(not all(previous))
+
+        if any(added):
+            new_urls = sum(added)
+            count = await self.rdb.hincrby(f"{self.key}:counts", active, new_urls)
+            capacity, _, _ = self.slice_params(active)
+            # Only the batch that fills the slice starts the next one
+            if count >= capacity > count - new_urls:
+                self.slices = 1 + await self.rdb.incr(f"{self.key}:grown")
+                logger.info(f"Bloom filter {self.key} grown to {self.slices} slices")
+        self.payload_bytes = sum(
+            self.slice_params(index)[1] // 8 for index in range(self.slices)
+        )
+        return added
+
+    async def count(self) -> int:
+        counts = await self.rdb.hvals(f"{self.key}:counts")
+        return sum(int(count) for count in counts)
+
+    def keys(self) -> list[str]:
+        return [self.slice_key(index) for index in range(self.slices)]
+
+
+SEEN_BACKENDS = {
+    "set": SeenSet,
+    "hash": HashedSeenSet,
+    "bloom": BloomSeenSet,
+}
+
+
+def make_seen_set(redis_conn: redis.Redis, key: str, backend: str = SEEN_BACKEND):
+    if backend not in SEEN_BACKENDS:
+        raise ValueError(
+            f"Unknown seen backend {backend}, use one of {list(SEEN_BACKENDS)}"
+        )
+    return SEEN_BACKENDS[backend](redis_conn, key)
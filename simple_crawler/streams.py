@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import socket
+import time
+
+import redis
+from config.configuration import STREAM_CLAIM_IDLE, STREAM_GROUP, get_logger
+
+logger = get_logger("data")
+
+HOSTNAME = socket.gethostname()
+
+
+def consumer_name() -> str:
+    """Names this process within a consumer group"""
+    return f"{HOSTNAME}:{os.getpid()}"
+
+
+class StreamQueue:
+    """
+    Work queue for one crawl stage on a redis stream read through a consumer
+    group. Each message goes to a single consumer, and stays pending until
+    that consumer acknowledges it. Messages left pending longer than
+    claim_idle seconds, e.g. by a worker that crashed, are claimed by
+    another consumer, so delivery is at-least-once.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        stream: str,
+        group: str = STREAM_GROUP,
+        consumer: str = None,
+        claim_idle: float = STREAM_CLAIM_IDLE,
+    ):
+        self.rdb = redis_conn
+        self.stream = stream
+        self.group = group
+        # Unless given, named as it's used, so each forked process is a
+        # consumer of its own rather than the one that created the queue
+        self._consumer = consumer
+        self.claim_idle = claim_idle
+        self.group_ready = False
+        self.next_claim = 0.0
+
+    @property
+    def consumer(self) -> str:
+        return self._consumer or consumer_name()
+
+    async def ensure_group(self):
+        if self.group_ready:
+            return
+        try:
+            await self.rdb.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.group_ready = True
+
+    def add(self, pipe, message: str):
+        """Queues a message onto the caller's pipeline"""
+        pipe.xadd(self.stream, {"data": message})
+
+    async def put(self, message: str):
+        await self.rdb.xadd(self.stream, {"data": message})
+
+    async def claim_stale(self, count: int) -> list:
+        """Takes over messages another consumer has left unacknowledged"""
+        if time.monotonic() < self.next_claim:
+            return []
+        self.next_claim = time.monotonic() + self.claim_idle / 4
+        _, claimed, *_ = await self.rdb.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=int(self.claim_idle * 1000),
+            start_id="0-0",
+            count=count,
+        )
+        # Messages deleted while pending come back empty
+        claimed = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        if claimed:
+            logger.warning(f"Claimed {len(claimed)} stale messages on {self.stream}")
+        return claimed
+
+    async def get(self, count: int = 1, timeout: float = None) -> list:
+        """
+        Returns up to count (message id, message) pairs, blocking
+        for up to timeout seconds if none are waiting
+        """
+        await self.ensure_group()
+        entries = await self.claim_stale(count)
+        if not entries:
+            block = int(timeout * 1000) if timeout and timeout > 0 else None
+            response = await self.rdb.xreadgroup(
+                self.group, self.consumer, {self.stream: ">"}, count=count, block=block
+            )
+            entries = response[0][1] if response else []
+        return [
+            (entry_id, fields[b"data"].decode("utf-8")) for entry_id, fields in entries
+        ]
+
+    async def ack(self, *entry_ids):
+        """Marks messages as handled, they are then dropped from the stream"""
+        if not entry_ids:
+            return
+        pipe = self.rdb.pipeline()
+        pipe.xack(self.stream, self.group, *entry_ids)
+        pipe.xdel(self.stream, *entry_ids)
+        await pipe.execute()
+
+    async def pending(self) -> int:
+        await self.ensure_group()
+        return (await self.rdb.xpending(self.stream, self.group))["pending"]
@@ -1,9 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 import sys
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 
 from fakeredis import FakeAsyncRedis, FakeRedis
 import pytest
@@ -64,21 +65,13 @@ class MockManager(Manager):
 
     def _init_redis(self, host=None, port=None, redis_conn=None):
         self.rdb = redis_conn
+        self.robots_rdb = redis_conn
 
     def _init_cache(self):
         self.cache = Mock()
-        self.crawl_tracker = Mock()
+        self.crawl_tracker = AsyncMock()
 
-    def _init_pubsub(self):
-        url_channel = "db"
-        # Initialize databases
-        # url_pubsub = self.rdb.pubsub()
-        url_pubsub = Mock()
-        url_pubsub.subscribe(url_channel)
-        self.url_pubsub = url_pubsub
-        return url_pubsub
-
-    def save_cache(self):
+    async def save_cache(self):
         pass
 
 
@@ -93,4 +86,4 @@ def manager(redis_conn):
         redis_conn=redis_conn,
     )
     yield manager
-    manager.shutdown()
+    asyncio.run(manager.shutdown())
@@ -1,16 +1,26 @@
 from __future__ import annotations
 
 import pytest
+import asyncio
 import json
-from unittest.mock import AsyncMock
+import time
+from unittest.mock import AsyncMock, patch
 
 from simple_crawler.utils import deserialize
 from simple_crawler.cache import CrawlStatus, CrawlTracker
+from simple_crawler.local_store import LocalRedis
 
 
-@pytest.fixture
-def crawl_tracker(async_redis_conn):
-    return CrawlTracker(async_redis_conn, "http://example.com", "test_run", 100)
+@pytest.fixture(scope="module")
+def local_redis():
+    # Shared across the module's tests, as the fake redis server is
+    return LocalRedis()
+
+
+@pytest.fixture(params=["redis", "local"])
+def crawl_tracker(request, async_redis_conn, local_redis):
+    conn = async_redis_conn if request.param == "redis" else local_redis
+    return CrawlTracker(conn, "http://example.com", "test_run", 100)
 
 
 @pytest.fixture
@@ -106,6 +116,41 @@ async def test_get_page_to_visit(crawl_tracker, sample_url):
     assert next_url is None
 
 
+@pytest.mark.asyncio
+async def test_request_downloads(crawl_tracker, sample_linked_urls):
+    """Test a page's links are de-duplicated and queued in two round trips"""
+    await crawl_tracker.rdb.delete("to_visit", "download_requests", "outstanding")
+    await crawl_tracker.request_download(sample_linked_urls[0])
+
+    pipeline = crawl_tracker.rdb.pipeline
+    with patch.object(crawl_tracker.rdb, "pipeline", wraps=pipeline) as pipelines:
+        new_urls = await crawl_tracker.request_downloads(
+            sample_linked_urls + sample_linked_urls
+        )
+    assert new_urls == sample_linked_urls[1:]
+    assert pipelines.call_count == 2
+
+    queued = await crawl_tracker.rdb.lrange("to_visit", 0, -1)
+    assert sorted(url.decode("utf-8") for url in queued) == sorted(sample_linked_urls)
+    assert int(await crawl_tracker.rdb.get("outstanding")) == 3
+    attrs = await crawl_tracker.rdb.hgetall(f"urls:{sample_linked_urls[2]}:attrs")
+    assert attrs[b"run_id"] == crawl_tracker.run_id.encode("utf-8")
+
+    assert await crawl_tracker.request_downloads(sample_linked_urls) == []
+    await crawl_tracker.rdb.delete("to_visit")
+
+
+@pytest.mark.asyncio
+async def test_request_downloads_canonical(crawl_tracker):
+    """Test equivalent spellings of a url are only queued once"""
+    await crawl_tracker.rdb.delete("to_visit", "download_requests", "outstanding")
+    new_urls = await crawl_tracker.request_downloads(
+        ["HTTP://Example.com:80/a?b=1&a=2#top", "http://example.com/a?a=2&b=1"]
+    )
+    assert new_urls == ["http://example.com/a?a=2&b=1"]
+    await crawl_tracker.rdb.delete("to_visit")
+
+
 @pytest.mark.asyncio
 async def test_request_parse(crawl_tracker, sample_url):
     """Test requesting a URL for parsing"""
@@ -149,10 +194,18 @@ async def test_update_url(crawl_tracker, sample_url):
     await crawl_tracker.rdb.delete(key)
 
 
+async def request_url(tracker, url):
+    """Requests a url afresh, so it's in flight until closed"""
+    await tracker.rdb.delete(
+        "download_requests", "in_flight", "completed_pages", "outstanding"
+    )
+    await tracker.request_download(url)
+
+
 @pytest.mark.asyncio
 async def test_close_url(crawl_tracker, sample_url):
     """Test closing a URL and publishing its data"""
-
+    await request_url(crawl_tracker, sample_url)
     crawl_tracker.rdb.publish = AsyncMock()
     crawl_tracker.rdb.publish.return_value = True
 
@@ -161,22 +214,34 @@ async def test_close_url(crawl_tracker, sample_url):
     completed_pages = await crawl_tracker.rdb.get("completed_pages")
     assert int(completed_pages) == 1
 
-    await crawl_tracker.close_url(sample_url)
-
-    completed_pages = await crawl_tracker.rdb.get("completed_pages")
-    assert int(completed_pages) == 2
-
     # Verify publish was called with correct data
     key = f"urls:{sample_url}"
     assert crawl_tracker.rdb.publish.call_args[0] == (
-        "db",
+        "writer",
         json.dumps({"key": key, "table_name": "urls"}),
     )
 
 
+@pytest.mark.asyncio
+async def test_close_url_twice(crawl_tracker, sample_url):
+    """Test a url delivered, and so closed, twice only counts once"""
+    await request_url(crawl_tracker, sample_url)
+    await crawl_tracker.request_download(f"{sample_url}other")
+    crawl_tracker.rdb.publish = AsyncMock()
+
+    await crawl_tracker.close_url(sample_url)
+    await crawl_tracker.close_url(sample_url)
+
+    assert int(await crawl_tracker.rdb.get("completed_pages")) == 1
+    # The other url is still outstanding, the crawl isn't over
+    assert int(await crawl_tracker.rdb.get("outstanding")) == 1
+    assert crawl_tracker.rdb.publish.await_count == 1
+
+
 @pytest.mark.asyncio
 async def test_max_pages_limit(crawl_tracker, sample_url):
     """Test that crawler stops when max pages is reached"""
+    await request_url(crawl_tracker, sample_url)
     # Set max pages to 1
     crawl_tracker.max_pages = 1
 
@@ -207,3 +272,104 @@ async def test_url_cache_get_cached_response(
 
     content = await crawl_tracker.get_cached_response(sample_url)
     assert content == sample_html_content
+
+
+@pytest.mark.asyncio
+async def test_retry_delay_backoff(crawl_tracker):
+    """Test retry delays grow exponentially, stay jittered and are capped"""
+    for attempt in range(1, 6):
+        capped = 2 ** (attempt - 1)
+        assert capped / 2 <= crawl_tracker.retry_delay(attempt) <= capped
+    assert crawl_tracker.retry_delay(50) <= 300
+
+
+@pytest.mark.asyncio
+async def test_schedule_retry(crawl_tracker, sample_url):
+    """Test failed urls are delayed on the retry queue until retries run out"""
+    await crawl_tracker.rdb.delete("retry_queue", "retry_attempts")
+    crawl_tracker.retries = 2
+
+    assert await crawl_tracker.schedule_retry(sample_url) is True
+    score = await crawl_tracker.rdb.zscore("retry_queue", sample_url)
+    assert score > time.time()
+    assert await crawl_tracker.schedule_retry(sample_url) is True
+    assert await crawl_tracker.schedule_retry(sample_url) is False
+
+
+@pytest.mark.asyncio
+async def test_requeue_due_retries(crawl_tracker, sample_url):
+    """Test only retries whose backoff has passed return to the frontier"""
+    await crawl_tracker.rdb.delete("retry_queue", "to_visit")
+    later_url = "http://example.com/later"
+    await crawl_tracker.rdb.zadd(
+        "retry_queue", {sample_url: time.time() - 1, later_url: time.time() + 60}
+    )
+
+    requeued = await crawl_tracker.requeue_due_retries()
+    assert requeued == [sample_url]
+    remaining = await crawl_tracker.rdb.zrange("retry_queue", 0, -1)
+    assert remaining == [later_url.encode("utf-8")]
+
+    # Due retries are picked up by the next frontier pop
+    await crawl_tracker.rdb.zadd("retry_queue", {later_url: time.time() - 1})
+    crawl_tracker.next_retry_due = 0
+    assert await crawl_tracker.get_page_to_visit() == sample_url
+    assert await crawl_tracker.get_page_to_visit() == later_url
+
+
+@pytest.mark.asyncio
+async def test_dead_letter(crawl_tracker, sample_url):
+    """Test exhausted urls are recorded on the dead letter list"""
+    await crawl_tracker.rdb.delete("dead_letter", "retry_attempts")
+    await crawl_tracker.schedule_retry(sample_url)
+    await crawl_tracker.dead_letter(sample_url, "error", 503)
+
+    entry = json.loads(await crawl_tracker.rdb.lpop("dead_letter"))
+    assert entry == {
+        "url": sample_url,
+        "crawl_status": "error",
+        "status_code": 503,
+        "attempts": 1,
+    }
+    assert await crawl_tracker.rdb.hget("retry_attempts", sample_url) is None
+
+
+@pytest.mark.asyncio
+async def test_get_page_to_visit_blocks(crawl_tracker, sample_url):
+    """Test a blocking pop wakes as soon as a url is requested"""
+    await crawl_tracker.rdb.delete("to_visit", "download_requests")
+
+    async def request_later():
+        await asyncio.sleep(0.05)
+        await crawl_tracker.request_download(sample_url)
+
+    task = asyncio.create_task(request_later())
+    started = time.monotonic()
+    assert await crawl_tracker.get_page_to_visit(timeout=2) == sample_url
+    assert time.monotonic() - started < 1
+    await task
+
+    assert await crawl_tracker.get_page_to_visit(timeout=0.05) is None
+
+
+@pytest.mark.asyncio
+async def test_outstanding_urls_signal_exit(crawl_tracker, sample_url):
+    """Test the crawl ends once every requested url has been closed"""
+    await crawl_tracker.rdb.delete("to_visit", "download_requests", "outstanding")
+    other_url = "http://example.com/other"
+    await crawl_tracker.request_download(sample_url)
+    await crawl_tracker.request_download(other_url)
+    assert int(await crawl_tracker.rdb.get("outstanding")) == 2
+
+    assert await crawl_tracker.get_page_to_visit() == other_url
+    await crawl_tracker.close_url(other_url)
+    assert await crawl_tracker.get_page_to_visit() == sample_url
+    assert await crawl_tracker.get_page_to_visit() is None
+
+    await crawl_tracker.close_url(sample_url)
+    # Every worker sees the exit signal, not just the first to pop it
+    assert await crawl_tracker.get_page_to_visit(timeout=1) == "exit"
+    assert await crawl_tracker.get_page_to_visit(timeout=1) == "exit"
+
+    await crawl_tracker.clear_exit()
+    assert await crawl_tracker.get_page_to_visit() is None
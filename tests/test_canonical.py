@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import pytest
+
+from simple_crawler.canonical import canonicalize, get_host
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("HTTPS://Example.COM:443/a#x", "https://example.com/a"),
+        ("http://example.com:80", "http://example.com/"),
+        ("http://example.com:8080/a", "http://example.com:8080/a"),
+        ("https://example.com/a?b=1&a=2", "https://example.com/a?a=2&b=1"),
+        (
+            "https://example.com/%7euser/%2f%e2%82%ac",
+            "https://example.com/~user/%2F%E2%82%AC",
+        ),
+        ("https://example.com/über path", "https://example.com/%C3%BCber%20path"),
+        ("https://example.com/?q=1&utm_source=x&gclid=y", "https://example.com/?q=1"),
+        ("http://user@[::1]:80/x", "http://user@[::1]/x"),
+        ("mailto:someone@example.com", "mailto:someone@example.com"),
+    ],
+)
+def test_canonicalize(url, expected):
+    assert canonicalize(url) == expected
+
+
+def test_equivalent_urls_share_a_form():
+    """Test urls differing only in fragment or query order are crawled once"""
+    urls = ["https://example.com/a", "https://example.com/a#x"]
+    urls += ["https://example.com/a?b=1&a=2", "https://example.com/a?a=2&b=1"]
+    assert len({canonicalize(url) for url in urls}) == 2
+
+
+def test_options():
+    """Test query sorting and tracking param removal can be turned off"""
+    url = "https://example.com/a?b=1&utm_medium=email&a=2"
+    assert canonicalize(url, sort_query=False, drop_tracking=False) == url
+    assert canonicalize(url, sort_query=False) == "https://example.com/a?b=1&a=2"
+
+
+def test_memoized():
+    """Test repeated urls are served from the memo"""
+    canonicalize.cache_clear()
+    get_host.cache_clear()
+    for _ in range(3):
+        canonicalize("https://Example.com/memo")
+        assert get_host("https://Example.com/memo") == "example.com"
+    assert canonicalize.cache_info().hits == 2
+    assert get_host.cache_info().hits == 2
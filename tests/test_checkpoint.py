@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+
+import pytest
+
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.checkpoint import Checkpointer
+from simple_crawler.data import DatabaseManager
+
+SEED = "http://example.com/"
+
+
+@pytest.fixture(params=["list", "priority", "host"])
+def crawl_tracker(request, async_redis_conn):
+    return CrawlTracker(async_redis_conn, SEED, "test_run", 100, frontier=request.param)
+
+
+async def clear(tracker):
+    await tracker.rdb.flushdb()
+
+
+@pytest.mark.asyncio
+async def test_snapshot(crawl_tracker):
+    """Test snapshots hold every url queued, being crawled or awaiting retry"""
+    await clear(crawl_tracker)
+    # On separate hosts, so the host frontier doesn't hold any back
+    urls = [f"http://{host}.com/" for host in ("a", "b", "c", "d")]
+    await crawl_tracker.request_downloads(urls)
+
+    crawling = await crawl_tracker.get_page_to_visit()
+    retrying = await crawl_tracker.get_page_to_visit()
+    await crawl_tracker.schedule_retry(retrying)
+    closed = await crawl_tracker.get_page_to_visit()
+    await crawl_tracker.close_url(closed)
+
+    snapshot = await crawl_tracker.snapshot()
+    assert snapshot["completed_pages"] == 1
+    assert snapshot["seed_url"] == SEED
+    assert sorted(snapshot["queued"]) == sorted(set(urls) - {closed})
+    assert crawling in snapshot["queued"]
+    assert retrying in snapshot["queued"]
+
+
+@pytest.mark.asyncio
+async def test_restore(crawl_tracker):
+    """Test a restored crawl skips pages already done and queues the rest"""
+    await clear(crawl_tracker)
+    done = ["http://a.com/", "http://b.com/"]
+    queued = ["http://b.com/", "http://c.com/", "HTTP://D.com:80/#top"]
+
+    restored = await crawl_tracker.restore(done, queued, completed_pages=3)
+    assert restored == ["http://c.com/", "http://d.com/"]
+    assert int(await crawl_tracker.rdb.get("outstanding")) == 2
+    assert int(await crawl_tracker.rdb.get("completed_pages")) == 3
+
+    # Pages already done are never requested again
+    assert await crawl_tracker.request_downloads(done) == []
+    assert await crawl_tracker.request_parse(done[0]) is False
+
+    popped = {await crawl_tracker.get_page_to_visit() for _ in range(2)}
+    assert popped == set(restored)
+    assert await crawl_tracker.get_page_to_visit() is None
+
+
+@pytest.mark.asyncio
+async def test_save_and_load(crawl_tracker, tmp_path):
+    """Test checkpoints are written to the run's data dir and read back"""
+    await clear(crawl_tracker)
+    checkpointer = Checkpointer(crawl_tracker, str(tmp_path))
+    assert checkpointer.load() is None
+
+    await crawl_tracker.request_download(f"{SEED}a")
+    saved = await checkpointer.save()
+    assert checkpointer.load() == saved
+    assert saved["queued"] == [f"{SEED}a"]
+    assert not (tmp_path / "checkpoint.json.tmp").exists()
+
+
+@pytest.mark.asyncio
+async def test_crawled_urls(tmp_path):
+    """Test the urls already written for a run are read back w/ their links"""
+    db_file = str(tmp_path / "sqlite.db")
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE urls (url TEXT, linked_urls BLOB, run_id TEXT)")
+    conn.executemany(
+        "INSERT INTO urls VALUES (?, ?, ?)",
+        [
+            (f"{SEED}a", json.dumps([f"{SEED}b"]), "test_run"),
+            (f"{SEED}b", None, "test_run"),
+            (f"{SEED}c", "[]", "other_run"),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    db_manager = DatabaseManager(None, db_file)
+    crawled = await db_manager.crawled_urls("test_run")
+    assert crawled == {f"{SEED}a": [f"{SEED}b"], f"{SEED}b": []}
+
+    db_manager = DatabaseManager(None, str(tmp_path / "missing.db"))
+    assert await db_manager.crawled_urls("test_run") == {}
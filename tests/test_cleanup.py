@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from unittest.mock import AsyncMock
+
+import pytest
+
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.data import BaseTable, BulkDBWriter
+from simple_crawler.local_store import LocalRedis
+
+SEED = "http://example.com/"
+URL = f"{SEED}a"
+URL_KEYS = [f"urls:{URL}:attrs", f"urls:{URL}:linked_urls", f"urls:{URL}:content", URL]
+
+
+@pytest.fixture
+def crawl_tracker(async_redis_conn):
+    return CrawlTracker(async_redis_conn, SEED, "test_run", 100)
+
+
+@pytest.fixture
+def urls_table(tmp_path):
+    return BaseTable(
+        str(tmp_path / "sqlite.db"),
+        "urls",
+        ["id", "seed_url", "url", "content", "crawl_status", "run_id", "linked_urls"],
+        ["INTEGER PRIMARY KEY AUTOINCREMENT"] + ["TEXT"] * 6,
+        "id",
+        ["id"],
+    )
+
+
+async def crawl_page(tracker):
+    """Leaves a crawled page's keys in redis, as the workers do"""
+    await tracker.rdb.delete(*URL_KEYS)
+    await tracker.init_url_data(URL)
+    await tracker.update_url(
+        URL, {"content": "<html></html>", "linked_urls": [f"{SEED}b"]}
+    )
+
+
+@pytest.mark.asyncio
+async def test_keys_removed_once_written(crawl_tracker, urls_table):
+    """Test a url's keys are dropped from redis once its row is committed"""
+    await crawl_page(crawl_tracker)
+    await urls_table.db_operation(operation="create")
+    writer = BulkDBWriter({"urls": urls_table}, crawl_tracker.rdb, key_ttl=0)
+
+    await writer.store_data("urls", key=f"urls:{URL}")
+    assert await crawl_tracker.rdb.exists(*URL_KEYS) == len(URL_KEYS)
+    await writer.flush_data("urls")
+    assert await crawl_tracker.rdb.exists(*URL_KEYS) == 0
+
+    conn = sqlite3.connect(urls_table.db_file)
+    rows = conn.execute("SELECT url, content, linked_urls, run_id FROM urls").fetchall()
+    conn.close()
+    assert rows == [(URL, "<html></html>", json.dumps([f"{SEED}b"]), "test_run")]
+
+    # Redelivered messages for urls already written are skipped
+    await writer.store_data("urls", key=f"urls:{URL}")
+    assert writer.to_write["urls"] == []
+
+
+@pytest.mark.asyncio
+async def test_keys_expire_once_written(crawl_tracker, urls_table):
+    """Test a url's keys are left to expire when given a ttl"""
+    await crawl_page(crawl_tracker)
+    await urls_table.db_operation(operation="create")
+    writer = BulkDBWriter({"urls": urls_table}, crawl_tracker.rdb, key_ttl=60)
+
+    await writer.store_data("urls", key=f"urls:{URL}")
+    await writer.flush_data("all")
+    for key in URL_KEYS:
+        assert 0 < await crawl_tracker.rdb.ttl(key) <= 60
+
+
+@pytest.mark.asyncio
+async def test_keys_kept_when_not_written(crawl_tracker, urls_table):
+    """Test a url's keys stay in redis if its row couldn't be committed"""
+    await crawl_page(crawl_tracker)
+    urls_table.db_operation = AsyncMock(return_value=False)
+    writer = BulkDBWriter({"urls": urls_table}, crawl_tracker.rdb, key_ttl=0)
+
+    await writer.store_data("urls", key=f"urls:{URL}")
+    assert await writer.flush_data("urls") is False
+    assert await crawl_tracker.rdb.exists(*URL_KEYS) == len(URL_KEYS)
+    assert writer.to_clean["urls"] == []
+
+
+@pytest.mark.asyncio
+async def test_memory_high_water_mark():
+    """Test the most memory used during a run is kept, not the latest"""
+    tracker = CrawlTracker(LocalRedis(), SEED, "test_run", 100)
+    await tracker.rdb.set(f"urls:{URL}:content", "x" * 1000)
+    peak = await tracker.record_memory()
+    assert peak > 1000
+
+    await tracker.rdb.delete(f"urls:{URL}:content")
+    assert await tracker.record_memory() < peak
+    assert await tracker.memory_peak() == peak
+
+
+@pytest.mark.asyncio
+async def test_memory_unreported(crawl_tracker):
+    """Test servers w/o INFO, like fakeredis, leave the high-water mark unset"""
+    await crawl_tracker.rdb.delete("memory_peak")
+    assert await crawl_tracker.record_memory() is None
+    assert await crawl_tracker.memory_peak() is None
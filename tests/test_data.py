@@ -10,7 +10,9 @@ import pytest
 from redis import asyncio as redis_async
 
 from simple_crawler.cache import CrawlTracker
-from simple_crawler.data import BaseTable, BulkDBWriter, DatabaseManager
+from simple_crawler.data import (BaseTable, BulkDBWriter, ContentsTable,
+                                  DatabaseManager, LinksTable,
+                                  SQLiteConnection)
 
 
 @pytest.fixture
@@ -99,14 +101,12 @@ def mock_redis():
 
 @pytest.fixture
 def mock_aiosqlite():
-    with patch("aiosqlite.connect") as mock:
-        mock = AsyncMock()
-        mock_conn = AsyncMock()
-        mock_exit = AsyncMock()
+    with patch.object(SQLiteConnection, "connect", new_callable=AsyncMock) as mock:
+        mock_conn = mock.return_value
         mock_conn.executemany.return_value = True
-        mock.return_value.__aenter__.return_value = mock_conn
         yield mock
-        mock.return_value.__aexit__.return_value = mock_exit
+    # Connections to the mocked db aren't kept for later tests
+    SQLiteConnection.open_connections.clear()
 
 
 class MockPubSub:
@@ -170,6 +170,125 @@ class TestBaseTable:
         assert params[0] == ("test1", "value1")
         assert params[1] == ("test2", "value2")
 
+    @pytest.mark.asyncio
+    async def test_build_upsert_string(self, base_table: BaseTable):
+        data = [{"id": 1, "name": "test1", "value": "value1"}]
+        base_table.unique_keys = ["name"]
+        query, params = await base_table.build_upsert_string(data)
+        assert query == (
+            "INSERT INTO test_table (name,value) VALUES (?,?)"
+            " ON CONFLICT(name) DO UPDATE SET value = excluded.value"
+        )
+        assert params == [("test1", "value1")]
+
+    @pytest.mark.asyncio
+    async def test_build_update_string(self, base_table: BaseTable):
+        data = [{"name": "test1", "value": "value1"}]
+        base_table.unique_keys = ["name"]
+        query, params = await base_table.build_update_string(data)
+        assert "SET value = ?" in query
+        assert "WHERE name = ?" in query
+        assert params == [("value1", "test1")]
+
+    @pytest.mark.asyncio
+    async def test_upsert_updates_rows(self, tmp_path):
+        table = BaseTable(
+            str(tmp_path / "test.db"),
+            "urls",
+            ["id", "run_id", "url", "crawl_status"],
+            ["INTEGER PRIMARY KEY AUTOINCREMENT", "TEXT", "TEXT", "TEXT"],
+            "id",
+            ["run_id", "url"],
+        )
+        await table.db_operation(operation="create")
+        rows = [
+            {"run_id": "1", "url": "a", "crawl_status": "1"},
+            {"run_id": "1", "url": "b", "crawl_status": "1"},
+        ]
+        assert await table.db_operation(rows, "upsert") is True
+        # Re-crawled, and crawled again by another run
+        rows = [
+            {"run_id": "1", "url": "a", "crawl_status": "3"},
+            {"run_id": "2", "url": "a", "crawl_status": "3"},
+        ]
+        assert await table.db_operation(rows, "upsert") is True
+
+        connection = SQLiteConnection.get(table.db_file)
+        query = "SELECT run_id, url, crawl_status FROM urls ORDER BY run_id, url"
+        async with connection.db.execute(query) as cursor:
+            assert await cursor.fetchall() == [
+                ("1", "a", "3"),
+                ("1", "b", "1"),
+                ("2", "a", "3"),
+            ]
+        await connection.close()
+        SQLiteConnection.open_connections.pop(table.db_file)
+
+    @pytest.mark.asyncio
+    async def test_upsert_mixed_rows(self, tmp_path):
+        table = BaseTable(
+            str(tmp_path / "test.db"),
+            "runs",
+            ["id", "run_id", "event", "max_pages", "redis_memory_peak"],
+            ["INTEGER PRIMARY KEY AUTOINCREMENT", "TEXT", "TEXT", "INTEGER", "INTEGER"],
+            "id",
+            ["run_id", "event"],
+        )
+        await table.db_operation(operation="create")
+        rows = [
+            {"run_id": "1", "event": "start_run", "max_pages": 10},
+            {"run_id": "1", "event": "complete_run", "redis_memory_peak": 2048},
+        ]
+        assert await table.db_operation(rows, "upsert") is True
+        # Written again w/o the memory peak, which is kept as it was
+        rows = [{"run_id": "1", "event": "complete_run", "max_pages": 10}]
+        assert await table.db_operation(rows, "upsert") is True
+
+        connection = SQLiteConnection.get(table.db_file)
+        query = "SELECT event, max_pages, redis_memory_peak FROM runs ORDER BY id"
+        assert await connection.read(query) == [
+            ("start_run", 10, None),
+            ("complete_run", 10, 2048),
+        ]
+        await connection.close()
+        SQLiteConnection.open_connections.pop(table.db_file)
+
+    @pytest.mark.asyncio
+    async def test_migrate(self, tmp_path):
+        """Test tables from before upserts are given their columns and keys"""
+        db_file = str(tmp_path / "test.db")
+        conn = sqlite3.connect(db_file)
+        conn.execute(
+            "CREATE TABLE urls (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " run_id TEXT, url TEXT, crawl_status TEXT, UNIQUE(id))"
+        )
+        conn.executemany(
+            "INSERT INTO urls (run_id, url, crawl_status) VALUES (?, ?, ?)",
+            [("1", "a", "1"), ("1", "a", "3"), ("1", "b", "3")],
+        )
+        conn.commit()
+        conn.close()
+        table = BaseTable(
+            db_file,
+            "urls",
+            ["id", "run_id", "url", "crawl_status", "content_hash"],
+            ["INTEGER PRIMARY KEY AUTOINCREMENT"] + ["TEXT"] * 4,
+            "id",
+            ["run_id", "url"],
+        )
+        await table.db_operation(operation="create")
+        await table.migrate()
+        rows = [{"run_id": "1", "url": "a", "crawl_status": "5", "content_hash": "h"}]
+        assert await table.db_operation(rows, "upsert") is True
+        # Migrating again finds nothing to do
+        await table.migrate()
+
+        connection = SQLiteConnection.get(db_file)
+        query = "SELECT url, crawl_status, content_hash FROM urls ORDER BY url"
+        assert await connection.read(query) == [("a", "5", "h"), ("b", "3", None)]
+        await connection.close()
+        SQLiteConnection.open_connections.pop(db_file)
+
     @pytest.mark.asyncio
     async def test_db_operation(self, base_table: BaseTable, mock_aiosqlite: AsyncMock):
         data = [{"name": "test1", "value": "value1"}]
@@ -232,6 +351,60 @@ class TestBulkDBWriter:
         _ = await bulk_writer.flush_data("test_table")
         assert bulk_writer.to_write == {"test_table": []}
 
+    @pytest.mark.asyncio
+    async def test_flush_due(self, mock_redis: AsyncMock):
+        writer = BulkDBWriter({}, mock_redis, batch_size=2, max_bytes=10, max_age=60)
+        assert writer.flush_due() is False
+        await writer.store_data("test_table", {"id": 1, "data": "a"})
+        assert writer.flush_due() is False
+        # Any of rows, bytes or age buffered is enough
+        await writer.store_data("test_table", {"id": 2, "data": "b"})
+        assert writer.flush_due() is True
+        writer.batch_size = 3
+        await writer.store_data("test_table", {"id": 3, "data": "0123456789"})
+        assert writer.flush_due() is True
+        writer.batch_size, writer.max_bytes = 10, 100
+        assert writer.flush_due() is False
+        writer.oldest -= 60
+        assert writer.flush_due() is True
+
+    def test_adapt_batch_size(self, mock_redis: AsyncMock):
+        writer = BulkDBWriter(
+            {}, mock_redis, batch_size=100, max_batch_size=300, target_latency=1.0
+        )
+        writer.adapt_batch_size(100, 0.1)
+        assert writer.batch_size == 200
+        writer.adapt_batch_size(200, 0.1)
+        assert writer.batch_size == 300
+        # Batches cut short by age or bytes say nothing of larger ones
+        writer.adapt_batch_size(10, 0.1)
+        assert writer.batch_size == 300
+        writer.adapt_batch_size(300, 2.0)
+        assert writer.batch_size == 150
+
+    @pytest.mark.asyncio
+    async def test_flush_in_background(self, bulk_writer: BulkDBWriter):
+        writing = []
+        written = []
+
+        async def db_operation(data, operation):
+            # Only one batch is ever being written
+            assert writing == []
+            writing.append(data)
+            await asyncio.sleep(0.05)
+            written.append(writing.pop())
+            return True
+
+        bulk_writer.tables["test_table"].db_operation = db_operation
+        await bulk_writer.store_data("test_table", {"id": 1, "data": "test1"})
+        await bulk_writer.flush_in_background()
+        await bulk_writer.store_data("test_table", {"id": 2, "data": "test2"})
+        # Waits on the batch already being written before starting another
+        await bulk_writer.flush_in_background()
+        assert len(written) == 1
+        await bulk_writer.wait_flushed()
+        assert [row["id"] for rows in written for row in rows] == [1, 2]
+
     @pytest.mark.asyncio
     async def test_handle_message_stopword(
         self, bulk_writer: BulkDBWriter, mock_redis: AsyncMock
@@ -271,6 +444,170 @@ class TestBulkDBWriter:
     #     assert len(fakeredisBulkDBWriter.to_write["test_table"]) == 1
 
 
+class TestSQLiteConnection:
+    @pytest.fixture
+    def table(self, tmp_path):
+        yield BaseTable(
+            str(tmp_path / "test.db"), "test_table", ["id", "data"], ["INTEGER", "TEXT"]
+        )
+        SQLiteConnection.open_connections.pop(str(tmp_path / "test.db"), None)
+
+    @pytest.mark.asyncio
+    async def test_connection_kept_open(self, table: BaseTable):
+        await table.db_operation(operation="create")
+        connection = SQLiteConnection.get(table.db_file)
+        db = connection.db
+        assert await table.db_operation([{"id": 1, "data": "a"}]) is True
+        assert connection.db is db
+        async with db.execute("PRAGMA journal_mode") as cursor:
+            assert await cursor.fetchone() == ("wal",)
+        await connection.close()
+
+    @pytest.mark.asyncio
+    async def test_batch_rolled_back(self, table: BaseTable):
+        await table.db_operation(operation="create")
+        connection = SQLiteConnection.get(table.db_file)
+        query = "INSERT INTO test_table (id, data) VALUES (?, ?)"
+        with pytest.raises(sqlite3.IntegrityError):
+            await connection.write(query, [(1, "a"), (1, "b")])
+        # None of the batch is written, and the connection can still be used
+        await connection.write(query, [(2, "c")])
+        async with connection.db.execute("SELECT id FROM test_table") as cursor:
+            assert await cursor.fetchall() == [(2,)]
+        await connection.close()
+
+
+class TestLinksTable:
+    @pytest.fixture
+    def tables(self, tmp_path):
+        db_file = str(tmp_path / "test.db")
+        yield {
+            "url_ids": BaseTable(
+                db_file,
+                "url_ids",
+                ["id", "url"],
+                ["INTEGER PRIMARY KEY AUTOINCREMENT", "TEXT"],
+                "id",
+                ["url"],
+            ),
+            "links": LinksTable(
+                db_file,
+                "links",
+                ["run_id", "src_id", "dst_id"],
+                ["TEXT", "INTEGER", "INTEGER"],
+                "id",
+                ["run_id", "src_id", "dst_id"],
+                {"links_by_dst": ["dst_id", "run_id", "src_id"]},
+            ),
+        }
+        SQLiteConnection.open_connections.pop(db_file, None)
+
+    @pytest.mark.asyncio
+    async def test_links_written_by_id(self, tables: dict[str, BaseTable]):
+        for table in tables.values():
+            await table.db_operation(operation="create")
+            for query in table.build_index_strings():
+                await table.execute_query(query)
+        links = tables["links"]
+        edges = [
+            {"run_id": "1", "src": "a", "dst": "b"},
+            {"run_id": "1", "src": "c", "dst": "b"},
+            {"run_id": "1", "src": "b", "dst": "a"},
+        ]
+        assert await links.db_operation(edges, "upsert") is True
+        # Edges found again are only stored once
+        assert await links.db_operation(edges[:1], "upsert") is True
+
+        db = SQLiteConnection.get(links.db_file).db
+        async with db.execute("SELECT url FROM url_ids ORDER BY id") as cursor:
+            assert await cursor.fetchall() == [("a",), ("b",), ("c",)]
+        async with db.execute("SELECT count(*) FROM links") as cursor:
+            assert await cursor.fetchone() == (3,)
+        query = "EXPLAIN QUERY PLAN SELECT src_id FROM links WHERE dst_id = 2"
+        async with db.execute(query) as cursor:
+            plan = " ".join(row[-1] for row in await cursor.fetchall())
+        assert "COVERING INDEX links_by_dst" in plan
+
+        db_manager = DatabaseManager(None, links.db_file)
+        assert sorted(await db_manager.links_to("b", "1")) == ["a", "c"]
+        assert await db_manager.links_to("b", "2") == []
+        await SQLiteConnection.get(links.db_file).close()
+
+    @pytest.mark.asyncio
+    async def test_process_key_adds_links(
+        self, tables: dict[str, BaseTable], async_redis_conn: FakeRedis
+    ):
+        tracker = CrawlTracker(async_redis_conn, "http://example.com/", "1", 100)
+        url = "http://example.com/a"
+        await async_redis_conn.delete(f"urls:{url}:linked_urls")
+        await tracker.init_url_data(url)
+        await tracker.update_url(url, {"linked_urls": ["http://example.com/b"]})
+
+        writer = BulkDBWriter(tables, async_redis_conn)
+        await writer.store_data("urls", key=f"urls:{url}")
+        assert writer.to_write["links"] == [
+            {"run_id": "1", "src": url, "dst": "http://example.com/b"}
+        ]
+        # Links don't count towards the batch size
+        assert writer.buffered_rows() == 1
+
+
+class TestContentsTable:
+    @pytest.mark.asyncio
+    async def test_content_stored_once(self, tmp_path, async_redis_conn: FakeRedis):
+        db_file = str(tmp_path / "test.db")
+        tables = {
+            "urls": BaseTable(
+                db_file,
+                "urls",
+                ["id", "url", "run_id", "content_hash"],
+                ["INTEGER PRIMARY KEY AUTOINCREMENT", "TEXT", "TEXT", "TEXT"],
+                "id",
+                ["url", "run_id"],
+            ),
+            "contents": ContentsTable(
+                db_file,
+                "contents",
+                ["hash", "size", "body"],
+                ["TEXT", "INTEGER", "BLOB"],
+                "hash",
+                ["hash"],
+            ),
+        }
+        for table in tables.values():
+            await table.db_operation(operation="create")
+
+        tracker = CrawlTracker(async_redis_conn, "http://example.com/", "1", 100)
+        page = "<html>" + "Not found " * 100 + "</html>"
+        urls = ["http://example.com/a", "http://example.com/b"]
+        for url in urls:
+            await tracker.init_url_data(url)
+            await tracker.update_url(url, {"content": page})
+
+        writer = BulkDBWriter(tables, async_redis_conn, key_ttl=-1)
+        for url in urls:
+            await writer.store_data("urls", key=f"urls:{url}")
+        assert await writer.flush_data("all") is True
+        # Written again by a later batch
+        await writer.store_data("urls", key=f"urls:{urls[0]}")
+        assert await writer.flush_data("all") is True
+
+        db = await SQLiteConnection.get(db_file).connect()
+        async with db.execute("SELECT hash, size, length(body) FROM contents") as c:
+            rows = await c.fetchall()
+        assert len(rows) == 1
+        content_hash, size, stored = rows[0]
+        assert size == len(page) and stored < size / 5
+        async with db.execute("SELECT DISTINCT content_hash FROM urls") as c:
+            assert await c.fetchall() == [(content_hash,)]
+
+        db_manager = DatabaseManager(None, db_file)
+        assert await db_manager.page_content(urls[1], "1") == page
+        assert await db_manager.page_content(urls[1], "2") is None
+        await SQLiteConnection.get(db_file).close()
+        SQLiteConnection.open_connections.pop(db_file)
+
+
 class TestDatabaseManager:
     @pytest.fixture
     def db_manager(
@@ -293,34 +630,40 @@ class TestDatabaseManager:
 
     @pytest.mark.asyncio
     async def test_shutdown(self, db_manager):
-        await db_manager._init_db()
+        await db_manager.start()
         await db_manager.shutdown()
         assert len(db_manager.listeners) > 0
 
     @pytest.mark.asyncio
     async def test_start_run_publishes_message(self, db_manager):
-        await db_manager._init_db()
-        db_manager.tables["runs"].execute_query = AsyncMock()
+        await db_manager.start()
+        db_manager.tables["runs"].execute_queries = AsyncMock()
         run_id = "test_run"
         seed_url = "http://example.com"
         max_pages = 100
         _ = await db_manager.start_run(run_id, seed_url, max_pages)
         await db_manager.shutdown()
+        [(query, _)] = db_manager.tables["runs"].execute_queries.call_args[0][0]
         assert (
-            db_manager.tables["runs"].execute_query.call_args[0][0]
+            query
             == "INSERT INTO runs (run_id,seed_url,max_pages,event) VALUES (?,?,?,?)"
+            " ON CONFLICT(run_id, event) DO UPDATE SET seed_url = excluded.seed_url,"
+            " max_pages = excluded.max_pages"
         )
 
     @pytest.mark.asyncio
     async def test_complete_run(self, db_manager):
-        await db_manager._init_db()
-        db_manager.tables["runs"].execute_query = AsyncMock()
+        await db_manager.start()
+        db_manager.tables["runs"].execute_queries = AsyncMock()
         run_id = "test_run"
         seed_url = "http://example.com"
         max_pages = 100
         _ = await db_manager.complete_run(run_id, seed_url, max_pages)
         await db_manager.shutdown()
+        [(query, _)] = db_manager.tables["runs"].execute_queries.call_args[0][0]
         assert (
-            db_manager.tables["runs"].execute_query.call_args[0][0]
+            query
             == "INSERT INTO runs (run_id,seed_url,max_pages,event) VALUES (?,?,?,?)"
+            " ON CONFLICT(run_id, event) DO UPDATE SET seed_url = excluded.seed_url,"
+            " max_pages = excluded.max_pages"
         )
@@ -1,17 +1,22 @@
 from __future__ import annotations
 
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
+import json
+
+import aiohttp
 import pytest
 
-from simple_crawler.downloader import SiteDownloader
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.downloader import NO_RESPONSE_STATUS, SiteDownloader
 
 
 @pytest.fixture
 def mock_manager():
     manager = Mock()
-    manager.crawl_tracker = Mock()
+    manager.crawl_tracker = AsyncMock()
     manager.db_manager = Mock()
+    manager.http_engine = AsyncMock()
     return manager
 
 
@@ -20,15 +25,16 @@ def downloader(mock_manager):
     return SiteDownloader(manager=mock_manager)
 
 
-def test_on_success(downloader):
+@pytest.mark.asyncio
+async def test_on_success(downloader):
     """Test successful download handling"""
     url = "https://example.com"
     content = "<html>test</html>"
     status_code = 200
 
-    downloader.on_success(url, content, status_code)
+    await downloader.on_success(url, content, status_code)
 
-    downloader.crawl_tracker.update_url.assert_called_once_with(
+    downloader.crawl_tracker.update_url.assert_awaited_once_with(
         url,
         {
             "attrs": {"crawl_status": "downloaded", "status_code": 200},
@@ -37,32 +43,32 @@ def test_on_success(downloader):
     )
 
 
-def test_on_failure(downloader):
+@pytest.mark.asyncio
+async def test_on_failure(downloader):
     """Test failed download handling"""
     url = "https://example.com"
     crawl_status = "error"
     status_code = 404
 
-    downloader.crawl_tracker.update_status.return_value = {"some": "data"}
-
-    downloader.on_failure(url, crawl_status, status_code)
+    await downloader.on_failure(url, crawl_status, status_code)
 
-    downloader.crawl_tracker.update_url.assert_called_once_with(
+    downloader.crawl_tracker.update_url.assert_awaited_once_with(
         url, {"attrs": {"crawl_status": "error", "status_code": 404}}, close=True
     )
+    downloader.crawl_tracker.dead_letter.assert_awaited_once_with(url, "error", 404)
 
 
-@patch("simple_crawler.downloader.requests")
-def test_get_page_elements_disallowed(mock_requests, downloader):
+@pytest.mark.asyncio
+async def test_get_page_elements_disallowed(downloader):
     """Test getting page elements when URL is disallowed"""
     url = "https://example.com/private"
 
     with patch.object(downloader, "can_fetch", return_value=False):
-        content, status = downloader.get_page_elements(url)
+        content, status = await downloader.get_page_elements(url)
 
         assert content is None
         assert status == 403
-        mock_requests.get.assert_not_called()
+        downloader.engine.fetch.assert_not_called()
         # I had trouble mocking on_failure, so I just confirmed the contained methods were called
         downloader.crawl_tracker.update_url.assert_called_once_with(
             url,
@@ -71,25 +77,22 @@ def test_get_page_elements_disallowed(mock_requests, downloader):
         )
 
 
-@patch("simple_crawler.downloader.requests")
-def test_get_page_elements_success(mock_requests, downloader):
+@pytest.mark.asyncio
+async def test_get_page_elements_success(downloader):
     """Test getting page elements with successful request"""
     url = "https://example.com"
     response_content = "<html>test</html>"
     status_code = 200
 
-    mock_response = Mock()
-    mock_response.text = response_content
-    mock_response.status_code = status_code
-    mock_requests.get.return_value = mock_response
+    downloader.engine.fetch.return_value = (response_content, status_code, {})
 
     with patch.object(downloader, "can_fetch", return_value=True):
-        content, status = downloader.get_page_elements(url)
+        content, status = await downloader.get_page_elements(url)
 
         assert content == response_content
         assert status == status_code
         # I had trouble mocking on_success, so I just confirmed the contained methods were called
-        mock_requests.get.assert_called_once_with(url, timeout=1)
+        downloader.engine.fetch.assert_awaited_once_with(url)
         downloader.crawl_tracker.update_url.assert_called_once_with(
             url,
             {
@@ -97,3 +100,42 @@ def test_get_page_elements_success(mock_requests, downloader):
                 "content": response_content,
             },
         )
+
+
+@pytest.mark.asyncio
+async def test_get_page_elements_http_error(downloader):
+    """Test that http errors are raised without closing the url"""
+    url = "https://example.com/missing"
+    downloader.engine.fetch.side_effect = aiohttp.ClientResponseError(
+        Mock(real_url=url), (), status=404
+    )
+
+    with patch.object(downloader, "can_fetch", return_value=True):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await downloader.get_page_elements(url)
+
+    # Whether the url is retried or closed is left to the caller
+    downloader.crawl_tracker.update_url.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_on_failure_without_response(mock_manager, async_redis_conn):
+    """Test a connection error is closed out once its retries are exhausted"""
+    url = "https://example.com/unreachable"
+    tracker = CrawlTracker(async_redis_conn, "https://example.com", "test_run", 10, 1)
+    await async_redis_conn.delete(f"urls:{url}:attrs", "retry_attempts", "dead_letter")
+    mock_manager.crawl_tracker = tracker
+    downloader = SiteDownloader(manager=mock_manager)
+    await tracker.init_url_data(url)
+
+    # Connection errors carry no status
+    assert await tracker.schedule_retry(url)
+    assert not await tracker.schedule_retry(url)
+    await downloader.on_failure(url, "error", None)
+
+    attrs = await async_redis_conn.hgetall(f"urls:{url}:attrs")
+    assert attrs[b"crawl_status"] == b"error"
+    assert attrs[b"status_code"] == str(NO_RESPONSE_STATUS).encode()
+    entry = json.loads(await async_redis_conn.lpop("dead_letter"))
+    assert entry["status_code"] == NO_RESPONSE_STATUS
+    assert entry["attempts"] == 2
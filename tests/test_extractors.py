@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+import pytest
+
+from simple_crawler.extractors import EXTRACTORS
+from simple_crawler.parser import extract_links
+
+PAGES = [
+    "",
+    "<html><a href='/x'>a</a></html>",
+    "<?xml version='1.0' encoding='utf-8'?><html><a href='/q?a=1&amp;b=2'>q</a></html>",
+    "<base href='/sub/'><a href='rel'>r</a><A HREF='/ABS'>a</A><a href>e</a><a>n</a>",
+    "<a href='a' href='b'>dup</a><a href='http://other.com/x'>o</a><a href=' s '>s</a>",
+    "<!-- <a href='/comment'> --><script>var s='<a href=\"/js\">';</script>",
+    "<table><a href='/t'>t</a></table><p><a href='/p'><a href='/nested'>n</a></a>",
+    "<a href='/é/ü'>u</a><a href='&#x2F;hex'>h</a><a href='mailto:x@y.com'>m</a>",
+    "<a href='/nul\x00raw'>n</a><a href='/nul&#0;d'>d</a><a href='/nul&#x0;h'>h</a>",
+    "<a href='/q?x=1&notanentity;y'>e</a><a href='/q?x=1&notanentity'>u</a>",
+    "<a href='/q?a&amp'>a</a><a href='/q?b&lt'>l</a><a href='/q?c&copy;'>c</a>",
+    "<a href='/a?x=1&copy=2'>c</a><a href='/a&NotEqualTilde;b'>n</a>",
+    "<a href='/a&#128;b'>e</a><a href='/a&#x9f;b'>y</a><a href='/a&#1;b'>c</a>",
+    "<a href='/a&#xD800;b'>s</a><a href='/a&#x110000;b'>o</a><a href='/a&#13;b'>r</a>",
+    "<base href='/x/' href='/y/'><a href='/a' href='/b\x00'>d</a>",
+    "<script>s='<&#47;script><a href=\"/js\">';</script><a href='&#x2f;&#47;s'>",
+]
+
+
+@pytest.mark.parametrize("content", PAGES)
+def test_engines_extract_same_links(content):
+    """Test every engine finds the same hrefs, and so the same links"""
+    url = "https://example.com/dir/page"
+    reference = EXTRACTORS["bs4"](content)
+    for engine, extractor in EXTRACTORS.items():
+        assert extractor(content) == reference, engine
+        assert sorted(extract_links(url, content, engine)) == sorted(
+            extract_links(url, content, "bs4")
+        )
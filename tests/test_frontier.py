@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.frontier import (HostFrontier, ListFrontier,
+                                     PriorityFrontier, make_frontier)
+
+
+@pytest.fixture
+def priority_tracker(async_redis_conn):
+    return CrawlTracker(
+        async_redis_conn, "http://example.com", "test_run", 100, frontier="priority"
+    )
+
+
+async def clear(tracker):
+    await tracker.rdb.delete(
+        "frontier",
+        "frontier:depth",
+        "frontier:score",
+        "download_requests",
+        "outstanding",
+        "in_flight",
+    )
+
+
+@pytest.mark.asyncio
+async def test_sitemap_priority_first(priority_tracker):
+    """Test pages the sitemap ranks highest are visited first"""
+    await clear(priority_tracker)
+    priorities = {
+        "http://example.com/low": 0.1,
+        "http://example.com/high": 0.9,
+        "http://example.com/mid": 0.5,
+    }
+    await priority_tracker.request_downloads(list(priorities), priorities=priorities)
+
+    popped = [await priority_tracker.get_page_to_visit() for _ in range(3)]
+    assert popped == [
+        "http://example.com/high",
+        "http://example.com/mid",
+        "http://example.com/low",
+    ]
+    assert await priority_tracker.get_page_to_visit() is None
+
+
+@pytest.mark.asyncio
+async def test_depth_and_in_degree(priority_tracker):
+    """Test shallow pages, and pages many others link to, come first"""
+    await clear(priority_tracker)
+    seed = "http://example.com/"
+    await priority_tracker.request_download(seed)
+    assert await priority_tracker.get_page_to_visit() == seed
+
+    await priority_tracker.request_downloads(
+        ["http://example.com/a", "http://example.com/b"], source_url=seed
+    )
+    frontier = priority_tracker.frontier
+    assert await frontier.get_depth("http://example.com/a") == 1
+
+    # Pages further from the seed score lower
+    await priority_tracker.request_downloads(
+        ["http://example.com/a/deep"], source_url="http://example.com/a"
+    )
+    assert await frontier.get_depth("http://example.com/a/deep") == 2
+    # Another link to b raises it above a
+    await priority_tracker.request_downloads(
+        ["http://example.com/b"], source_url="http://example.com/a/deep"
+    )
+
+    popped = [await priority_tracker.get_page_to_visit() for _ in range(3)]
+    assert popped == [
+        "http://example.com/b",
+        "http://example.com/a",
+        "http://example.com/a/deep",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_exit_comes_first(priority_tracker):
+    """Test the exit signal is popped ahead of any url, by every worker"""
+    await clear(priority_tracker)
+    await priority_tracker.request_downloads(["http://example.com/a"])
+    await priority_tracker.signal_exit()
+
+    assert await priority_tracker.get_page_to_visit(timeout=1) == "exit"
+    assert await priority_tracker.get_page_to_visit(timeout=1) == "exit"
+    await priority_tracker.clear_exit()
+    assert await priority_tracker.get_page_to_visit() == "http://example.com/a"
+
+
+@pytest.mark.asyncio
+async def test_requeue(async_redis_conn):
+    """Test retried urls go back on the frontier"""
+    frontier = PriorityFrontier(async_redis_conn, key="frontier_test")
+    await async_redis_conn.delete(frontier.key, frontier.depth_key, frontier.score_key)
+    await frontier.requeue(["http://example.com/retry"])
+    assert await frontier.pop(timeout=1) == b"http://example.com/retry"
+
+
+@pytest.mark.asyncio
+async def test_requeue_keeps_priority(priority_tracker):
+    """Test a requeued url keeps its sitemap priority over later urls"""
+    await clear(priority_tracker)
+    priorities = {"http://example.com/high": 0.9, "http://example.com/low": 0.1}
+    await priority_tracker.request_downloads(list(priorities), priorities=priorities)
+    assert await priority_tracker.get_page_to_visit() == "http://example.com/high"
+
+    await priority_tracker.frontier.requeue([b"http://example.com/high"])
+    assert await priority_tracker.get_page_to_visit() == "http://example.com/high"
+    assert await priority_tracker.get_page_to_visit() == "http://example.com/low"
+
+
+@pytest.mark.asyncio
+async def test_close_forgets_url(priority_tracker):
+    """Test a url's depth and score are dropped once it is closed"""
+    await clear(priority_tracker)
+    seed = "http://example.com/"
+    await priority_tracker.request_download(seed)
+    assert await priority_tracker.get_page_to_visit() == seed
+    await priority_tracker.request_downloads(["http://example.com/a"], source_url=seed)
+    await priority_tracker.close_url(seed)
+
+    frontier = priority_tracker.frontier
+    for key in (frontier.depth_key, frontier.score_key):
+        assert await priority_tracker.rdb.hkeys(key) == [b"http://example.com/a"]
+
+
+def test_make_frontier(async_redis_conn):
+    assert isinstance(make_frontier(async_redis_conn, "list"), ListFrontier)
+    assert isinstance(make_frontier(async_redis_conn, "priority"), PriorityFrontier)
+    assert isinstance(make_frontier(async_redis_conn, "host"), HostFrontier)
+    with pytest.raises(ValueError):
+        make_frontier(async_redis_conn, "stack")
+
+
+@pytest.fixture
+def host_frontier(async_redis_conn):
+    return HostFrontier(async_redis_conn, key="host_frontier", default_delay=60)
+
+
+async def push(frontier, urls):
+    pipe = frontier.rdb.pipeline()
+    frontier.push(pipe, urls)
+    await pipe.execute()
+
+
+async def clear_hosts(frontier):
+    keys = await frontier.rdb.keys(f"{frontier.key}*")
+    if keys:
+        await frontier.rdb.delete(*keys)
+
+
+@pytest.mark.asyncio
+async def test_host_frontier_round_robin(host_frontier):
+    """Test a host w/ a long queue doesn't hold up other hosts"""
+    await clear_hosts(host_frontier)
+    await push(host_frontier, [f"http://big.com/{i}" for i in range(100)])
+    await push(host_frontier, ["http://a.com/1", "http://b.com/1", "http://b.com/2"])
+
+    popped = [await host_frontier.pop() for _ in range(3)]
+    assert sorted(popped) == [b"http://a.com/1", b"http://b.com/1", b"http://big.com/0"]
+    # Every host now waits out its delay
+    assert await host_frontier.pop() is None
+    assert await host_frontier.rdb.zscore(host_frontier.hosts_key, "big.com") > 0
+
+
+@pytest.mark.asyncio
+async def test_host_frontier_delays(host_frontier):
+    """Test hosts are spaced out by their own delay"""
+    await clear_hosts(host_frontier)
+    delays = {"fast.com": 0, "slow.com": 60}
+    host_frontier.set_delays(lambda host: delays[host])
+    await push(host_frontier, ["http://slow.com/1", "http://slow.com/2"])
+    await push(host_frontier, ["http://fast.com/1", "http://fast.com/2"])
+
+    popped = [await host_frontier.pop(timeout=0.5) for _ in range(4)]
+    assert popped[:3].count(b"http://slow.com/1") == 1
+    assert b"http://fast.com/1" in popped and b"http://fast.com/2" in popped
+    assert b"http://slow.com/2" not in popped
+
+
+@pytest.mark.asyncio
+async def test_host_frontier_wakes_and_exits(host_frontier):
+    """Test a blocked pop wakes for new urls and for the exit signal"""
+    await clear_hosts(host_frontier)
+
+    async def push_later():
+        await asyncio.sleep(0.05)
+        await push(host_frontier, ["http://late.com/1"])
+
+    task = asyncio.create_task(push_later())
+    assert await host_frontier.pop(timeout=2) == b"http://late.com/1"
+    await task
+
+    await host_frontier.signal_exit()
+    assert await host_frontier.pop(timeout=1) == b"exit"
+    await host_frontier.clear_exit()
+    assert await host_frontier.pop(timeout=0.05) is None
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import aiohttp
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from simple_crawler.http_engine import HttpEngine
+
+
+async def page(request):
+    return web.Response(text="<html>hello</html>", content_type="text/html")
+
+
+async def missing(request):
+    return web.Response(status=404, text="not here")
+
+
+@pytest_asyncio.fixture
+async def server():
+    app = web.Application()
+    app.router.add_get("/page", page)
+    app.router.add_get("/missing", missing)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_reuses_session(server):
+    """Test that every fetch goes through the one pooled session"""
+    engine = HttpEngine(max_connections=4, max_per_host=2)
+    content, status, headers = await engine.fetch(str(server.make_url("/page")))
+    session = await engine.get_session()
+    await engine.fetch(str(server.make_url("/page")))
+
+    assert content == "<html>hello</html>"
+    assert status == 200
+    assert headers["Content-Type"].startswith("text/html")
+    assert await engine.get_session() is session
+    assert session.connector.limit == 4
+    assert session.connector.limit_per_host == 2
+    await engine.close()
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_fetch_raise_for_status(server):
+    """Test that error statuses raise unless explicitly allowed"""
+    engine = HttpEngine()
+    url = str(server.make_url("/missing"))
+    with pytest.raises(aiohttp.ClientResponseError) as err:
+        await engine.fetch(url)
+    assert err.value.status == 404
+
+    content, status, _ = await engine.fetch(url, raise_for_status=False)
+    assert (content, status) == ("not here", 404)
+    await engine.close()
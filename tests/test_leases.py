@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import time
+
+import pytest
+import redis as redis_sync
+from redis import asyncio as redis
+
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.config.configuration import REDIS_HOST, REDIS_PORT
+from simple_crawler.streams import HOSTNAME, StreamQueue
+
+SEED = "http://example.com/"
+# Kept apart from the crawler's own db
+SCALING_DB = 15
+
+
+@pytest.fixture
+def crawl_tracker(async_redis_conn):
+    return CrawlTracker(async_redis_conn, SEED, "test_run", 100, lease_timeout=60)
+
+
+async def clear(tracker):
+    await tracker.rdb.delete(
+        "to_visit",
+        "download_requests",
+        "outstanding",
+        "completed_pages",
+        "leases",
+        "lease_owners",
+        "heartbeats",
+        "retry_queue",
+        "retry_attempts",
+    )
+
+
+@pytest.mark.asyncio
+async def test_popped_urls_are_leased(crawl_tracker):
+    """Test a popped url is leased to its worker until it's closed"""
+    await clear(crawl_tracker)
+    url = f"{SEED}a"
+    await crawl_tracker.request_download(url)
+    assert await crawl_tracker.get_page_to_visit() == url
+
+    expiry = await crawl_tracker.rdb.zscore("leases", url)
+    assert time.time() < expiry <= time.time() + 60
+    owner = await crawl_tracker.rdb.hget("lease_owners", url)
+    assert owner.decode("utf-8") == crawl_tracker.worker_id
+
+    await crawl_tracker.close_url(url)
+    assert await crawl_tracker.rdb.zcard("leases") == 0
+    assert crawl_tracker.leased == set()
+
+
+@pytest.mark.asyncio
+async def test_deferred_urls_requeued(crawl_tracker):
+    """Test a url put back on the frontier is no longer leased, and is popped again"""
+    await clear(crawl_tracker)
+    url = f"{SEED}a"
+    await crawl_tracker.request_download(url)
+    assert await crawl_tracker.get_page_to_visit() == url
+
+    await crawl_tracker.defer(url)
+    assert await crawl_tracker.rdb.zcard("leases") == 0
+    assert crawl_tracker.leased == set()
+    assert await crawl_tracker.get_page_to_visit() == url
+
+
+@pytest.mark.asyncio
+async def test_retries_release_leases(crawl_tracker):
+    """Test urls waiting on the retry queue aren't leased meanwhile"""
+    await clear(crawl_tracker)
+    url = f"{SEED}a"
+    await crawl_tracker.request_download(url)
+    await crawl_tracker.get_page_to_visit()
+    assert await crawl_tracker.schedule_retry(url)
+    assert await crawl_tracker.rdb.zscore("leases", url) is None
+
+
+@pytest.mark.asyncio
+async def test_close_drops_retry_attempts(crawl_tracker):
+    """Test a url that succeeds on a retry doesn't keep its count of attempts"""
+    await clear(crawl_tracker)
+    url = f"{SEED}a"
+    await crawl_tracker.request_download(url)
+    await crawl_tracker.get_page_to_visit()
+    assert await crawl_tracker.schedule_retry(url)
+    assert await crawl_tracker.rdb.hget("retry_attempts", url) == b"1"
+
+    await crawl_tracker.close_url(url)
+    assert await crawl_tracker.rdb.hget("retry_attempts", url) is None
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_extends_leases(crawl_tracker):
+    """Test heartbeats push back the expiry of the worker's leases"""
+    await clear(crawl_tracker)
+    url = f"{SEED}a"
+    await crawl_tracker.request_download(url)
+    await crawl_tracker.get_page_to_visit()
+    await crawl_tracker.rdb.zadd("leases", {url: time.time() + 1})
+
+    await crawl_tracker.heartbeat()
+    assert await crawl_tracker.rdb.zscore("leases", url) > time.time() + 30
+    assert await crawl_tracker.live_workers() == [crawl_tracker.worker_id]
+
+    # Leases already reaped aren't brought back
+    await crawl_tracker.rdb.zrem("leases", url)
+    await crawl_tracker.heartbeat()
+    assert await crawl_tracker.rdb.zscore("leases", url) is None
+
+
+@pytest.mark.asyncio
+async def test_reaper_requeues_lapsed_leases(crawl_tracker, async_redis_conn):
+    """Test urls held by a worker that stopped sending heartbeats are requeued"""
+    await clear(crawl_tracker)
+    dead = CrawlTracker(async_redis_conn, SEED, "test_run", 100, lease_timeout=60)
+    dead.worker_id = "dead-node:1"
+    urls = [f"{SEED}a", f"{SEED}b"]
+    await crawl_tracker.request_downloads(urls)
+    popped = [await dead.get_page_to_visit() for _ in urls]
+    assert sorted(popped) == sorted(urls)
+    assert await crawl_tracker.get_page_to_visit() is None
+    assert await crawl_tracker.reap_expired_leases() == []
+
+    # No heartbeats come, so the leases lapse
+    await crawl_tracker.rdb.zadd("leases", {url: time.time() - 1 for url in urls})
+    reaped = await crawl_tracker.reap_expired_leases()
+    assert sorted(reaped) == sorted(urls)
+    # Still outstanding, so the crawl doesn't end early
+    assert int(await crawl_tracker.rdb.get("outstanding")) == 2
+    assert await crawl_tracker.reap_expired_leases() == []
+
+    again = {await crawl_tracker.get_page_to_visit() for _ in urls}
+    assert again == set(urls)
+
+
+def test_forked_workers_named_apart(crawl_tracker, async_redis_conn):
+    """Test processes forked w/ a tracker each lease urls under their own id"""
+    queue = StreamQueue(async_redis_conn, "stream:test")
+    context = multiprocessing.get_context("fork")
+    names = context.Queue()
+
+    def report():
+        names.put((os.getpid(), crawl_tracker.worker_id, queue.consumer))
+
+    workers = [context.Process(target=report) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    reported = [names.get(timeout=10) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=10)
+
+    assert len({worker_id for _, worker_id, _ in reported}) == 2
+    for pid, worker_id, consumer in reported:
+        assert worker_id == consumer == f"{HOSTNAME}:{pid}"
+    assert crawl_tracker.worker_id == f"{HOSTNAME}:{os.getpid()}"
+
+
+def redis_server_available() -> bool:
+    try:
+        return redis_sync.Redis(host=REDIS_HOST, port=REDIS_PORT).ping()
+    except (redis_sync.ConnectionError, redis_sync.TimeoutError):
+        return False
+
+
+def scaling_worker(worker: int, crash_after: int | None):
+    """Pops and closes urls until none are left, or exits abruptly"""
+
+    async def work():
+        conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=SCALING_DB)
+        tracker = CrawlTracker(conn, SEED, "scaling", 10_000, lease_timeout=1)
+        popped = 0
+        while True:
+            url = await tracker.get_page_to_visit(timeout=0.2)
+            if url == "exit":
+                break
+            if url is None:
+                await tracker.heartbeat()
+                continue
+            popped += 1
+            if crash_after is not None and popped >= crash_after:
+                # Dies holding its leases, w/o closing them
+                os._exit(1)
+            await conn.rpush("closed", url)
+            await tracker.close_url(url)
+        await conn.aclose()
+
+    asyncio.run(work())
+
+
+@pytest.mark.skipif(not redis_server_available(), reason="needs a redis-server")
+def test_workers_across_processes():
+    """Test urls held by a process that dies are crawled by the others"""
+    conn = redis_sync.Redis(host=REDIS_HOST, port=REDIS_PORT, db=SCALING_DB)
+    conn.flushdb()
+    urls = [f"{SEED}{page}" for page in range(60)]
+
+    async def seed():
+        async_conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=SCALING_DB)
+        tracker = CrawlTracker(async_conn, SEED, "scaling", 10_000)
+        await tracker.request_downloads(urls)
+        await async_conn.aclose()
+
+    asyncio.run(seed())
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=scaling_worker, args=(i, 3 if i == 0 else None))
+        for i in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+
+    assert workers[0].exitcode == 1
+    assert all(worker.exitcode == 0 for worker in workers[1:])
+    closed = [url.decode("utf-8") for url in conn.lrange("closed", 0, -1)]
+    # Every url is crawled once, the crashed worker's via the reaper
+    assert sorted(closed) == sorted(urls)
+    assert int(conn.get("completed_pages")) == len(urls)
+    conn.flushdb()
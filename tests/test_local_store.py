@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+import redis
+
+from simple_crawler.frontier import HostFrontier, PriorityFrontier
+from simple_crawler.local_store import LocalRedis
+from simple_crawler.seen import BloomSeenSet
+
+
+@pytest.fixture
+def local_redis():
+    return LocalRedis(max_content_bytes=10)
+
+
+@pytest.mark.asyncio
+async def test_values_returned_as_bytes(local_redis):
+    """Test values come back encoded, as from a redis client"""
+    await local_redis.set("count", 3)
+    assert await local_redis.get("count") == b"3"
+    assert await local_redis.incr("count") == 4
+
+    await local_redis.hset("attrs", mapping={"run_id": "1", "max_pages": 10})
+    assert await local_redis.hgetall("attrs") == {b"run_id": b"1", b"max_pages": b"10"}
+    assert await local_redis.hmget("attrs", ["run_id", "missing"]) == [b"1", None]
+
+    with pytest.raises(redis.ResponseError):
+        await local_redis.lpush("attrs", "a")
+
+
+@pytest.mark.asyncio
+async def test_pipeline(local_redis):
+    """Test pipelined commands chain and return their results in order"""
+    results = await (
+        local_redis.pipeline().sadd("seen", "a").sadd("seen", "a").scard("seen")
+    ).execute()
+    assert results == [1, 0, 1]
+
+
+@pytest.mark.asyncio
+async def test_lists(local_redis):
+    """Test list commands match redis, including empty lists being dropped"""
+    await local_redis.lpush("queue", "a", "b")
+    await local_redis.rpush("queue", "c")
+    assert await local_redis.lrange("queue", 0, -1) == [b"b", b"a", b"c"]
+    assert await local_redis.lrem("queue", 0, "a") == 1
+    await local_redis.ltrim("queue", 0, 0)
+    assert await local_redis.lpop("queue") == b"b"
+    assert await local_redis.exists("queue") == 0
+
+
+@pytest.mark.asyncio
+async def test_sorted_set_order(local_redis):
+    """Test sorted sets pop highest first and range lowest first"""
+    await local_redis.zadd("ranked", {"a": 1, "b": 2, "c": 2, "d": 0})
+    assert await local_redis.zadd("ranked", {"a": 5}, xx=True, incr=True) == 6
+    assert await local_redis.zadd("ranked", {"e": 1}, xx=True, incr=True) is None
+    assert await local_redis.zadd("ranked", {"d": 9}, nx=True) == 0
+
+    assert await local_redis.zrange("ranked", 0, 0, withscores=True) == [(b"d", 0)]
+    assert await local_redis.zrangebyscore("ranked", "-inf", 2) == [b"d", b"b", b"c"]
+    assert await local_redis.zremrangebyscore("ranked", "-inf", 0) == 1
+    # Equal scores pop in reverse lexical order, as in redis
+    popped = [await local_redis.zpopmax("ranked") for _ in range(3)]
+    assert popped == [[(b"a", 6.0)], [(b"c", 2.0)], [(b"b", 2.0)]]
+    assert await local_redis.zcard("ranked") == 0
+
+
+@pytest.mark.asyncio
+async def test_blocking_pop_wakes(local_redis):
+    """Test a blocking pop returns as soon as something is pushed"""
+
+    async def push_later():
+        await asyncio.sleep(0.05)
+        await local_redis.rpush("queue", "a")
+
+    task = asyncio.create_task(push_later())
+    started = time.monotonic()
+    assert await local_redis.blpop(["queue"], timeout=2) == (b"queue", b"a")
+    assert time.monotonic() - started < 1
+    await task
+
+    assert await local_redis.bzpopmax("ranked", timeout=0.05) is None
+    assert local_redis.waiters == []
+
+
+@pytest.mark.asyncio
+async def test_expiry(local_redis):
+    """Test keys set w/ an expiry report their ttl and then disappear"""
+    await local_redis.set("robots:a", "rules", ex=60)
+    await local_redis.set("robots:b", "rules", ex=0)
+    assert await local_redis.ttl("robots:a") == 60
+    assert await local_redis.ttl("robots:b") == -2
+    assert await local_redis.get("robots:b") is None
+
+    await local_redis.set("slot", 1, px=500)
+    assert not await local_redis.set("slot", 1, px=500, nx=True)
+    assert 0 < await local_redis.pttl("slot") <= 500
+    assert await local_redis.pttl("robots:b") == -2
+
+
+@pytest.mark.asyncio
+async def test_content_bounded(local_redis):
+    """Test page content beyond the limit is dropped, oldest first"""
+    await local_redis.set("urls:a:content", "123456")
+    await local_redis.set("urls:b:content", "123456")
+    assert await local_redis.get("urls:a:content") is None
+    assert await local_redis.get("urls:b:content") == b"123456"
+    assert local_redis.content_bytes == 6
+
+
+@pytest.mark.asyncio
+async def test_frontiers_and_seen_sets(local_redis):
+    """Test the redis backed frontiers and seen sets run unchanged"""
+    priority = PriorityFrontier(local_redis)
+    pipe = local_redis.pipeline()
+    priority.push(pipe, ["a", "b"], priorities={"b": 0.9})
+    await pipe.execute()
+    assert await priority.pop() == b"b"
+
+    hosts = HostFrontier(local_redis, default_delay=60)
+    pipe = local_redis.pipeline()
+    hosts.push(pipe, ["http://a.com/1", "http://a.com/2", "http://b.com/1"])
+    await pipe.execute()
+    popped = {await hosts.pop(), await hosts.pop()}
+    assert popped == {b"http://a.com/1", b"http://b.com/1"}
+    # a.com is waiting out its delay
+    assert await hosts.pop() is None
+
+    seen = BloomSeenSet(local_redis, "seen", initial_capacity=100)
+    assert await seen.add_many(["a", "b", "a"]) == [True, True, False]
+    assert await seen.count() == 2
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import tempfile
+from collections import Counter
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import manager as manager_module
+
+# main sets up a manager on import, kept out of the package's data dir
+manager_module.DATA_DIR = tempfile.mkdtemp()
+
+from simple_crawler import main  # noqa: E402
+from simple_crawler.local_store import LocalRedis  # noqa: E402
+
+PAGES = {
+    "/": ["/a", "/b"],
+    "/a": ["/b", "/c"],
+    "/b": ["/"],
+    "/c": [],
+}
+
+# Links from one page to many more on the same host
+WIDE_LINKS = 50
+
+
+def links_on(path: str) -> list[str]:
+    if path == "/wide":
+        return [f"/wide/{i}" for i in range(WIDE_LINKS)]
+    return PAGES.get(path, [])
+
+
+async def page(request):
+    request.app["hits"][request.path] += 1
+    links = "".join(f'<a href="{link}">{link}</a>' for link in links_on(request.path))
+    html = f"<html><body>{links}</body></html>"
+    return web.Response(text=html, content_type="text/html")
+
+
+@pytest_asyncio.fixture
+async def site():
+    app = web.Application()
+    app["hits"] = Counter()
+    for path in [*PAGES, "/wide", "/wide/{i}"]:
+        app.router.add_get(path, page)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await server.close()
+
+
+def use_manager(monkeypatch) -> main.Manager:
+    """A fresh manager for the test run, as a new crawler process would have"""
+    manager = main.Manager(run_id="test_run", redis_conn=LocalRedis())
+    manager.set_crawl_delay(0)
+    monkeypatch.setattr(main, "manager", manager)
+    return manager
+
+
+@pytest.fixture
+def crawl_manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(manager_module, "DATA_DIR", str(tmp_path))
+    return use_manager(monkeypatch)
+
+
+async def crawl(
+    url: str, max_pages: int = 10, resume: bool = False, download_workers: int = 2
+):
+    main.manager.set_seed_url(url)
+    main.manager.set_max_pages(max_pages)
+    return await main.process_url_while_true(
+        url,
+        retries=0,
+        download_workers=download_workers,
+        parse_workers=1,
+        parse_processes=0,
+        resume=resume,
+    )
+
+
+def crawled_rows(manager) -> dict[str, str]:
+    conn = sqlite3.connect(manager.sqlite_path)
+    rows = conn.execute("SELECT url, crawl_status FROM urls").fetchall()
+    conn.close()
+    return dict(rows)
+
+
+@pytest.mark.asyncio
+async def test_crawled_pages_persisted(site, crawl_manager):
+    """Test pages are written to sqlite, and dropped from redis once written"""
+    seed = str(site.make_url("/"))
+    await crawl(seed)
+
+    rows = crawled_rows(crawl_manager)
+    assert set(rows) == {str(site.make_url(path)) for path in PAGES}
+    assert set(rows.values()) == {"parsed"}
+    for url in rows:
+        assert not await crawl_manager.rdb.exists(f"urls:{url}:attrs", url)
+
+    conn = sqlite3.connect(crawl_manager.sqlite_path)
+    events = conn.execute("SELECT event FROM runs WHERE run_id = 'test_run'")
+    assert {event for event, in events} == {"start_run", "complete_run"}
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_resume(site, crawl_manager, monkeypatch):
+    """Test a resumed crawl carries on from the pages already written"""
+    seed = str(site.make_url("/"))
+    await crawl(seed, max_pages=2, download_workers=1)
+    # Pages already downloaded when the limit is reached are still written
+    assert 2 <= len(crawled_rows(crawl_manager)) < len(PAGES)
+
+    resumed_manager = use_manager(monkeypatch)
+    await crawl(seed, resume=True, download_workers=1)
+
+    assert set(crawled_rows(resumed_manager)) == {
+        str(site.make_url(path)) for path in PAGES
+    }
+    # Pages written before the crawl was stopped aren't downloaded again
+    assert site.app["hits"] == Counter({path: 1 for path in PAGES})
+
+
+@pytest.mark.asyncio
+async def test_waiting_urls_stay_queued(site, crawl_manager):
+    """Test workers waiting out a host's delay leave the rest of its urls queued"""
+    crawl_manager.set_crawl_delay(0.3)
+    tracker = crawl_manager.crawl_tracker
+    crawling = asyncio.create_task(crawl(str(site.make_url("/wide")), max_pages=4))
+
+    async def links_queued():
+        while not await tracker.frontier.queued():
+            await asyncio.sleep(0.05)
+
+    await asyncio.wait_for(links_queued(), 5)
+    await asyncio.sleep(0.5)
+    assert len(await tracker.frontier.queued()) >= WIDE_LINKS - 4
+    # Each download worker holds at most the url it's waiting to fetch
+    assert len(tracker.leased) <= 2
+    await crawling
@@ -1,6 +1,12 @@
 from __future__ import annotations
 
 import os
+from unittest.mock import AsyncMock
+
+import pytest
+
+from simple_crawler import manager as manager_module
+from simple_crawler.manager import Manager
 
 
 def test_manager_initialization(manager):
@@ -30,3 +36,20 @@ def test_init_dirs(manager):
     assert manager.data_dir.endswith(manager.run_id)
     assert manager.rdb_path.endswith("data.rdb")
     assert manager.sqlite_path.endswith(manager.db_file)
+
+
+@pytest.mark.asyncio
+async def test_save_cache(manager, monkeypatch, tmp_path):
+    """Test redis is snapshotted, w/ the save awaited, before its dump is copied"""
+    monkeypatch.setattr(manager_module, "loc", str(tmp_path / "simple_crawler"))
+    manager.rdb = AsyncMock()
+    manager.rdb_path = str(tmp_path / "data.rdb")
+
+    async def save():
+        (tmp_path / "dump.rdb").write_bytes(b"REDIS0011")
+
+    manager.rdb.save.side_effect = save
+    await Manager.save_cache(manager)
+    manager.rdb.save.assert_awaited_once()
+    with open(manager.rdb_path, "rb") as f:
+        assert f.read() == b"REDIS0011"
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from datetime import datetime, timezone
 from unittest.mock import Mock
 
 import pytest
@@ -62,6 +63,7 @@ class TestSiteMapper:
             "priority",
             "changefreq",
             "modified",
+            "lastmod",
         ]
 
     def test_parse_sitemap_index(self, mapper, sitemap_index):
@@ -83,16 +85,18 @@ class TestSiteMapper:
         assert details["modified"] == "2023-01-01"
         assert details["status"] == "Success"
 
-    def test_recurse_sitemap_with_index(self, mapper, sitemap_index):
+    @pytest.mark.asyncio
+    async def test_recurse_sitemap_with_index(self, mapper, sitemap_index):
         sm_url = "https://example.com/sitemap-index.xml"
-        mapper.recurse_sitemap("https://example.com/sitemap-index.xml", sitemap_index)
+        await mapper.recurse_sitemap("https://example.com/sitemap-index.xml", sitemap_index)
         sm_one = mapper.sitemap_indexes[sm_url]
         assert len(sm_one) == 2
         assert "https://example.com/sitemap1.xml" in sm_one
         assert "https://example.com/sitemap2.xml" in sm_one
 
-    def test_recurse_sitemap_with_urls(self, mapper, sitemap_content):
-        mapper.recurse_sitemap(
+    @pytest.mark.asyncio
+    async def test_recurse_sitemap_with_urls(self, mapper, sitemap_content):
+        await mapper.recurse_sitemap(
             "https://example.com/sitemap.xml", sitemap_content, "root"
         )
 
@@ -101,7 +105,41 @@ class TestSiteMapper:
         assert mapper.sitemap_details[0]["priority"] == "0.8"
         assert mapper.sitemap_details[0]["status"] == "Success"
 
-    def test_get_sitemap_urls(self, mapper, mocker: MockerFixture):
+    @pytest.mark.asyncio
+    async def test_recurse_sitemap_queues_every_url(self, mapper):
+        sitemap = """<?xml version="1.0" encoding="UTF-8"?>
+        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+            <url><loc>https://example.com/page1</loc><priority>0.8</priority></url>
+            <url><loc>https://example.com/page2</loc></url>
+        </urlset>"""
+        await mapper.recurse_sitemap("https://example.com/sitemap.xml", sitemap, "root")
+
+        assert [d["loc"] for d in mapper.sitemap_details] == [
+            "https://example.com/page1",
+            "https://example.com/page2",
+        ]
+        mapper.crawl_tracker.request_downloads.assert_called_once_with(
+            ["https://example.com/page1", "https://example.com/page2"],
+            priorities={
+                "https://example.com/page1": 0.8,
+                "https://example.com/page2": 0.5,
+            },
+        )
+
+    def test_priority_freshness(self, mapper):
+        """Test pages that change often or changed lately are crawled first"""
+        today = datetime.now(timezone.utc).date().isoformat()
+        assert mapper.get_priority({"priority": "0.5"}) == 0.5
+        assert mapper.get_priority({"changefreq": "daily"}) > 0.5
+        assert mapper.get_priority({"changefreq": "yearly"}) < 0.5
+        assert mapper.get_priority({"changefreq": "sometimes"}) == 0.5
+        recent = mapper.get_priority({"lastmod": today})
+        stale = mapper.get_priority({"lastmod": "2001-01-01T00:00:00Z"})
+        assert stale < 0.5 < recent
+        assert mapper.get_priority({"lastmod": "not a date"}) == 0.5
+
+    @pytest.mark.asyncio
+    async def test_get_sitemap_urls(self, mapper, mocker: MockerFixture):
         mock_request = mocker.patch.object(mapper, "request_page")
         mock_request.return_value = """<?xml version="1.0" encoding="UTF-8"?>
         <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
@@ -110,7 +148,7 @@ class TestSiteMapper:
             </url>
         </urlset>"""
 
-        sitemap_url, indexes, details = mapper.get_sitemap_urls(
+        sitemap_url, indexes, details = await mapper.get_sitemap_urls(
             "https://example.com/sitemap.xml"
         )
 
@@ -118,7 +156,8 @@ class TestSiteMapper:
         assert len(details) == 1
         assert details[0]["loc"] == "https://example.com/page1"
 
-    def test_get_sitemap(self, mapper, mocker: MockerFixture):
+    @pytest.mark.asyncio
+    async def test_get_sitemap(self, mapper, mocker: MockerFixture):
         mock_get_urls = mocker.patch.object(mapper, "get_sitemap_urls")
         mock_get_urls.return_value = (
             "https://example.com/sitemap.xml",
@@ -129,7 +168,7 @@ class TestSiteMapper:
         mock_read = mocker.patch.object(mapper.downloader, "read_politeness_info")
         mock_read.return_value = (["https://example.com/sitemap.xml"], None, None)
 
-        sitemap_url, indexes, details = mapper.get_sitemap()
+        sitemap_url, indexes, details = await mapper.get_sitemap()
 
         assert sitemap_url == "https://example.com/sitemap.xml"
         assert indexes == {"root": []}
@@ -1,19 +1,22 @@
 from __future__ import annotations
 
 import unittest
-from unittest.mock import Mock, patch
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import AsyncMock, Mock, patch
 from urllib.parse import urljoin
 
 from simple_crawler.parser import Parser
 
 
-class TestParser(unittest.TestCase):
+class TestParser(unittest.IsolatedAsyncioTestCase):
+    engine = "bs4"
+
     def setUp(self):
         self.mock_manager = Mock()
-        self.mock_manager.crawl_tracker = Mock()
-        self.parser = Parser(manager=self.mock_manager)
+        self.mock_manager.crawl_tracker = AsyncMock()
+        self.parser = Parser(manager=self.mock_manager, engine=self.engine)
 
-    def test_get_links_from_content(self):
+    async def test_get_links_from_content(self):
         """Test extracting links from HTML content"""
         test_url = "https://example.com"
         test_content = """
@@ -26,29 +29,54 @@ class TestParser(unittest.TestCase):
         </html>
         """
         self.parser.crawl_tracker.get_cached_response.return_value = test_content
-        links = self.parser.get_links_from_content(test_url, test_content)
+        links = await self.parser.get_links_from_content(test_url, test_content)
 
         expected_links = {urljoin(test_url, "/page1"), "https://example.com/page2"}
 
         self.assertEqual(links, expected_links)
-        self.mock_manager.crawl_tracker.request_download.assert_called()
+        request_downloads = self.mock_manager.crawl_tracker.request_downloads
+        request_downloads.assert_called_once()
+        self.assertEqual(set(request_downloads.call_args[0][0]), expected_links)
 
-    def test_on_success(self):
+    async def test_get_links_from_content_in_process_pool(self):
+        """Test link extraction offloaded to a process pool gives the same links"""
+        test_url = "https://example.com"
+        test_content = """
+        <html>
+            <body>
+                <a href="/page1">Page 1</a>
+                <a href="https://example.com/page2">Page 2</a>
+                <a href="https://other-domain.com/page3">Page 3</a>
+            </body>
+        </html>
+        """
+        with ProcessPoolExecutor(1) as executor:
+            parser = Parser(
+                manager=self.mock_manager, executor=executor, engine=self.engine
+            )
+            links = await parser.get_links_from_content(test_url, test_content)
+
+        expected_links = {urljoin(test_url, "/page1"), "https://example.com/page2"}
+        self.assertEqual(links, expected_links)
+        self.mock_manager.crawl_tracker.request_downloads.assert_called_once()
+
+    async def test_on_success(self):
         """Test successful parsing callback"""
         test_url = "https://example.com"
-        self.parser.on_success(test_url, ["https://example.com"])
+        await self.parser.on_success(test_url, ["https://example.com"])
         self.mock_manager.crawl_tracker.update_url.assert_called_with(
             test_url,
             {
                 "attrs": {"crawl_status": "parsed"},
                 "linked_urls": ["https://example.com"],
             },
+            close=True,
         )
 
-    def test_on_failure(self):
+    async def test_on_failure(self):
         """Test failure parsing callback"""
         test_url = "https://example.com"
-        self.parser.on_failure(test_url)
+        await self.parser.on_failure(test_url)
         print(self.mock_manager.crawl_tracker.update_url.call_args)
         self.mock_manager.crawl_tracker.update_url.assert_called_with(
             test_url,
@@ -58,13 +86,13 @@ class TestParser(unittest.TestCase):
             close=True,
         )
 
-    def test_parse_success(self):
+    async def test_parse_success(self):
         """Test successful parsing of a page"""
         test_url = "https://example.com"
         test_content = "<html><a href='/test'>Test</a></html>"
 
         self.parser.url = test_url
-        self.parser.parse(test_url, test_content)
+        await self.parser.parse(test_url, test_content)
         self.parser.crawl_tracker.get_cached_response.return_value = test_content
 
         self.mock_manager.crawl_tracker.update_url.assert_called_with(
@@ -73,9 +101,10 @@ class TestParser(unittest.TestCase):
                 "attrs": {"crawl_status": "parsed"},
                 "linked_urls": ["https://example.com/test"],
             },
+            close=True,
         )
 
-    def test_on_failure_called_after_exception(self):
+    async def test_on_failure_called_after_exception(self):
         """Test failure parsing callback"""
         with patch(
             "simple_crawler.parser.Parser.get_links_from_content",
@@ -84,27 +113,78 @@ class TestParser(unittest.TestCase):
             test_url = "https://example.com"
             test_content = "<html><a href='/test'>Test</a></html>"
             self.parser.crawl_tracker.get_cached_response.return_value = test_content
-            self.parser.parse(url=test_url)
+            await self.parser.parse(url=test_url)
             self.mock_manager.crawl_tracker.update_url.assert_called_with(
                 test_url, {"attrs": {"crawl_status": "error"}}, close=True
             )
 
-    def test_parse_failure(self):
+    async def test_parse_failure(self):
         """Test parsing with an error"""
         test_url = "https://example.com"
         test_content = None  # Invalid content to trigger exception
 
         self.parser.url = test_url
-        self.parser.parse(test_url, test_content)
+        await self.parser.parse(test_url, test_content)
 
         self.mock_manager.crawl_tracker.update_url.assert_called_with(
             test_url, {"attrs": {"crawl_status": "error"}}, close=True
         )
 
-    def test_invalid_href(self):
+    async def test_invalid_href(self):
         """Test handling of invalid href attributes"""
         test_url = "https://example.com"
         test_content = "<html><a href='javascript:void(0)'>Invalid</a></html>"
 
-        links = self.parser.get_links_from_content(test_url, test_content)
+        links = await self.parser.get_links_from_content(test_url, test_content)
         self.assertEqual(links, set())
+
+    async def test_base_href(self):
+        """Test relative links resolve against the page's <base> tag"""
+        test_url = "https://example.com/dir/page"
+        test_content = (
+            "<html><head><base href='/sub/'></head>"
+            "<body><a href='rel'>Rel</a><a href='/abs'>Abs</a></body></html>"
+        )
+
+        links = await self.parser.get_links_from_content(test_url, test_content)
+        self.assertEqual(
+            links, {"https://example.com/sub/rel", "https://example.com/abs"}
+        )
+
+    async def test_character_references(self):
+        """Test references in hrefs are read as html.parser reads them"""
+        test_url = "https://example.com"
+        test_content = (
+            "<a href='/a&#128;b'>Windows-1252</a>"
+            "<a href='/c&#xD800;d'>Surrogate</a>"
+            "<a href='/e&#x110000;f'>Out of range</a>"
+            "<a href='/g?x=1&copy=2'>Unterminated</a>"
+            "<a href='/h&notanentity;'>Unknown</a>"
+            "<a href='/i' href='/j'>Repeated</a>"
+        )
+
+        links = await self.parser.get_links_from_content(test_url, test_content)
+        self.assertEqual(
+            links,
+            {
+                "https://example.com/a%E2%82%ACb",
+                "https://example.com/c%EF%BF%BDd",
+                "https://example.com/e%EF%BF%BDf",
+                "https://example.com/g?x=1%C2%A9=2",
+                "https://example.com/h%C2%ACanentity",
+                "https://example.com/j",
+            },
+        )
+
+    def test_unknown_engine(self):
+        """Test an unknown parse engine is rejected up front"""
+        with self.assertRaises(ValueError):
+            Parser(manager=self.mock_manager, engine="regex")
+
+
+class TestParserLxml(TestParser):
+    engine = "lxml"
+
+
+class TestParserStream(TestParser):
+    engine = "stream"
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+import redis as redis_sync
+from protego import RequestRate
+from redis import asyncio as redis
+
+from simple_crawler.config.configuration import REDIS_HOST, REDIS_PORT
+from simple_crawler.local_store import LocalRedis
+from simple_crawler.politeness import (HostLimits, PolitenessScheduler,
+                                       parse_retry_after)
+
+# Kept apart from the crawler's own db
+POLITENESS_DB = 14
+
+
+@pytest.fixture
+def robots_cache():
+    robots = AsyncMock()
+    robots.read_politeness_info.return_value = ([], None, None)
+    return robots
+
+
+async def clear(conn):
+    """Drops the hosts' slots left by other tests on the shared fake server"""
+    keys = await conn.keys("politeness:*")
+    if keys:
+        await conn.delete(*keys)
+
+
+@pytest_asyncio.fixture(params=["redis", "local"])
+async def scheduler(request, robots_cache, async_redis_conn):
+    conn = async_redis_conn if request.param == "redis" else LocalRedis()
+    if request.param == "redis":
+        await clear(conn)
+    return PolitenessScheduler(robots_cache, conn, default_delay=1.0, max_delay=30.0)
+
+
+@pytest.mark.asyncio
+async def test_get_delay_default(scheduler):
+    """Test the configured delay is used when robots.txt sets none"""
+    assert await scheduler.get_delay("https://example.com/a") == 1.0
+
+
+@pytest.mark.asyncio
+async def test_get_delay_from_robots(scheduler, robots_cache):
+    """Test crawl-delay and request-rate are read, taking the stricter"""
+    robots_cache.read_politeness_info.return_value = (
+        [],
+        RequestRate(1, 5, None, None),
+        2.0,
+    )
+    assert await scheduler.get_delay("https://example.com/a") == 5.0
+
+    robots_cache.read_politeness_info.return_value = ([], None, 600)
+    assert await scheduler.get_delay("https://slow.com/a") == 30.0
+
+
+@pytest.mark.asyncio
+async def test_reserve_spaces_same_host(scheduler):
+    """Test a second request to a host waits until its delay passes"""
+    assert await scheduler.reserve("https://example.com/a")
+    assert not await scheduler.reserve("https://example.com/b")
+    assert 0 < await scheduler.ready_in("https://example.com/b") <= 1.0
+
+    # Once the host is ready its next request goes ahead
+    await scheduler.rdb.delete(scheduler.slot_key("example.com"))
+    assert await scheduler.ready_in("https://example.com/b") == 0
+    assert await scheduler.reserve("https://example.com/b")
+
+
+@pytest.mark.asyncio
+async def test_reserve_independent_hosts(scheduler):
+    """Test one busy host does not hold back requests to other hosts"""
+    assert await scheduler.reserve("https://example.com/a")
+    assert not await scheduler.reserve("https://example.com/b")
+    assert await scheduler.reserve("https://other.com/a")
+    assert await scheduler.reserve("https://sub.example.com/a")
+
+
+@pytest.mark.asyncio
+async def test_wait_for_slot(scheduler):
+    """Test a worker waits out a short delay, but not one longer than its timeout"""
+    scheduler.delays["example.com"] = 0.2
+    assert await scheduler.wait_for_slot("https://example.com/a", 1.0)
+    started = time.monotonic()
+    assert await scheduler.wait_for_slot("https://example.com/b", 1.0)
+    assert time.monotonic() - started >= 0.15
+
+    assert not await scheduler.wait_for_slot("https://example.com/c", 0.05)
+
+
+@pytest.mark.asyncio
+async def test_robots_error_uses_default(scheduler, robots_cache):
+    """Test an unreadable robots.txt falls back to the default delay"""
+    robots_cache.read_politeness_info.side_effect = Exception("boom")
+    assert await scheduler.get_delay("https://example.com/a") == 1.0
+
+
+def test_parse_retry_after():
+    """Test Retry-After is read as either seconds or an http date"""
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_host_limits_additive_increase():
+    """Test healthy responses raise the limit gradually, up to the max"""
+    limits = HostLimits(initial_limit=2, max_limit=4)
+    for _ in range(50):
+        limits.acquire("example.com")
+        limits.release("example.com", 200, 0.1)
+    assert limits.limits["example.com"] == 4
+    assert limits.in_flight["example.com"] == 0
+
+
+def test_host_limits_throttle_backs_off():
+    """Test a 429 halves the limit and pauses the host for Retry-After"""
+    limits = HostLimits(initial_limit=4, max_limit=8, default_backoff=10)
+    limits.acquire("example.com")
+    limits.release("example.com", 429, 0.1, retry_after=30)
+    assert limits.limits["example.com"] == 2
+    assert 29 < limits.backoff_until["example.com"] - time.monotonic() <= 30
+
+    # Without Retry-After, repeated throttling backs off exponentially
+    limits.release("example.com", 503, 0.1)
+    assert limits.limits["example.com"] == 1
+    assert 19 < limits.backoff_until["example.com"] - time.monotonic() <= 20
+    assert limits.snapshot()["example.com"]["limit"] == 1
+
+
+def test_host_limits_recover_after_throttle():
+    """Test the limit climbs back once a throttled host is healthy"""
+    limits = HostLimits(initial_limit=4, max_limit=4)
+    limits.release("example.com", 429, 0.1)
+    assert limits.limits["example.com"] == 2
+    for _ in range(20):
+        limits.release("example.com", 200, 0.1)
+    assert limits.limits["example.com"] == 4
+    assert limits.throttled["example.com"] == 0
+
+
+def test_host_limits_slow_responses_decrease():
+    """Test latency far above the host's best cuts the limit"""
+    limits = HostLimits(initial_limit=4, latency_tolerance=2.0)
+    limits.release("example.com", 200, 0.1)
+    before = limits.limits["example.com"]
+    limits.release("example.com", 200, 1.0)
+    assert limits.limits["example.com"] == before * 0.5
+    limits.release("example.com", None, 0.1)
+    assert limits.limits["example.com"] == before * 0.25
+
+
+@pytest.mark.asyncio
+async def test_reserve_respects_host_limits(scheduler):
+    """Test a host at its concurrency limit is deferred, and backoff is honoured"""
+    scheduler.delays["example.com"] = 0
+    scheduler.host_limits.limits["example.com"] = 1
+    assert await scheduler.reserve("https://example.com/a")
+    assert not await scheduler.reserve("https://example.com/b")
+
+    await scheduler.release("https://example.com/a", 429, 0.1, retry_after=60)
+    assert not await scheduler.reserve("https://example.com/c")
+    assert await scheduler.ready_in("https://example.com/c") > 59
+
+
+@pytest.mark.asyncio
+async def test_publish_limits(scheduler):
+    """Test host limits are written to redis for monitoring"""
+    await scheduler.reserve("https://example.com/a")
+    await scheduler.release("https://example.com/a", 200, 0.1)
+    await scheduler.publish_limits()
+    state = await scheduler.rdb.hget("host_limits", "example.com")
+    assert json.loads(state)["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_hosts_shared_between_schedulers(scheduler, robots_cache):
+    """Test a host's delay, backoff and concurrency hold for every process"""
+    other = PolitenessScheduler(robots_cache, scheduler.rdb, default_delay=1.0)
+    assert await scheduler.reserve("https://example.com/a")
+    assert not await other.reserve("https://example.com/b")
+    assert 0 < await other.ready_in("https://example.com/b") <= 1.0
+
+    for each in (scheduler, other):
+        each.delays["example.com"] = 0
+        each.host_limits.limits["example.com"] = 2
+    await scheduler.rdb.delete(scheduler.slot_key("example.com"))
+    assert await other.reserve("https://example.com/b")
+    # Both places are taken, one by each scheduler
+    assert not await scheduler.reserve("https://example.com/c")
+
+    await other.release("https://example.com/b", 429, 0.1, retry_after=60)
+    assert not await scheduler.reserve("https://example.com/c")
+    assert await scheduler.ready_in("https://example.com/c") > 59
+
+
+def redis_server_available() -> bool:
+    try:
+        return redis_sync.Redis(host=REDIS_HOST, port=REDIS_PORT).ping()
+    except (redis_sync.ConnectionError, redis_sync.TimeoutError):
+        return False
+
+
+def requesting_worker(requests: int, delay: float):
+    """Makes requests to one host as its politeness allows, recording when"""
+
+    async def work():
+        conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=POLITENESS_DB)
+        robots = AsyncMock()
+        robots.read_politeness_info.return_value = ([], None, delay)
+        scheduler = PolitenessScheduler(robots, conn)
+        for page in range(requests):
+            url = f"https://example.com/{page}"
+            while not await scheduler.wait_for_slot(url, 5.0):
+                pass
+            await conn.rpush("requested", time.time())
+            await scheduler.release(url, 200, 0.01)
+        await conn.aclose()
+
+    asyncio.run(work())
+
+
+@pytest.mark.skipif(not redis_server_available(), reason="needs a redis-server")
+def test_delay_across_processes():
+    """Test processes crawling one host space their requests by its crawl-delay"""
+    conn = redis_sync.Redis(host=REDIS_HOST, port=REDIS_PORT, db=POLITENESS_DB)
+    conn.flushdb()
+    delay = 0.2
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=requesting_worker, args=(3, delay)) for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+
+    assert all(worker.exitcode == 0 for worker in workers)
+    requested = sorted(float(at) for at in conn.lrange("requested", 0, -1))
+    assert len(requested) == 12
+    gaps = [later - earlier for earlier, later in zip(requested, requested[1:])]
+    # A little slack for the time between claiming a slot and recording it
+    assert min(gaps) >= delay - 0.05
+    conn.flushdb()
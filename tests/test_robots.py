@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+
+from simple_crawler.robots import RobotsCache
+
+ROBOTS_TXT = """User-agent: *
+Disallow: /private
+Crawl-delay: 2
+Request-rate: 3/10s
+Sitemap: https://example.com/sitemap.xml
+"""
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncMock()
+    engine.fetch.return_value = (ROBOTS_TXT, 200, {})
+    return engine
+
+
+@pytest_asyncio.fixture
+async def robots_cache(async_redis_conn, engine):
+    await async_redis_conn.flushall()
+    return RobotsCache(async_redis_conn, engine, ttl=60)
+
+
+@pytest.mark.asyncio
+async def test_can_fetch(robots_cache):
+    """Test robots.txt rules are applied to the requested url"""
+    assert await robots_cache.can_fetch("https://example.com/public")
+    assert not await robots_cache.can_fetch("https://example.com/private/page")
+
+
+@pytest.mark.asyncio
+async def test_rules_cached_per_host(robots_cache, engine):
+    """Test robots.txt is fetched once per host, not once per url"""
+    await robots_cache.can_fetch("https://example.com/a")
+    await robots_cache.can_fetch("https://example.com/b")
+    await robots_cache.can_fetch("https://other.com/a")
+
+    fetched = [call.args[0] for call in engine.fetch.call_args_list]
+    assert fetched == [
+        "https://example.com/robots.txt",
+        "https://other.com/robots.txt",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_coalesced(robots_cache, engine):
+    """Test concurrent lookups for one host share a single fetch"""
+
+    async def slow_fetch(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return ROBOTS_TXT, 200, {}
+
+    engine.fetch.side_effect = slow_fetch
+    urls = [f"https://example.com/page{i}" for i in range(20)]
+    allowed = await asyncio.gather(*[robots_cache.can_fetch(url) for url in urls])
+
+    assert all(allowed)
+    assert engine.fetch.await_count == 1
+    assert robots_cache.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_stored_copy_survives_new_cache(robots_cache, engine, async_redis_conn):
+    """Test a new cache (e.g. a later run) reads robots.txt from redis"""
+    await robots_cache.can_fetch("https://example.com/a")
+    ttl = await async_redis_conn.ttl("robots:https://example.com")
+    assert 0 < ttl <= 60
+
+    new_engine = AsyncMock()
+    new_cache = RobotsCache(async_redis_conn, new_engine, ttl=60)
+    assert not await new_cache.can_fetch("https://example.com/private")
+    new_engine.fetch.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_expired_rules_reloaded(robots_cache, engine, async_redis_conn):
+    """Test rules past their TTL are loaded again"""
+    await robots_cache.can_fetch("https://example.com/a")
+    host = "https://example.com"
+    expires_at, rules = robots_cache.rules[host]
+    robots_cache.rules[host] = (0, rules)
+    await async_redis_conn.delete(f"robots:{host}")
+
+    await robots_cache.can_fetch("https://example.com/a")
+    assert engine.fetch.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_missing_robots_allows_all(robots_cache, engine):
+    """Test that a 404 allows crawling"""
+    engine.fetch.return_value = ("<html>Not Found</html>", 404, {})
+    assert await robots_cache.can_fetch("https://example.com/private")
+
+
+@pytest.mark.asyncio
+async def test_unreachable_robots_disallows_all(robots_cache, engine, async_redis_conn):
+    """Test a server error or failed fetch disallows crawling, for a short while"""
+    robots_cache.error_ttl = 5
+    engine.fetch.return_value = ("<html>Unavailable</html>", 503, {})
+    assert not await robots_cache.can_fetch("https://example.com/public")
+
+    engine.fetch.side_effect = Exception("connection refused")
+    assert not await robots_cache.can_fetch("https://down.com/public")
+
+    # Nothing is stored, so later runs fetch again
+    for host in ("https://example.com", "https://down.com"):
+        assert not await async_redis_conn.exists(f"robots:{host}")
+        expires_at, _ = robots_cache.rules[host]
+        assert expires_at <= time.monotonic() + 5
+
+
+@pytest.mark.asyncio
+async def test_read_politeness_info(robots_cache):
+    """Test sitemaps, request rate and crawl delay are read from the cache"""
+    sitemaps, rrate, crawl_delay = await robots_cache.read_politeness_info(
+        "https://example.com/sitemap-index.xml"
+    )
+    assert list(sitemaps) == ["https://example.com/sitemap.xml"]
+    assert (rrate.requests, rrate.seconds) == (3, 10)
+    assert crawl_delay == 2.0
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import pytest
+
+from simple_crawler.seen import BloomSeenSet, make_seen_set
+
+URLS = [f"https://example.com/page/{i}" for i in range(50)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["set", "hash", "bloom"])
+async def test_add_many(async_redis_conn, backend):
+    """Test each backend reports which urls are new"""
+    key = f"seen_test:{backend}"
+    await async_redis_conn.delete(key, f"{key}:grown", f"{key}:counts")
+    await async_redis_conn.delete(*[f"{key}:bloom:{i}" for i in range(4)])
+    seen = make_seen_set(async_redis_conn, key, backend)
+
+    assert await seen.add_many(URLS[:30]) == [True] * 30
+    assert await seen.add_many(URLS[20:]) == [False] * 10 + [True] * 20
+    assert await seen.add(URLS[0]) is False
+    assert await seen.count() == 50
+
+    stats = await seen.stats()
+    assert stats["backend"] == backend
+    assert stats["count"] == 50
+    assert stats["bytes_per_url"] > 0
+
+
+@pytest.mark.asyncio
+async def test_bloom_grows(async_redis_conn):
+    """Test a full bloom filter starts a new slice, and still knows old urls"""
+    key = "seen_test:bloom_growth"
+    await async_redis_conn.delete(key, f"{key}:grown", f"{key}:counts")
+    await async_redis_conn.delete(*[f"{key}:bloom:{i}" for i in range(4)])
+    urls = [f"https://example.com/grow/{i}" for i in range(300)]
+    seen = BloomSeenSet(async_redis_conn, key, 1e-6, initial_capacity=100)
+
+    assert all(await seen.add_many(urls[:100]))
+    assert seen.slices == 2
+    assert await seen.add_many(urls[:100]) == [False] * 100
+    # The second slice is twice the size of the first
+    assert all(await seen.add_many(urls[100:]))
+    assert seen.slices == 3
+    # A second worker picks up the slices the first has started
+    other = BloomSeenSet(async_redis_conn, key, 1e-6, initial_capacity=100)
+    assert await other.add_many(urls) == [False] * 300
+    assert other.slices == 3
+
+
+def test_bloom_sizing():
+    """Test slices get larger and stricter as the filter grows"""
+    seen = BloomSeenSet(None, "sizing", error_rate=0.001, initial_capacity=1000)
+    first, second = seen.slice_params(0), seen.slice_params(1)
+    assert second[0] == 2 * first[0]
+    assert second[2] > first[2]
+    # Roughly 14 bits (under 2 bytes) per url at 0.05% error
+    assert first[1] / first[0] < 16
+
+
+def test_unknown_backend(async_redis_conn):
+    with pytest.raises(ValueError):
+        make_seen_set(async_redis_conn, "seen_test", "list")
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+from simple_crawler.cache import CrawlTracker
+from simple_crawler.data import BulkDBWriter
+from simple_crawler.streams import StreamQueue
+
+
+@pytest.fixture
+def queue(async_redis_conn):
+    return StreamQueue(async_redis_conn, "stream:test", consumer="worker-1")
+
+
+@pytest.fixture
+def stream_tracker(async_redis_conn):
+    return CrawlTracker(
+        async_redis_conn, "http://example.com", "test_run", 100, transport="streams"
+    )
+
+
+async def clear(redis_conn):
+    await redis_conn.delete(
+        "stream:test",
+        "stream:download",
+        "stream:download:exit",
+        "stream:persist",
+        "download_requests",
+        "outstanding",
+        "completed_pages",
+    )
+
+
+@pytest.mark.asyncio
+async def test_put_get_ack(queue):
+    """Test messages are delivered in order and dropped once acknowledged"""
+    await clear(queue.rdb)
+    await queue.put("http://example.com/a")
+    await queue.put("http://example.com/b")
+
+    entries = await queue.get(count=2)
+    assert [message for _, message in entries] == [
+        "http://example.com/a",
+        "http://example.com/b",
+    ]
+    assert await queue.pending() == 2
+    # Already delivered, so not handed out again
+    assert await queue.get() == []
+
+    await queue.ack(*[entry_id for entry_id, _ in entries])
+    assert await queue.pending() == 0
+    assert await queue.rdb.xlen("stream:test") == 0
+
+
+@pytest.mark.asyncio
+async def test_consumers_share_work(queue, async_redis_conn):
+    """Test each message goes to only one consumer in the group"""
+    await clear(queue.rdb)
+    other = StreamQueue(async_redis_conn, "stream:test", consumer="worker-2")
+    for page in ("a", "b"):
+        await queue.put(f"http://example.com/{page}")
+
+    first = await queue.get()
+    second = await other.get()
+    assert first[0][1] == "http://example.com/a"
+    assert second[0][1] == "http://example.com/b"
+    assert await other.get() == []
+
+
+@pytest.mark.asyncio
+async def test_stale_messages_claimed(queue, async_redis_conn):
+    """Test messages left unacknowledged, e.g. by a crashed worker, are redelivered"""
+    await clear(queue.rdb)
+    await queue.put("http://example.com/a")
+    assert len(await queue.get()) == 1
+
+    other = StreamQueue(
+        async_redis_conn, "stream:test", consumer="worker-2", claim_idle=0
+    )
+    claimed = await other.get()
+    assert [message for _, message in claimed] == ["http://example.com/a"]
+
+    await other.ack(claimed[0][0])
+    assert await other.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_frontier(stream_tracker):
+    """Test urls stay pending on the frontier until the download is acknowledged"""
+    await clear(stream_tracker.rdb)
+    url = "http://example.com/a"
+    assert await stream_tracker.request_download(url)
+    assert await stream_tracker.get_page_to_visit() == url
+    assert await stream_tracker.frontier.queue.pending() == 1
+
+    await stream_tracker.ack_download(url)
+    assert await stream_tracker.frontier.queue.pending() == 0
+    assert await stream_tracker.get_page_to_visit() is None
+
+    await stream_tracker.signal_exit()
+    assert await stream_tracker.get_page_to_visit() == "exit"
+    await stream_tracker.clear_exit()
+    assert await stream_tracker.get_page_to_visit() is None
+
+
+@pytest.mark.asyncio
+async def test_close_url_adds_to_persist_stream(stream_tracker, async_redis_conn):
+    """Test closed urls are passed to the db writer on the persist stream"""
+    await clear(stream_tracker.rdb)
+    await stream_tracker.request_download("http://example.com/a")
+    await stream_tracker.close_url("http://example.com/a")
+
+    entries = await stream_tracker.persist_stream.get()
+    assert json.loads(entries[0][1]) == {
+        "key": "urls:http://example.com/a",
+        "table_name": "urls",
+    }
+
+
+@pytest.mark.asyncio
+async def test_writer_acks_after_flush(queue, async_redis_conn):
+    """Test the db writer only acknowledges messages once they are written"""
+    await clear(queue.rdb)
+    writer = BulkDBWriter({}, async_redis_conn)
+    written = []
+
+    async def store_data(table_name, data=None, key=None):
+        written.append(data)
+
+    writer.store_data = store_data
+    await queue.put(json.dumps({"table_name": "runs", "data": {"run_id": "1"}}))
+    await queue.put("exit")
+
+    await writer.handle_stream(queue)
+    assert written == [{"run_id": "1"}]
+    assert not writer.running
+    assert await queue.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_writer_stops_after_batch(queue, async_redis_conn):
+    """Test messages read along w/ the stop message are written, not left pending"""
+    await clear(queue.rdb)
+    writer = BulkDBWriter({}, async_redis_conn)
+    written = []
+
+    async def store_data(table_name, data=None, key=None):
+        written.append(data)
+
+    writer.store_data = store_data
+    await queue.put("exit")
+    await queue.put(json.dumps({"table_name": "runs", "data": {"run_id": "1"}}))
+
+    await writer.handle_stream(queue)
+    assert written == [{"run_id": "1"}]
+    assert not writer.running
+    assert await queue.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_writer_leaves_unwritten_pending(queue, async_redis_conn):
+    """Test messages whose rows couldn't be written are left to be claimed again"""
+    await clear(queue.rdb)
+    table = AsyncMock()
+    # As when the db is locked by another writer
+    table.db_operation.return_value = False
+    writer = BulkDBWriter({"runs": table}, async_redis_conn)
+    await queue.put(json.dumps({"table_name": "runs", "data": {"run_id": "1"}}))
+    await queue.put("exit")
+
+    await writer.handle_stream(queue)
+    table.db_operation.assert_awaited_once()
+    assert await queue.pending() == 2